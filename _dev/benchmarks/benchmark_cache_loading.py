@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""Compare loading a school cache in the formats written by the cache builder.
+
+The cache builder writes a synthetic dataset (see benchmark_expand_licenses.py) to a temporary
+directory as plain JSON, as dictionary encoded JSON (--dictionary-encoding) and in the binary format.
+Then every format is loaded in a fresh process that reads the file and keeps all records, like
+LdapRepository._process_entries() does. The script prints the file sizes, load times, the resident
+memory after loading and the peak memory of every format. It fails if a format doesn't decode to the
+same objects as the plain JSON file.
+
+Run it on a UCS system (the builder imports python-ldap and the UCR, the reader the UMC logging):
+
+    python _dev/benchmarks/benchmark_cache_loading.py [--size 50000]
+"""
+import argparse
+import imp
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BUILDER = os.path.join(
+    BENCHMARK_DIR, '..', '..', 'bildungslogin-plugin', 'bildungslogin_build_ucs_school_api_cache.py')
+READER = os.path.join(
+    BENCHMARK_DIR, '..', '..', 'ucs-school-umc-licenses', 'umc', 'python', 'licenses', 'cache_format.py')
+FORMATS = ('json', 'dictionary', 'binary')
+
+
+def get_memory(field):
+    """Return the given memory value of /proc/self/status in MiB.
+
+    ru_maxrss is inherited on exec, so it is only used if /proc is not available.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def get_paths(directory, cache_format):
+    """Return the path of the JSON file and the path of the file of the given format."""
+    json_path = os.path.join(
+        directory, 'schools', 'dictionary' if cache_format == 'dictionary' else 'plain', 'cache.json')
+    return json_path, os.path.splitext(json_path)[0] + '.bin' if cache_format == 'binary' else json_path
+
+
+def read(cache_format, json_path):
+    cache_format_module = imp.load_source('cache_format', READER)
+    if cache_format == 'binary':
+        return cache_format_module.BinaryCache(os.path.splitext(json_path)[0] + '.bin')
+    with open(json_path) as f:
+        entries = json.load(f)
+    if cache_format == 'dictionary':
+        return cache_format_module.DictionaryEncodedCache(entries)
+    return entries
+
+
+def load(cache_format, directory):
+    """Load the cache file of the given format, print the results as JSON."""
+    json_path, path = get_paths(directory, cache_format)
+    imp.load_source('cache_format', READER)
+    start = time.time()
+    entries = read(cache_format, json_path)
+    records = dict((name, list(entries[name])) for name in entries.keys())
+    print(json.dumps({
+        'seconds': time.time() - start,
+        'objects': sum(len(objs) for objs in records.values()),
+        'size_mib': os.stat(path).st_size / 1024.0 / 1024.0,
+        'rss_mib': get_memory('VmRSS'),
+        'peak_mib': get_memory('VmHWM'),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=50000, help='Number of users of the dataset.')
+    parser.add_argument('--load', choices=FORMATS, help=argparse.SUPPRESS)
+    parser.add_argument('--directory', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.load:
+        return load(args.load, args.directory)
+
+    builder = imp.load_source('bildungslogin_build_ucs_school_api_cache', BUILDER)
+    dataset = imp.load_source('benchmark_expand_licenses', os.path.join(
+        BENCHMARK_DIR, 'benchmark_expand_licenses.py'))
+    directory = tempfile.mkdtemp()
+    try:
+        builder.JSON_DIR = directory + '/'
+        dictionary = dataset.create_dataset(args.size)
+        builder.expand_licenses(dictionary)
+        builder.write_school_cache_file('plain', dictionary)
+        builder.write_school_cache_file('dictionary', dictionary, dictionary_encoding=True)
+
+        expected = dict((name, list(objs)) for name, objs in read('json', get_paths(directory, 'json')[0]).items())
+        for cache_format in FORMATS[1:]:
+            entries = read(cache_format, get_paths(directory, cache_format)[0])
+            if dict((name, list(entries[name])) for name in entries.keys()) != expected:
+                sys.exit('The {} cache file does not match the plain JSON file'.format(cache_format))
+
+        print('{:>10} {:>11} {:>9} {:>9} {:>9} {:>9}'.format(
+            'format', 'size MiB', 'seconds', 'RSS MiB', 'peak MiB', 'objects'))
+        for cache_format in FORMATS:
+            result = json.loads(subprocess.check_output(
+                [sys.executable, __file__, '--load', cache_format, '--directory', directory]).decode('utf-8'))
+            print('{:>10} {:>11.1f} {:>9.3f} {:>9.1f} {:>9.1f} {:>9}'.format(
+                cache_format, result['size_mib'], result['seconds'], result['rss_mib'], result['peak_mib'],
+                result['objects']))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
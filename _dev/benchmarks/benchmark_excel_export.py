@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Compare the peak memory of the Excel exports of the UMC module.
+
+The exports used to build a list of all rows, to insert the header in front of it and to write
+them cell by cell into a workbook, which kept all cells in memory until it was closed.
+excel.write_worksheet() writes rows from a generator into a workbook in constant_memory mode.
+
+The script writes --rows rows like the ones of users_to_excel() both ways, each in its own
+process, and prints the time and the peak memory (maximum resident set size) of the process. It
+only needs the vendored xlsxwriter of the UMC module:
+
+    python _dev/benchmarks/benchmark_excel_export.py [--rows 200000]
+"""
+import argparse
+import imp
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+UMC_MODULE = os.path.join(BENCHMARK_DIR, '..', '..', 'ucs-school-umc-licenses', 'umc', 'python', 'licenses')
+COLUMNS = [
+    'User id', 'Classes', 'Workgroups', 'User role', 'Publisher', 'Date of assignment', 'Import date',
+    'Medium ID', 'Medium', 'License code', 'License type', 'Status',
+]
+
+
+def import_excel_module():
+    """Import excel.py of the UMC module without the UMC module itself."""
+    package = imp.new_module('licenses')
+    package.__path__ = [UMC_MODULE]
+    sys.modules['licenses'] = package
+    return __import__('licenses.excel', fromlist=['excel'])
+
+
+def generate_rows(count):
+    for number in range(count):
+        yield [
+            'user{}'.format(number),
+            'class{}, class{}'.format(number % 40, number % 41),
+            'workgroup{}'.format(number % 70),
+            'Student',
+            'Publisher {}'.format(number % 9),
+            '2022-02-{:02d}'.format(number % 28 + 1),
+            '2022-01-{:02d}'.format(number % 28 + 1),
+            'urn:bilo:medium:{:06d}'.format(number % 2000),
+            'Title of the medium {}'.format(number % 2000),
+            'CODE-{:08d}'.format(number),
+            'Single license',
+            'Assigned',
+        ]
+
+
+def write_in_memory(excel, path, rows):
+    """The export before excel.write_worksheet()."""
+    result = list(rows)
+    workbook = excel.Workbook(path)
+    worksheet = workbook.add_worksheet()
+    header_format = workbook.add_format({'bold': True})
+    result.insert(0, COLUMNS)
+    worksheet.set_column(0, len(COLUMNS) - 1, 25)
+    for row_num, row in enumerate(result):
+        for col_num, data in enumerate(row):
+            if row_num == 0:
+                worksheet.write(row_num, col_num, data, header_format)
+            else:
+                worksheet.write(row_num, col_num, data)
+    workbook.close()
+
+
+def run_export(mode, count):
+    excel = import_excel_module()
+    path = tempfile.mktemp(suffix='.xlsx')
+    start = time.time()
+    try:
+        if mode == 'in-memory':
+            write_in_memory(excel, path, generate_rows(count))
+        else:
+            excel.write_worksheet(path, COLUMNS, generate_rows(count))
+        size = os.path.getsize(path)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print('{:>12} {:>10} {:>8.2f} {:>14.1f} {:>10.1f}'.format(mode, count, time.time() - start, peak, size / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=200000, help='Number of rows of the export.')
+    parser.add_argument('--mode', choices=('in-memory', 'streaming'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.mode:
+        run_export(args.mode, args.rows)
+        return
+
+    print('{:>12} {:>10} {:>8} {:>14} {:>10}'.format('mode', 'rows', 'time s', 'peak memory MB', 'file MB'))
+    sys.stdout.flush()
+    for mode in ('in-memory', 'streaming'):
+        subprocess.check_call(
+            [sys.executable, os.path.abspath(__file__), '--mode', mode, '--rows', str(args.rows)])
+
+
+if __name__ == '__main__':
+    main()
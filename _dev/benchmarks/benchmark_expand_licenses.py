@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Regression benchmark for the license expansion of the UCS@School API cache builder.
+
+The builder used to search the assignee of every WORKGROUP and SCHOOL assignment in the list of all
+groups and schools and to scan all users for the members of an assigned school, so the run time grew
+with licenses x users. Since the expansion uses indexes the run time has to grow linearly with the
+size of the dataset.
+
+Run it on a UCS system (the builder imports python-ldap and the UCR):
+
+    python _dev/benchmarks/benchmark_expand_licenses.py [--size 5000]
+
+The dataset is doubled three times starting with --size users; the script fails if doubling the
+dataset more than triples the run time of expand_licenses().
+"""
+import argparse
+import imp
+import os
+import sys
+import time
+
+BUILDER = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    '..', '..', 'bildungslogin-plugin', 'bildungslogin_build_ucs_school_api_cache.py',
+)
+MAX_GROWTH = 3.0
+
+
+def create_dataset(size):
+    """Return a converted dictionary with `size` users in size / 100 schools.
+
+    Every school has one SCHOOL license and a WORKGROUP license for each of its workgroups of ten
+    users.
+    """
+    dictionary = {
+        'users': [], 'licenses': [], 'assignments': [], 'schools': [], 'workgroups': [], 'classes': [],
+        'metadata': [],
+    }
+    for school_number in range(max(1, size // 100)):
+        school = 'school{}'.format(school_number)
+        dictionary['schools'].append({'entryUUID': 'uuid-' + school, 'entry_dn': 'ou=' + school, 'ou': school})
+        licenses = [('SCHOOL', 'uuid-' + school)]
+        for group_number in range(10):
+            group = '{}-group{}'.format(school, group_number)
+            members = ['{}-user{}'.format(school, group_number * 10 + i) for i in range(10)]
+            dictionary['workgroups'].append({
+                'entryUUID': 'uuid-' + group,
+                'entry_dn': 'cn=' + group,
+                'cn': group,
+                'ucsschoolRole': 'workgroup:school:' + school,
+                'memberUid': members,
+            })
+            licenses.append(('WORKGROUP', 'uuid-' + group))
+            for uid in members:
+                dictionary['users'].append({
+                    'entryUUID': 'uuid-' + uid,
+                    'uid': uid,
+                    'givenName': 'Given',
+                    'sn': 'Surname',
+                    'ucsschoolSchool': [school],
+                    'ucsschoolRole': ['student:school:' + school],
+                })
+        for license_number, (license_type, assignee) in enumerate(licenses):
+            license_dn = 'cn={}-license{},cn=licenses'.format(school, license_number)
+            dictionary['licenses'].append({
+                'entry_dn': license_dn,
+                'bildungsloginLicenseCode': '{}-license{}'.format(school, license_number),
+                'bildungsloginLicenseType': license_type,
+                'bildungsloginLicenseSpecialType': '',
+                'bildungsloginLicenseSchool': school,
+                'bildungsloginDeliveryDate': '2022-01-01',
+            })
+            dictionary['assignments'].append({
+                'entry_dn': 'cn=assignment,' + license_dn,
+                'bildungsloginAssignmentStatus': 'ASSIGNED',
+                'bildungsloginAssignmentAssignee': assignee,
+            })
+    return dictionary
+
+
+def measure(builder, size):
+    dictionary = create_dataset(size)
+    start = time.time()
+    builder.expand_licenses(dictionary)
+    duration = time.time() - start
+    assigned = sum(_license['quantity_assigned'] for _license in dictionary['licenses'])
+    if assigned != 2 * len(dictionary['users']):
+        sys.exit('Wrong expansion: {} assignees for {} users'.format(assigned, len(dictionary['users'])))
+    return duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=5000, help='Number of users of the smallest dataset.')
+    args = parser.parse_args()
+
+    builder = imp.load_source('bildungslogin_build_ucs_school_api_cache', BUILDER)
+    sizes = [args.size * 2 ** i for i in range(4)]
+    durations = [measure(builder, size) for size in sizes]
+
+    print('{:>10} {:>12} {:>8}'.format('users', 'seconds', 'growth'))
+    failed = False
+    for i, (size, duration) in enumerate(zip(sizes, durations)):
+        growth = duration / durations[i - 1] if i and durations[i - 1] else None
+        print('{:>10} {:>12.4f} {:>8}'.format(size, duration, '{:.2f}'.format(growth) if growth else '-'))
+        # very short runs are too noisy to judge the growth
+        if growth and durations[i - 1] > 0.01 and growth > MAX_GROWTH:
+            failed = True
+    if failed:
+        sys.exit('expand_licenses() does not scale linearly anymore')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""Compare the product aggregation of the UMC module with searching the licenses of every product.
+
+products_query() and products_to_excel() used to call filter_licenses() for every product of the
+school and to sum the licenses in several loops, so the run time grew with products x licenses.
+LdapRepository.aggregate_products() aggregates all products in one pass over the licenses.
+
+The script writes a synthetic school with --size licenses of --size / 50 products with the cache
+builder, loads it into an LdapRepository and prints the time of both ways to aggregate the
+products. It fails if they don't return the same sums and counts.
+
+Run it on a UCS system (the builder imports python-ldap and the UCR, the repository the UMC
+libraries):
+
+    python _dev/benchmarks/benchmark_products_query.py [--size 100000]
+"""
+import argparse
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BUILDER = os.path.join(
+    BENCHMARK_DIR, '..', '..', 'bildungslogin-plugin', 'bildungslogin_build_ucs_school_api_cache.py')
+UMC_MODULE = os.path.join(BENCHMARK_DIR, '..', '..', 'ucs-school-umc-licenses', 'umc', 'python', 'licenses')
+SCHOOL = 'school'
+LICENSE_TYPES = ('SINGLE', 'VOLUME', 'WORKGROUP', 'SCHOOL')
+
+
+def import_repository_module():
+    """Import cache.py of the UMC module without the UMC module itself."""
+    package = imp.new_module('licenses')
+    package.__path__ = [UMC_MODULE]
+    sys.modules['licenses'] = package
+    return __import__('licenses.cache', fromlist=['cache'])
+
+
+def create_partition(size):
+    """Return the cache file content of a school with `size` licenses, 50 per product."""
+    partition = {
+        'users': [], 'licenses': [], 'assignments': [], 'workgroups': [], 'classes': [], 'metadata': [],
+        'schools': [{'entryUUID': 'uuid-' + SCHOOL, 'entry_dn': 'ou=' + SCHOOL, 'objectClass': [], 'ou': SCHOOL}],
+    }
+    for product_number in range(max(1, size // 50)):
+        product_id = 'urn:bilo:medium:{:06d}'.format(product_number)
+        partition['metadata'].append({
+            'entryUUID': 'uuid-' + product_id,
+            'entry_dn': 'cn=' + product_id,
+            'objectClass': [],
+            'bildungsloginProductId': product_id,
+            'bildungsloginMetaDataTitle': 'Title {}'.format(product_number),
+            'bildungsloginMetaDataPublisher': 'Publisher',
+            'bildungsloginMetaDataCover': '',
+            'bildungsloginMetaDataCoverSmall': '',
+            'bildungsloginMetaDataAuthor': '',
+            'bildungsloginMetaDataDescription': '',
+        })
+    for license_number in range(size):
+        license_type = LICENSE_TYPES[license_number % len(LICENSE_TYPES)]
+        quantity = 1 if license_type == 'SINGLE' else license_number % 7
+        partition['licenses'].append({
+            'entryUUID': 'uuid-license{}'.format(license_number),
+            'entry_dn': 'cn=license{},cn=licenses'.format(license_number),
+            'objectClass': [],
+            'bildungsloginLicenseCode': 'CODE-{}'.format(license_number),
+            'bildungsloginLicenseSpecialType': '',
+            'bildungsloginProductId': 'urn:bilo:medium:{:06d}'.format(license_number % max(1, size // 50)),
+            'bildungsloginLicenseSchool': SCHOOL,
+            'bildungsloginLicenseType': license_type,
+            'bildungsloginIgnoredForDisplay': '1' if license_number % 23 == 0 else '0',
+            'bildungsloginDeliveryDate': '2022-01-{:02d}'.format(license_number % 28 + 1),
+            'bildungsloginLicenseQuantity': str(quantity),
+            'bildungsloginValidityEndDate': '2020-12-31' if license_number % 11 == 0 else '2099-12-31',
+            'bildungsloginValidityDuration': '',
+            'bildungsloginUtilizationSystems': '',
+            'bildungsloginLicenseProvider': 'Publisher',
+            'bildungsloginValidityStatus': '',
+            'bildungsloginUsageStatus': '',
+            'bildungsloginExpiryDate': '',
+            'quantity_assigned': license_number % 3 if quantity else 0,
+            'user_ids': [],
+            'groups': [],
+        })
+    return partition
+
+
+def aggregate_per_product(repository, license_types):
+    """The aggregation of the previous products_query(): one license search per product."""
+    result = {}
+    for metadata in repository.filter_metadata('*'):
+        licenses = repository.filter_licenses(metadata.bildungsloginProductId, SCHOOL, license_types)
+        if not licenses:
+            continue
+        non_ignored_licenses = [license for license in licenses if not license.bildungsloginIgnoredForDisplay]
+        result[metadata.bildungsloginProductId] = (
+            len(non_ignored_licenses),
+            sum(license.quantity for license in non_ignored_licenses),
+            sum(license.quantity_assigned for license in non_ignored_licenses),
+            sum(license.quantity_expired for license in non_ignored_licenses if license.is_expired),
+            sum(license.quantity_available for license in non_ignored_licenses if not license.is_expired),
+            sum(1 for license in non_ignored_licenses if license.quantity_assigned > 0),
+            sum(1 for license in non_ignored_licenses if license.is_expired),
+            sum(1 for license in non_ignored_licenses if license.is_available),
+            max(license.bildungsloginDeliveryDate for license in licenses),
+        )
+    return result
+
+
+def aggregate_in_one_pass(repository, license_types):
+    return dict(
+        (product_id, (
+            aggregate.licenses, aggregate.quantity, aggregate.assigned, aggregate.expired, aggregate.available,
+            aggregate.licenses_assigned, aggregate.licenses_expired, aggregate.licenses_available,
+            aggregate.latest_delivery_date))
+        for product_id, aggregate in repository.aggregate_products(SCHOOL, license_types).items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=100000, help='Number of licenses of the school.')
+    args = parser.parse_args()
+
+    builder = imp.load_source('bildungslogin_build_ucs_school_api_cache', BUILDER)
+    cache = import_repository_module()
+    directory = tempfile.mkdtemp()
+    try:
+        builder.JSON_DIR = cache.JSON_DIR = directory + '/'
+        builder.write_school_cache_file(SCHOOL, create_partition(args.size))
+        repository = cache.LdapRepository()
+        repository.update(SCHOOL)
+
+        print('{:>20} {:>10} {:>14} {:>14}'.format('license types', 'products', 'per product s', 'one pass s'))
+        for license_types in (None, ['SINGLE', 'VOLUME']):
+            start = time.time()
+            expected = aggregate_per_product(repository, license_types)
+            per_product = time.time() - start
+            start = time.time()
+            aggregates = aggregate_in_one_pass(repository, license_types)
+            one_pass = time.time() - start
+            if aggregates != expected:
+                sys.exit('The aggregates differ for the license types {}'.format(license_types))
+            print('{:>20} {:>10} {:>14.3f} {:>14.3f}'.format(
+                ','.join(license_types or ['all']), len(aggregates), per_product, one_pass))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -29,21 +29,54 @@
 #
 """Create a cache file for UCS@School API.
 
-The script fetches objects from LDAP as found using the 'SEARCH_FILTER', transforms the returned
-entries via 'transform_to_dictionary' and writes the result as a JSON string to JSON_PATH (or the
-cache file given on the command-line).
+The script fetches objects from LDAP with the searches returned by 'get_searches', transforms the
+returned entries via 'transform_to_dictionary' and writes the result as a JSON string to JSON_PATH (or
+the cache file given on the command-line). The searches run in parallel on '--ldap-connections'
+connections and every search only fetches the attributes of its object class.
 
 Note that you can use '-' as an argument to '--cache-file' to get the result to stdout.
 
+With '--incremental' the script remembers the contextCSN of the LDAP base (or the latest
+modifyTimestamp it has seen) in a state file. The next run only fetches the objects changed since
+then, removes the objects which are gone and rewrites the cache files of the affected schools. A
+full rebuild is done if the state file is missing or the delta is bigger than '--max-delta'.
+Deleted objects are found by listing the entryUUIDs of all objects of the searches, so every
+incremental run still pages through the whole tree once, though only with one attribute per object.
+
+LDAP objects are fetched in pages of '--page-size' objects (RFC 2696 Simple Paged Results) and
+converted page by page, so the raw LDAP result is never held in memory as a whole.
+
+Every cache file is written to a temporary file, synced to disk and renamed, so readers never see a
+missing or partial file. The renames happen under the exclusive lock of the cache file's lock file
+and increment the counter in its generation file: readers take the lock shared and without blocking,
+and reload when the generation changes. Only one instance of the script runs at a time, a second
+one waits for the build lock.
+
+The UMC module appends the licenses it changes to the journal of the school (cache.journal). When
+the cache file of a school is replaced, the records appended before the LDAP objects were fetched
+are dropped from the journal, the later ones are kept.
+
 We extensively use doctests in this script as a replacement to unittests. You can run the tests via
 'python -m doctest SCRIPTNAME'.
 """
 import argparse
+import collections
+import contextlib
+import errno
+import fcntl
 import json
 import logging
+import multiprocessing
 import os
 import re
-
+import resource
+import struct
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from ldap.controls import SimplePagedResultsControl
+from ldap.filter import escape_filter_chars
 from univention.management.console.config import ucr
 
 logger = logging.getLogger(__name__)
@@ -51,6 +84,16 @@ entry_dn_pattern = re.compile(".*dc=.*")
 
 JSON_PATH = '/var/lib/univention-appcenter/apps/ucsschool-apis/data/bildungslogin.json'
 JSON_DIR = '/var/lib/univention-appcenter/apps/ucsschool-apis/data/'
+STATE_PATH = JSON_DIR + 'cache_state.json'
+STATE_VERSION = 1
+PROGRESS_FILE = 'cache_progress.json'
+BUILD_LOCK_FILE = 'cache_build.lock'
+
+# see the cache_format modules of the UMC module and the plugin for the readers and the layouts
+BINARY_MAGIC = b'BLCACHE1'
+BINARY_MISSING = 0xFFFFFFFF
+BINARY_MISSING_INT = -2 ** 63
+DICTIONARY_ENCODING = 'dictionary'
 
 PARSER = argparse.ArgumentParser('Create a cache file for the UCS@School API')
 PARSER.add_argument(
@@ -73,34 +116,104 @@ PARSER.add_argument(
         "School name used to create the folder in which the cache file will be saved."
     ),
 )
+PARSER.add_argument(
+    '--incremental',
+    action='store_true',
+    help=(
+        'Only fetch the objects changed since the last run and update the cache files of the '
+        'affected schools. Deleted objects are detected by listing the entryUUIDs of all objects, '
+        'which still reads the whole tree on every run. Ignored together with --school.'
+    ),
+)
+PARSER.add_argument(
+    '--state-file',
+    metavar='FILE',
+    default=STATE_PATH,
+    help='The path to the state file of incremental runs. (Default: %(default)s)',
+)
+PARSER.add_argument(
+    '--max-delta',
+    metavar='RATIO',
+    type=float,
+    default=0.2,
+    help=(
+        'Do a full rebuild if more than this share of the cached objects changed since the last '
+        'run. (Default: %(default)s)'
+    ),
+)
 
-SCHOOL = PARSER.parse_args().school
-
-if SCHOOL:
-    SEARCH_FILTER = ''.join([
-        '(|',
-        '(&(uid=*)(ucsschoolSchool=' + SCHOOL + ')',
-        '(!(shadowExpire=1))' if ucr.get('bildungslogin/use-deactivated-users') != 'true' else '',
-        ')',
-        '(objectClass=bildungsloginAssignment)',
-        '(&(objectClass=bildungsloginLicense)(bildungsloginLicenseSchool=' + SCHOOL + '))',
-        '(objectClass=bildungsloginMetaData)',
-        '(&(objectClass=ucsschoolOrganizationalUnit)(ou=' + SCHOOL + '))',
-        '(&(objectClass=ucsschoolGroup)(ucsschoolRole=*' + SCHOOL + '*))',
-        ')',
-    ])
-else:
-    SEARCH_FILTER = ''.join([
-        '(|',
-        '(&(uid=*)(ucsschoolSchool=*)',
-        '(!(shadowExpire=1))' if ucr.get('bildungslogin/use-deactivated-users') != 'true' else '',
-        ')',
-        '(objectClass=bildungsloginAssignment)',
-        '(objectClass=bildungsloginLicense)',
-        '(objectClass=bildungsloginMetaData)',
-        '(objectClass=ucsschoolOrganizationalUnit)(objectClass=ucsschoolGroup)',
-        ')',
-    ])
+PARSER.add_argument(
+    '--page-size',
+    metavar='SIZE',
+    type=int,
+    default=1000,
+    help='Number of LDAP objects fetched per page, 0 disables paging. (Default: %(default)s)',
+)
+
+PARSER.add_argument(
+    '--ldap-connections',
+    metavar='NUMBER',
+    type=int,
+    default=4,
+    help='Number of LDAP connections used to run the searches in parallel. (Default: %(default)s)',
+)
+
+PARSER.add_argument(
+    '--dictionary-encoding',
+    action='store_true',
+    help=(
+        'Write the cache files with a shared string table instead of repeating the strings in '
+        'every object.'
+    ),
+)
+PARSER.add_argument(
+    '--workers',
+    metavar='NUMBER',
+    type=int,
+    default=min(4, multiprocessing.cpu_count()),
+    help='Number of processes writing the cache files of the schools. (Default: %(default)s)',
+)
+
+BASE_ATTRIBUTES = ['entryUUID', 'objectClass', 'modifyTimestamp']
+USER_ATTRIBUTES = BASE_ATTRIBUTES + ['uid', 'givenName', 'sn', 'ucsschoolSchool', 'ucsschoolRole']
+LICENSE_ATTRIBUTES = BASE_ATTRIBUTES + [
+    'bildungsloginLicenseCode',
+    'bildungsloginLicenseSpecialType',
+    'bildungsloginProductId',
+    'bildungsloginLicenseType',
+    'bildungsloginLicenseSchool',
+    'bildungsloginIgnoredForDisplay',
+    'bildungsloginDeliveryDate',
+    'bildungsloginLicenseQuantity',
+    'bildungsloginValidityStartDate',
+    'bildungsloginValidityEndDate',
+    'bildungsloginValidityDuration',
+    'bildungsloginUtilizationSystems',
+    'bildungsloginPurchasingReference',
+    'bildungsloginLicenseProvider',
+    'bildungsloginUsageStatus',
+    'bildungsloginExpiryDate',
+    'bildungsloginValidityStatus',
+]
+ASSIGNMENT_ATTRIBUTES = BASE_ATTRIBUTES + [
+    'bildungsloginAssignmentAssignee',
+    'bildungsloginAssignmentStatus',
+    'bildungsloginAssignmentTimeOfAssignment',
+]
+SCHOOL_ATTRIBUTES = BASE_ATTRIBUTES + ['ou']
+GROUP_ATTRIBUTES = BASE_ATTRIBUTES + ['cn', 'ucsschoolRole', 'memberUid']
+METADATA_ATTRIBUTES = BASE_ATTRIBUTES + [
+    'bildungsloginProductId',
+    'bildungsloginMetaDataTitle',
+    'bildungsloginMetaDataPublisher',
+    'bildungsloginMetaDataCover',
+    'bildungsloginMetaDataCoverSmall',
+    'bildungsloginMetaDataDescription',
+    'bildungsloginMetaDataAuthor',
+]
+
+# license values computed by expand_licenses(), not stored in the state file
+DERIVED_LICENSE_ATTRIBUTES = ('groups', 'user_ids', 'quantity_assigned', 'volume_quantity')
 
 
 def add_attribute_to_dictionary(dict_entry, obj, key):
@@ -357,7 +470,231 @@ def transform_to_dictionary(entries):
     >>> result == expected
     True
     """
-    processed_list = {
+    processed_list = convert_entries(entries)
+    expand_licenses(processed_list)
+    return processed_list
+
+
+def convert_entries(entries, processed_list=None):
+    """Convert the given LDAP objects to dictionaries, without computing the license assignees.
+
+    The converted objects are appended to processed_list if given, so the results of several
+    searches can be collected.
+    """
+    if processed_list is None:
+        processed_list = new_processed_list()
+
+    logger.debug("Starting converting ldap objects to json compatible dictionary.")
+
+    for (entry_dn, dict_entry) in entries:
+        for object_class, converter in CONVERTERS:
+            if object_class in dict_entry['objectClass']:
+                converter(entry_dn, dict_entry, processed_list)
+                break
+    logger.debug("Finished converting ldap objects to json compatible dictionary.")
+    return processed_list
+
+
+def new_object(entry_dn, dict_entry):
+    obj = {
+        'entryUUID': str(dict_entry['entryUUID'][0]),
+        'entry_dn': str(entry_dn),
+        'objectClass': [str(_class) for _class in dict_entry['objectClass']],
+    }
+
+    if not entry_dn_pattern.match(obj['entry_dn']):
+        logger.warning("Corrupted DN by object %r with entry dn: %r", dict_entry['entryUUID'], entry_dn)
+    return obj
+
+
+def convert_user(entry_dn, dict_entry, processed_list):
+    if 'ucsschoolRole' not in dict_entry:
+        logger.warning('Ignored user %s.', dict_entry['uid'][0])
+        return
+
+    obj = new_object(entry_dn, dict_entry)
+    obj.update({
+        'uid': str(dict_entry['uid'][0]),
+        'givenName': "" if 'givenName' not in dict_entry else str(dict_entry['givenName'][0]),
+        'sn': str(dict_entry['sn'][0]),
+        'ucsschoolSchool': [str(school) for school in dict_entry['ucsschoolSchool']],
+        'ucsschoolRole': [str(role) for role in dict_entry['ucsschoolRole']]
+    })
+    processed_list['users'].append(obj)
+
+
+def convert_license(entry_dn, dict_entry, processed_list):
+    obj = new_object(entry_dn, dict_entry)
+    obj.update({
+        'bildungsloginLicenseCode': str(dict_entry['bildungsloginLicenseCode'][0]),
+        'bildungsloginProductId': str(dict_entry['bildungsloginProductId'][0]),
+        'bildungsloginLicenseType': str(dict_entry['bildungsloginLicenseType'][0]),
+        'bildungsloginLicenseSchool': str(dict_entry['bildungsloginLicenseSchool'][0]),
+        'bildungsloginIgnoredForDisplay': str(dict_entry['bildungsloginIgnoredForDisplay'][0]),
+        'bildungsloginLicenseQuantity': str(dict_entry['bildungsloginLicenseQuantity'][0]),
+        'bildungsloginDeliveryDate': str(dict_entry['bildungsloginDeliveryDate'][0]),
+        'bildungsloginLicenseProvider': str(dict_entry['bildungsloginLicenseProvider'][0]),
+        'bildungsloginValidityDuration': '',
+        'bildungsloginUtilizationSystems': '',
+        'bildungsloginLicenseSpecialType': '',
+        'bildungsloginUsageStatus': '',
+        'bildungsloginExpiryDate': '',
+        'bildungsloginValidityStatus': '',
+        'groups': [],
+        'user_ids': [],
+        'quantity_assigned': 0,
+    })
+
+    add_attribute_to_dictionary(dict_entry, obj, 'bildungsloginValidityDuration')
+    add_attribute_to_dictionary(dict_entry, obj, 'bildungsloginUtilizationSystems')
+    add_attribute_to_dictionary(dict_entry, obj, 'bildungsloginValidityStartDate')
+    add_attribute_to_dictionary(dict_entry, obj, 'bildungsloginValidityEndDate')
+    add_attribute_to_dictionary(dict_entry, obj, 'bildungsloginLicenseSpecialType')
+
+    add_attribute_to_dictionary(dict_entry, obj, 'bildungsloginUsageStatus')
+    add_attribute_to_dictionary(dict_entry, obj, 'bildungsloginExpiryDate')
+    add_attribute_to_dictionary(dict_entry, obj, 'bildungsloginValidityStatus')
+    add_attribute_to_dictionary(dict_entry, obj, 'bildungsloginPurchasingReference')
+
+    processed_list['licenses'].append(obj)
+
+
+def convert_assignment(entry_dn, dict_entry, processed_list):
+    obj = new_object(entry_dn, dict_entry)
+    obj.update({
+        'bildungsloginAssignmentStatus':
+            str(dict_entry['bildungsloginAssignmentStatus'][0]),
+        'bildungsloginAssignmentTimeOfAssignment': ''
+    })
+
+    if 'bildungsloginAssignmentTimeOfAssignment' in dict_entry:
+        obj['bildungsloginAssignmentTimeOfAssignment'] = str(
+            dict_entry['bildungsloginAssignmentTimeOfAssignment'][0])
+
+    if 'bildungsloginAssignmentAssignee' in dict_entry:
+        obj.update({
+            'bildungsloginAssignmentAssignee':
+                str(dict_entry['bildungsloginAssignmentAssignee'][0]),
+        })
+
+    processed_list['assignments'].append(obj)
+
+
+def convert_school(entry_dn, dict_entry, processed_list):
+    obj = new_object(entry_dn, dict_entry)
+    obj.update({'ou': str(dict_entry['ou'][0])})
+
+    processed_list['schools'].append(obj)
+
+
+def convert_group(entry_dn, dict_entry, processed_list):
+    obj = new_object(entry_dn, dict_entry)
+    obj.update({
+        'cn': str(dict_entry['cn'][0]),
+        'ucsschoolRole': str(dict_entry['ucsschoolRole'][0]),
+        'memberUid': [str(member) for member in dict_entry.get('memberUid', [])],
+    })
+
+    if 'workgroup' in dict_entry['ucsschoolRole'][0]:
+        processed_list['workgroups'].append(obj)
+    elif 'school_class' in dict_entry['ucsschoolRole'][0]:
+        processed_list['classes'].append(obj)
+
+
+def convert_metadata(entry_dn, dict_entry, processed_list):
+    obj = new_object(entry_dn, dict_entry)
+    obj.update({
+        'bildungsloginProductId': str(dict_entry['bildungsloginProductId'][0]),
+        'bildungsloginMetaDataTitle': str(dict_entry['bildungsloginMetaDataTitle'][0]),
+        'bildungsloginMetaDataPublisher': str(dict_entry['bildungsloginMetaDataPublisher'][0]),
+        'bildungsloginMetaDataCoverSmall': '',
+        'bildungsloginMetaDataCover': '',
+        'bildungsloginMetaDataDescription': '',
+        'bildungsloginMetaDataAuthor': ''
+    })
+
+    if 'bildungsloginMetaDataDescription' in dict_entry:
+        obj['bildungsloginMetaDataDescription'] = str(
+            dict_entry['bildungsloginMetaDataDescription'][0])
+
+    if 'bildungsloginMetaDataAuthor' in dict_entry:
+        obj['bildungsloginMetaDataAuthor'] = str(
+            dict_entry['bildungsloginMetaDataAuthor'][0])
+
+    if 'bildungsloginMetaDataCoverSmall' in dict_entry:
+        obj['bildungsloginMetaDataCoverSmall'] = str(
+            dict_entry['bildungsloginMetaDataCoverSmall'][0])
+
+    if 'bildungsloginMetaDataCover' in dict_entry:
+        obj['bildungsloginMetaDataCover'] = str(
+            dict_entry['bildungsloginMetaDataCover'][0])
+
+    processed_list['metadata'].append(obj)
+
+
+# checked in this order, as the first matching objectClass decides about the converter
+CONVERTERS = (
+    ('person', convert_user),
+    ('bildungsloginLicense', convert_license),
+    ('bildungsloginAssignment', convert_assignment),
+    ('ucsschoolOrganizationalUnit', convert_school),
+    ('ucsschoolGroup', convert_group),
+    ('bildungsloginMetaData', convert_metadata),
+)
+
+
+def get_searches(school=None):
+    """Return the LDAP searches for the objects of the cache, limited to the given school.
+
+    Every search is a tuple of the LDAP filter, the attributes to fetch and the function converting
+    a found object into the processed_list.
+
+    >>> [search_filter for search_filter, attributes, converter in get_searches('a')]
+    ... # doctest: +NORMALIZE_WHITESPACE
+    ['(&(objectClass=person)(uid=*)(ucsschoolSchool=a)(!(shadowExpire=1)))',
+     '(&(objectClass=bildungsloginLicense)(bildungsloginLicenseSchool=a))',
+     '(objectClass=bildungsloginAssignment)',
+     '(&(objectClass=ucsschoolOrganizationalUnit)(ou=a))',
+     '(&(objectClass=ucsschoolGroup)(ucsschoolRole=*a*))',
+     '(objectClass=bildungsloginMetaData)']
+    """
+    school = escape_filter_chars(school) if school else None
+    return [
+        (
+            ''.join([
+                '(&(objectClass=person)(uid=*)',
+                '(ucsschoolSchool=' + (school or '*') + ')',
+                '(!(shadowExpire=1))' if ucr.get('bildungslogin/use-deactivated-users') != 'true' else '',
+                ')',
+            ]),
+            USER_ATTRIBUTES,
+            convert_user,
+        ),
+        (
+            '(&(objectClass=bildungsloginLicense)(bildungsloginLicenseSchool=' + school + '))'
+            if school else '(objectClass=bildungsloginLicense)',
+            LICENSE_ATTRIBUTES,
+            convert_license,
+        ),
+        ('(objectClass=bildungsloginAssignment)', ASSIGNMENT_ATTRIBUTES, convert_assignment),
+        (
+            '(&(objectClass=ucsschoolOrganizationalUnit)(ou=' + school + '))'
+            if school else '(objectClass=ucsschoolOrganizationalUnit)',
+            SCHOOL_ATTRIBUTES,
+            convert_school,
+        ),
+        (
+            '(&(objectClass=ucsschoolGroup)(ucsschoolRole=*' + school + '*))'
+            if school else '(objectClass=ucsschoolGroup)',
+            GROUP_ATTRIBUTES,
+            convert_group,
+        ),
+        ('(objectClass=bildungsloginMetaData)', METADATA_ATTRIBUTES, convert_metadata),
+    ]
+
+
+def new_processed_list():
+    return {
         'users': [],
         'licenses': [],
         'assignments': [],
@@ -367,154 +704,128 @@ def transform_to_dictionary(entries):
         'metadata': [],
     }
 
-    logger.debug("Starting converting ldap objects to json compatible dictionary.")
 
-    for (entry_dn, dict_entry) in entries:
-        obj = {
-            'entryUUID': str(dict_entry['entryUUID'][0]),
-            'entry_dn': str(entry_dn),
-            'objectClass': [str(_class) for _class in dict_entry['objectClass']],
-        }
-
-        if not entry_dn_pattern.match(obj['entry_dn']):
-            logger.warning("Corrupted DN by object %r with entry dn: %r", dict_entry['entryUUID'], entry_dn)
-
-        if 'person' in dict_entry['objectClass']:
-            if 'ucsschoolRole' not in dict_entry:
-                logger.warning('Ignored user %s.', dict_entry['uid'][0])
-                continue
-
-            obj.update({
-                'uid': str(dict_entry['uid'][0]),
-                'givenName': "" if 'givenName' not in dict_entry else str(dict_entry['givenName'][0]),
-                'sn': str(dict_entry['sn'][0]),
-                'ucsschoolSchool': [str(school) for school in dict_entry['ucsschoolSchool']],
-                'ucsschoolRole': [str(role) for role in dict_entry['ucsschoolRole']]
-            })
-            processed_list['users'].append(obj)
-
-        elif 'bildungsloginLicense' in dict_entry['objectClass']:
-            obj.update({
-                'bildungsloginLicenseCode': str(dict_entry['bildungsloginLicenseCode'][0]),
-                'bildungsloginProductId': str(dict_entry['bildungsloginProductId'][0]),
-                'bildungsloginLicenseType': str(dict_entry['bildungsloginLicenseType'][0]),
-                'bildungsloginLicenseSchool': str(dict_entry['bildungsloginLicenseSchool'][0]),
-                'bildungsloginIgnoredForDisplay': str(dict_entry['bildungsloginIgnoredForDisplay'][0]),
-                'bildungsloginLicenseQuantity': str(dict_entry['bildungsloginLicenseQuantity'][0]),
-                'bildungsloginDeliveryDate': str(dict_entry['bildungsloginDeliveryDate'][0]),
-                'bildungsloginLicenseProvider': str(dict_entry['bildungsloginLicenseProvider'][0]),
-                'bildungsloginValidityDuration': '',
-                'bildungsloginUtilizationSystems': '',
-                'bildungsloginLicenseSpecialType': '',
-                'bildungsloginUsageStatus': '',
-                'bildungsloginExpiryDate': '',
-                'bildungsloginValidityStatus': '',
-                'groups': [],
-                'user_strings': [],
-                'quantity_assigned': 0,
-            })
-
-            add_attribute_to_dictionary(dict_entry, obj, 'bildungsloginValidityDuration')
-            add_attribute_to_dictionary(dict_entry, obj, 'bildungsloginUtilizationSystems')
-            add_attribute_to_dictionary(dict_entry, obj, 'bildungsloginValidityStartDate')
-            add_attribute_to_dictionary(dict_entry, obj, 'bildungsloginValidityEndDate')
-            add_attribute_to_dictionary(dict_entry, obj, 'bildungsloginLicenseSpecialType')
-
-            add_attribute_to_dictionary(dict_entry, obj, 'bildungsloginUsageStatus')
-            add_attribute_to_dictionary(dict_entry, obj, 'bildungsloginExpiryDate')
-            add_attribute_to_dictionary(dict_entry, obj, 'bildungsloginValidityStatus')
-            add_attribute_to_dictionary(dict_entry, obj, 'bildungsloginPurchasingReference')
-
-            processed_list['licenses'].append(obj)
-        elif 'bildungsloginAssignment' in dict_entry['objectClass']:
-            obj.update({
-                'bildungsloginAssignmentStatus':
-                    str(dict_entry['bildungsloginAssignmentStatus'][0]),
-                'bildungsloginAssignmentTimeOfAssignment': ''
-            })
-
-            if 'bildungsloginAssignmentTimeOfAssignment' in dict_entry:
-                obj['bildungsloginAssignmentTimeOfAssignment'] = str(
-                    dict_entry['bildungsloginAssignmentTimeOfAssignment'][0])
-
-            if 'bildungsloginAssignmentAssignee' in dict_entry:
-                obj.update({
-                    'bildungsloginAssignmentAssignee':
-                        str(dict_entry['bildungsloginAssignmentAssignee'][0]),
-                })
-
-            processed_list['assignments'].append(obj)
-        elif 'ucsschoolOrganizationalUnit' in dict_entry['objectClass']:
-
-            obj.update({'ou': str(dict_entry['ou'][0])})
-
-            processed_list['schools'].append(obj)
-        elif 'ucsschoolGroup' in dict_entry['objectClass']:
-
-            obj.update({
-                'cn': str(dict_entry['cn'][0]),
-                'ucsschoolRole': str(dict_entry['ucsschoolRole'][0]),
-                'memberUid': [str(member) for member in dict_entry.get('memberUid', [])],
-            })
-
-            if 'workgroup' in dict_entry['ucsschoolRole'][0]:
-                processed_list['workgroups'].append(obj)
-            elif 'school_class' in dict_entry['ucsschoolRole'][0]:
-                processed_list['classes'].append(obj)
-        elif 'bildungsloginMetaData' in dict_entry['objectClass']:
-            obj.update({
-                'bildungsloginProductId': str(dict_entry['bildungsloginProductId'][0]),
-                'bildungsloginMetaDataTitle': str(dict_entry['bildungsloginMetaDataTitle'][0]),
-                'bildungsloginMetaDataPublisher': str(dict_entry['bildungsloginMetaDataPublisher'][0]),
-                'bildungsloginMetaDataCoverSmall': '',
-                'bildungsloginMetaDataCover': '',
-                'bildungsloginMetaDataDescription': '',
-                'bildungsloginMetaDataAuthor': ''
-            })
-
-            if 'bildungsloginMetaDataDescription' in dict_entry:
-                obj['bildungsloginMetaDataDescription'] = str(
-                    dict_entry['bildungsloginMetaDataDescription'][0])
-
-            if 'bildungsloginMetaDataAuthor' in dict_entry:
-                obj['bildungsloginMetaDataAuthor'] = str(
-                    dict_entry['bildungsloginMetaDataAuthor'][0])
-
-            if 'bildungsloginMetaDataCoverSmall' in dict_entry:
-                obj['bildungsloginMetaDataCoverSmall'] = str(
-                    dict_entry['bildungsloginMetaDataCoverSmall'][0])
-
-            if 'bildungsloginMetaDataCover' in dict_entry:
-                obj['bildungsloginMetaDataCover'] = str(
-                    dict_entry['bildungsloginMetaDataCover'][0])
-
-            processed_list['metadata'].append(obj)
-    logger.debug("Finished converting ldap objects to json compatible dictionary.")
+class CacheIndex(object):
+    """The lookup tables of one builder run.
+
+    They are built once from the converted dictionary and passed through the whole pipeline, so
+    every lookup is a dictionary access. The hits and misses of the lookups are counted and logged
+    together with the build time by log_statistics().
+
+    >>> index = CacheIndex({
+    ...   'users': [{'entryUUID': 'u1', 'uid': 'a', 'ucsschoolSchool': ['s1']}],
+    ...   'assignments': [{'entry_dn': 'cn=x,cn=l'}],
+    ...   'schools': [{'entryUUID': 's1', 'ou': 's1'}],
+    ...   'workgroups': [{'entryUUID': 'g1', 'ucsschoolRole': 'workgroup:school:s1'}],
+    ... })
+    >>> index.get_user_by_uuid('u1')['uid'], index.get_user_by_uid('b')
+    ('a', None)
+    >>> len(index.get_assignments('cn=l')), sorted(index.get_school_entities('s1'))
+    (1, ['classes', 'schools', 'users', 'workgroups'])
+    >>> sorted(index.hits.items()), sorted(index.misses.items())
+    ([('assignments', 1), ('school_entities', 1), ('user_by_uuid', 1)], [('user_by_uid', 1)])
+    """
+
+    def __init__(self, dictionary):
+        start = time.time()
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self.assignments_by_license_dn = {}
+        self.users_by_uuid = {}
+        self.users_by_uid = {}
+        self.groups_by_uuid = {}
+        self.schools_by_uuid = {}
+        self.entities_by_school = {}
+
+        for assignment in dictionary.get('assignments', []):
+            license_dn = assignment['entry_dn'].split(',', 1)[1]
+            self.assignments_by_license_dn.setdefault(license_dn, []).append(assignment)
+        for user in dictionary.get('users', []):
+            self.users_by_uuid[user['entryUUID']] = user
+            self.users_by_uid[user['uid']] = user
+            for school in user['ucsschoolSchool']:
+                self._school_entities(school)['users'].append(user)
+        for school in dictionary.get('schools', []):
+            self.schools_by_uuid[school['entryUUID']] = school
+            self._school_entities(school['ou'])['schools'].append(school)
+        for category in ('workgroups', 'classes'):
+            for group in dictionary.get(category, []):
+                self.groups_by_uuid[group['entryUUID']] = group
+                if group.get('ucsschoolRole'):
+                    self._school_entities(group['ucsschoolRole'].split(':')[-1])[category].append(group)
+        self.build_time = time.time() - start
+
+    def _school_entities(self, school):
+        if school not in self.entities_by_school:
+            self.entities_by_school[school] = {'users': [], 'schools': [], 'workgroups': [], 'classes': []}
+        return self.entities_by_school[school]
+
+    def _lookup(self, name, mapping, key, default=None):
+        if key in mapping:
+            self.hits[name] += 1
+            return mapping[key]
+        self.misses[name] += 1
+        return default
+
+    def get_assignments(self, license_dn):
+        return self._lookup('assignments', self.assignments_by_license_dn, license_dn, [])
+
+    def get_user_by_uuid(self, uuid):
+        return self._lookup('user_by_uuid', self.users_by_uuid, uuid)
+
+    def get_user_by_uid(self, uid):
+        return self._lookup('user_by_uid', self.users_by_uid, uid)
+
+    def get_group_by_uuid(self, uuid):
+        return self._lookup('group_by_uuid', self.groups_by_uuid, uuid)
+
+    def get_school_by_uuid(self, uuid):
+        return self._lookup('school_by_uuid', self.schools_by_uuid, uuid)
+
+    def get_school_entities(self, school):
+        """Return the users, schools, workgroups and classes of the school."""
+        return self._lookup('school_entities', self.entities_by_school, school, {
+            'users': [], 'schools': [], 'workgroups': [], 'classes': []})
+
+    def log_statistics(self):
+        logger.debug('Built the lookup tables in %.3f seconds.', self.build_time)
+        for name in sorted(set(self.hits) | set(self.misses)):
+            logger.debug('Lookups of %s: %d hits, %d misses', name, self.hits[name], self.misses[name])
+
+
+def expand_licenses(processed_list, index=None):
+    """Compute the assigned users, groups and quantities of the licenses in processed_list.
+
+    The values derived by a previous call are reset first, so this can be run again after objects
+    of processed_list were replaced by an incremental update. The lookup tables are built from
+    processed_list if no index is given.
+    """
+    if index is None:
+        index = CacheIndex(processed_list)
 
-    _assignments_map = get_assignment_map(processed_list['assignments'])
+    for _license in processed_list['licenses']:
+        _license.update({
+            'groups': [],
+            'user_ids': [],
+            'quantity_assigned': 0,
+        })
+        _license.pop('volume_quantity', None)
 
     processed_list['licenses'].sort(key=lambda license: license['bildungsloginDeliveryDate'], reverse=True)
     licenses = processed_list['licenses']
-    users = processed_list['users']
-    groups = processed_list['classes'] + processed_list['workgroups']
-    schools = processed_list['schools']
-
-    _users_uid_map = get_users_uid_map(users)
-    _users_uuid_map = get_users_uuid_map(users)
 
     processed_licenses = 0
 
     for _license in licenses:
-        if _license['entry_dn'] in _assignments_map:
-            assignments = _assignments_map[_license['entry_dn']]
-
+        assignments = index.get_assignments(_license['entry_dn'])
+        if assignments:
             if _license['bildungsloginLicenseType'] == 'VOLUME':
                 _license['volume_quantity'] = len(assignments)
 
             for assignment in assignments:
                 if assignment['bildungsloginAssignmentStatus'] != 'AVAILABLE':
                     if _license['bildungsloginLicenseType'] in ['SINGLE', 'VOLUME']:
-                        user = _users_uuid_map.get(assignment['bildungsloginAssignmentAssignee'])
+                        user = index.get_user_by_uuid(assignment['bildungsloginAssignmentAssignee'])
                         if user:
                             add_user_to_license(_license, user)
                         else:
@@ -522,77 +833,25 @@ def transform_to_dictionary(entries):
                             logger.debug("Didn't found user for uuid: " + assignment['bildungsloginAssignmentAssignee'])
 
                     elif _license['bildungsloginLicenseType'] == 'WORKGROUP':
-                        for group in groups:
-                            if group['entryUUID'] == assignment['bildungsloginAssignmentAssignee']:
-                                for uid in group['memberUid']:
-                                    user = _users_uid_map.get(uid)
-                                    if user:
-                                        add_user_to_license(_license, user)
-                                        _license['groups'].append(group['entry_dn'])
+                        group = index.get_group_by_uuid(assignment.get('bildungsloginAssignmentAssignee'))
+                        if group:
+                            for uid in group['memberUid']:
+                                user = index.get_user_by_uid(uid)
+                                if user:
+                                    add_user_to_license(_license, user)
+                                    _license['groups'].append(group['entry_dn'])
 
                     elif _license['bildungsloginLicenseType'] == 'SCHOOL':
-                        for school in schools:
-                            if school['entryUUID'] == assignment['bildungsloginAssignmentAssignee']:
-                                for user in users:
-                                    if school['ou'] in user['ucsschoolSchool']:
-                                        add_user_to_license(_license, user)
+                        school = index.get_school_by_uuid(assignment.get('bildungsloginAssignmentAssignee'))
+                        if school:
+                            for user in index.get_school_entities(school['ou'])['users']:
+                                add_user_to_license(_license, user)
                     else:
                         raise RuntimeError("Unknown license type: {}".format(_license['bildungsloginLicenseType']))
         processed_licenses += 1
         if not processed_licenses % 1000:
             logger.debug('Processed ' + str(processed_licenses))
 
-    return processed_list
-
-
-assignments_map = {}
-
-
-def get_assignment_map(assignments):
-    if len(assignments_map) > 0:
-        logger.debug("Using already existing lookup up dictionary for license to assignment.")
-        return assignments_map
-    else:
-        logger.debug("Starting generating lookup up dictionary for license to assignment.")
-        for assignment in assignments:
-            license_dn = assignment['entry_dn'].split(',', 1)[1]
-            if license_dn in assignments_map:
-                assignments_map[license_dn].append(assignment)
-            else:
-                assignments_map.update({license_dn: [assignment]})
-        logger.debug("Finished generating lookup up dictionary for license to assignment.")
-    return assignments_map
-
-
-users_uuid_map = {}
-
-
-def get_users_uuid_map(users):
-    if len(users_uuid_map) > 0:
-        logger.debug("Using already existing lookup up dictionary for assignment to user.")
-        return users_uuid_map
-    else:
-        logger.debug("Starting generating lookup up dictionary for assignment to user.")
-        for user in users:
-            users_uuid_map.update({user['entryUUID']: user})
-
-    return users_uuid_map
-
-
-users_uid_map = {}
-
-
-def get_users_uid_map(users):
-    if len(users_uid_map) > 0:
-        logger.debug("Using already existing lookup up dictionary for group to user.")
-        return users_uid_map
-    else:
-        logger.debug("Starting generating lookup up dictionary for group to user.")
-        for user in users:
-            users_uid_map.update({user['uid']: user})
-
-    return users_uid_map
-
 
 def add_user_to_license(_license, user):
     roles = []
@@ -602,92 +861,137 @@ def add_user_to_license(_license, user):
     if _license['bildungsloginLicenseSpecialType'] != 'Lehrkraft' or (
             _license['bildungsloginLicenseSpecialType'] == 'Lehrkraft' and 'teacher' in roles):
         _license['quantity_assigned'] += 1
-        _license['user_strings'].append(user['givenName'])
-        _license['user_strings'].append(user['sn'])
-        _license['user_strings'].append(user['uid'])
+        _license['user_ids'].append(user['uid'])
 
 
-def get_products_from_licenses(dictionary):
-    metadata = []
+def partition_by_school(dictionary, schools=None, index=None):
+    """Split the dictionary into the contents of the cache files of the schools in one pass.
 
-    for _metadata in dictionary.get('metadata', []):
-        if any(_metadata.get('bildungsloginProductId') == license.get('bildungsloginProductId') for license in
-               dictionary.get('licenses', [])):
-            metadata.append(_metadata)
+    Only the schools found in the dictionary (and in schools, if given) get a partition. The
+    metadata of a partition is limited to the products of its licenses. The lookup tables are built
+    from the dictionary if no index is given.
 
-    return metadata
+    >>> partitions = partition_by_school({
+    ...   'users': [{'entryUUID': 'u1', 'uid': 'a', 'ucsschoolSchool': ['s1', 's2']}],
+    ...   'schools': [{'entryUUID': 's1', 'ou': 's1'}, {'entryUUID': 's2', 'ou': 's2'}],
+    ...   'licenses': [{'entry_dn': 'cn=l,cn=licenses', 'bildungsloginLicenseSchool': 's1',
+    ...                 'bildungsloginProductId': 'p', 'bildungsloginLicenseCode': 'l'}],
+    ...   'assignments': [{'entry_dn': 'cn=x,cn=l,cn=licenses'}],
+    ...   'workgroups': [{'entryUUID': 'g1', 'ucsschoolRole': 'workgroup:school:s2'}],
+    ...   'classes': [],
+    ...   'metadata': [{'bildungsloginProductId': 'p'}, {'bildungsloginProductId': 'q'}],
+    ... })
+    >>> sorted((school, sorted((key, len(objs)) for key, objs in partition.items() if objs))
+    ...        for school, partition in partitions.items())  # doctest: +NORMALIZE_WHITESPACE
+    [('s1', [('assignments', 1), ('licenses', 1), ('metadata', 1), ('schools', 1), ('users', 1)]),
+     ('s2', [('schools', 1), ('users', 1), ('workgroups', 1)])]
+    """
+    if index is None:
+        index = CacheIndex(dictionary)
 
+    partitions = {}
+    for _school in dictionary.get('schools', []):
+        if schools is None or _school['ou'] in schools:
+            partition = new_processed_list()
+            partition.update(index.get_school_entities(_school['ou']))
+            partitions[_school['ou']] = partition
 
-def filter_dictionary_by_school(dictionary, school):
-    logger.debug("Starting filtering objects for school: " + school)
-    processed_list = {
-        'users': [],
-        'schools': [],
-        'assignments': [],
-        'licenses': [],
-        'workgroups': [],
-        'classes': [],
-        'metadata': dictionary.get('metadata', []),
-    }
+    partition_by_license_dn = {}
+    for _license in dictionary.get('licenses', []):
+        partition = partitions.get(_license['bildungsloginLicenseSchool'])
+        if partition is not None:
+            partition['licenses'].append(_license)
+            partition_by_license_dn[_license['entry_dn']] = partition
 
-    for _user in dictionary.get('users', []):
-        if school in _user.get('ucsschoolSchool'):
-            processed_list['users'].append(_user)
+    for license_dn, partition in partition_by_license_dn.items():
+        partition['assignments'].extend(index.get_assignments(license_dn))
 
-    for _school in dictionary.get('schools', []):
-        if school == _school.get('ou'):
-            processed_list['schools'].append(_school)
+    metadata_by_product_id = {}
+    for _metadata in dictionary.get('metadata', []):
+        metadata_by_product_id.setdefault(_metadata.get('bildungsloginProductId'), []).append(_metadata)
+    for partition in partitions.values():
+        product_ids = set()
+        for _license in partition['licenses']:
+            if _license['entry_dn'] not in index.assignments_by_license_dn:
+                logger.warning(
+                    'License can not be assigned anymore and is not used: ' + _license['bildungsloginLicenseCode'])
+            if _license['bildungsloginProductId'] not in product_ids:
+                product_ids.add(_license['bildungsloginProductId'])
+                partition['metadata'].extend(metadata_by_product_id.get(_license['bildungsloginProductId'], []))
+    return partitions
 
-    for _assignment in dictionary.get('assignments', []):
-        processed_list['assignments'].append(_assignment)
 
-    for _license in dictionary.get('licenses', []):
-        if school == _license.get('bildungsloginLicenseSchool'):
-            processed_list['licenses'].append(_license)
-
-    for _workgroup in dictionary.get('workgroups', []):
-        if _workgroup.get('ucsschoolRole'):
-            if school == _workgroup.get('ucsschoolRole').split(':')[-1]:
-                processed_list['workgroups'].append(_workgroup)
-
-    for _class in dictionary.get('classes', []):
-        if _class.get('ucsschoolRole'):
-            if school == _class.get('ucsschoolRole').split(':')[-1]:
-                processed_list['classes'].append(_class)
-    logger.debug("Finished filtering objects for school: " + school)
-    return processed_list
+def get_school_cache_path(school):
+    return JSON_DIR + 'schools/' + school + '/cache.json'
 
 
-def store_school_cache_file(dictionary, school):
-    if any(s.get('ou') == school for s in dictionary.get('schools', [])):
-        tmp_school_folder = JSON_DIR + 'schools/' + school
-        tmp_school_filepath = tmp_school_folder + '/cache.json'
-        tmp_school_dict = dictionary
-        tmp_school_dict['metadata'] = get_products_from_licenses(dictionary)
+def write_school_cache_file(school, partition, dictionary_encoding=False, journal_offset=0):
+    school_folder = JSON_DIR + 'schools/' + school
+    school_filepath = get_school_cache_path(school)
 
-        assignments_map = get_assignment_map(tmp_school_dict['assignments'])
+    if not os.path.isdir(school_folder):
+        os.makedirs(school_folder)
 
-        tmp_school_dict['assignments'] = []
-        for license in tmp_school_dict['licenses']:
-            if license['entry_dn'] in assignments_map:
-                tmp_school_dict['assignments'] += assignments_map[license['entry_dn']]
-            else:
-                tmp_school_dict['assignments'] = []
-                logger.warning('License can not be assigned anymore and is not used: ' + license['bildungsloginLicenseCode'])
+    write_cache_file(school_filepath, partition, dictionary_encoding, journal_offset)
+
+
+def store_school_cache_file(dictionary, school, index=None, dictionary_encoding=False, journal_offsets=None):
+    partition = partition_by_school(dictionary, [school], index).get(school)
+    if partition is not None:
+        write_school_cache_file(school, partition, dictionary_encoding, (journal_offsets or {}).get(school, 0))
 
-        if not os.path.isdir(tmp_school_folder):
-            os.makedirs(tmp_school_folder)
 
-        if os.path.isfile(tmp_school_filepath):
-            os.unlink(tmp_school_filepath)
+# the partitions written by the worker processes of store_school_cache_files(), inherited on fork
+_partitions = {}
 
-        tmp_school_file = open(tmp_school_filepath, 'w')
-        json.dump(tmp_school_dict, tmp_school_file)
-        tmp_school_file.close()
-        del tmp_school_folder, tmp_school_dict, tmp_school_filepath, tmp_school_file
 
+def _write_partition(args):
+    school, dictionary_encoding, journal_offset = args
+    write_school_cache_file(school, _partitions[school], dictionary_encoding, journal_offset)
+    return school
 
-def store_api_cache(filtered_dict, cache_file):
+
+def store_school_cache_files(partitions, workers, dictionary_encoding=False, journal_offsets=None):
+    """Write the cache files of the partitions with up to `workers` processes.
+
+    The progress is written to the progress file after each school, so the UMC module can show it.
+    """
+    global _partitions
+    progress = {
+        'started': time.time(),
+        'finished': None,
+        'schools_total': len(partitions),
+        'schools_done': 0,
+    }
+    write_progress(progress)
+    journal_offsets = journal_offsets or {}
+    schools = [(school, dictionary_encoding, journal_offsets.get(school, 0)) for school in sorted(partitions)]
+    _partitions = partitions
+    pool = None
+    if workers <= 1 or len(schools) <= 1:
+        written = (_write_partition(args) for args in schools)
+    else:
+        pool = multiprocessing.Pool(min(workers, len(schools)))
+        written = pool.imap_unordered(_write_partition, schools)
+    try:
+        for school in written:
+            progress['schools_done'] += 1
+            write_progress(progress)
+            logger.debug("Finished cache write for school: " + school)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _partitions = {}
+    progress['finished'] = time.time()
+    write_progress(progress)
+
+
+def write_progress(progress):
+    write_file_atomically(JSON_DIR + PROGRESS_FILE, lambda f: json.dump(progress, f))
+
+
+def store_api_cache(filtered_dict, cache_file, dictionary_encoding=False):
     needed_attributes = ['entryUUID',
                          'objectClass',
                          'entry_dn',
@@ -704,120 +1008,829 @@ def store_api_cache(filtered_dict, cache_file):
                          'bildungsloginAssignmentAssignee',
                          'bildungsloginAssignmentStatus']
     logger.debug("Starting filtering objects for api.")
-    for index, license in enumerate(filtered_dict['licenses']):
-        license = {key: value for key, value in license.iteritems() if key in needed_attributes}
-        filtered_dict['licenses'][index] = license
+    api_dict = dict((key, value) for key, value in filtered_dict.items() if key != 'metadata')
+    api_dict['licenses'] = [
+        {key: value for key, value in license.items() if key in needed_attributes}
+        for license in filtered_dict['licenses']
+    ]
     logger.debug("Finished filtering objects for api.")
-    del filtered_dict['metadata']
 
-    tmp_filepath = cache_file + '~'
-    tmp_file = open(tmp_filepath, 'w')
-    json.dump(filtered_dict, tmp_file)
-    tmp_file.close()
+    write_cache_file(cache_file, api_dict, dictionary_encoding)
+
+
+def get_binary_path(json_path):
+    return os.path.splitext(json_path)[0] + '.bin'
+
+
+def get_lock_path(json_path):
+    return os.path.splitext(json_path)[0] + '.lock'
+
+
+def get_generation_path(json_path):
+    return os.path.splitext(json_path)[0] + '.generation'
+
+
+@contextlib.contextmanager
+def file_lock(path, operation=fcntl.LOCK_EX):
+    """Hold the advisory lock on the lock file at path (created if needed) while the block runs."""
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def build_lock():
+    """Hold the build lock, so that only one instance of the script writes the cache files."""
+    with open(JSON_DIR + BUILD_LOCK_FILE, 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as exc:
+            if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            logger.info('Waiting for the running cache build to finish.')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_temp_path(path):
+    """Return a hidden temporary path next to path, which doesn't match the patterns of the readers."""
+    directory, filename = os.path.split(path)
+    return os.path.join(directory, '.{}.{}~'.format(filename, os.getpid()))
+
+
+def write_temp_file(path, write, mode='w'):
+    """Call write() with a temporary file next to path, sync it to disk and return its path."""
+    tmp_filepath = get_temp_path(path)
+    try:
+        with open(tmp_filepath, mode) as tmp_file:
+            write(tmp_file)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+    except BaseException:
+        if os.path.isfile(tmp_filepath):
+            os.unlink(tmp_filepath)
+        raise
+    return tmp_filepath
+
+
+def replace_files(replacements):
+    """Rename the (temporary path, path) pairs in order, then sync the directories to disk."""
+    for tmp_filepath, path in replacements:
+        os.rename(tmp_filepath, path)
+    for directory in set(os.path.dirname(path) for _, path in replacements):
+        directory_fd = os.open(directory or '.', os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+
+def write_file_atomically(path, write, mode='w'):
+    replace_files([(write_temp_file(path, write, mode), path)])
+
+
+def read_generation(json_path):
+    """Return the generation of the cache file at json_path, 0 if it was never written.
+
+    >>> import tempfile
+    >>> json_path = os.path.join(tempfile.mkdtemp(), 'cache.json')
+    >>> read_generation(json_path)
+    0
+    >>> write_cache_file(json_path, {'users': []})
+    1
+    >>> write_cache_file(json_path, {'users': []})
+    2
+    >>> read_generation(json_path)
+    2
+    """
+    try:
+        with open(get_generation_path(json_path)) as f:
+            return int(f.read())
+    except (IOError, ValueError):
+        return 0
+
 
-    if os.path.isfile(cache_file):
-        os.unlink(cache_file)
-    os.rename(tmp_filepath, cache_file)
+def get_journal_path(json_path):
+    return os.path.splitext(json_path)[0] + '.journal'
 
 
-def main(cache_file, school):
-    """Start the main routine of the script.
+def get_journal_end(data):
+    """Return the end of the last complete record in the journal data.
 
-    Fetch the LDAP objects, transform and filter them as needed and write the JSON objects to the
-    given cache_file.
+    >>> record = struct.pack('<I', 2) + b'{}'
+    >>> get_journal_end(record * 2), get_journal_end(record * 2 + struct.pack('<I', 2) + b'{')
+    (12, 12)
     """
-    import univention.admin.uldap as uldap
-    ldap_access, ldap_position = uldap.getAdminConnection()
+    uint = struct.Struct('<I')
+    position = 0
+    while position + uint.size <= len(data):
+        end = position + uint.size + uint.unpack_from(data, position)[0]
+        if end > len(data):
+            break
+        position = end
+    return position
 
-    logger.info('Start searching objects in LDAP')
-    response = ldap_access.search(
-        filter=SEARCH_FILTER,
-        scope='sub',
-        attr=[
-            'entryUUID',
-            'objectClass',
-            'uid',
-            'givenName',
-            'ou',
-            'cn',
-            'ucsschoolRole',
-            'sn',
-            'ucsschoolSchool',
-            'bildungsloginLicenseCode',
-            'bildungsloginLicenseSpecialType',
-            'memberUid',
-            'bildungsloginAssignmentAssignee',
-            'bildungsloginAssignmentStatus',
-            'bildungsloginProductId',
-            'bildungsloginMetaDataTitle',
-            'bildungsloginMetaDataPublisher',
-            'bildungsloginMetaDataCover',
-            'bildungsloginMetaDataCoverSmall',
-            'bildungsloginMetaDataDescription',
-            'bildungsloginMetaDataAuthor',
-            'bildungsloginLicenseType',
-            'bildungsloginLicenseSchool',
-            'bildungsloginIgnoredForDisplay',
-            'bildungsloginDeliveryDate',
-            'bildungsloginLicenseQuantity',
-            'bildungsloginValidityStartDate',
-            'bildungsloginValidityEndDate',
-            'bildungsloginValidityDuration',
-            'bildungsloginUtilizationSystems',
-            'bildungsloginPurchasingReference',
-            'bildungsloginAssignmentTimeOfAssignment',
-            'bildungsloginLicenseProvider',
-            'bildungsloginUsageStatus',
-            'bildungsloginExpiryDate',
-            'bildungsloginValidityStatus'
-        ],
-    )
-    logger.debug('Found {} objects'.format(len(response)))
 
-    dictionary = transform_to_dictionary(response)
-    logger.debug('After filtering and transformation {} objects remaining'.format(
-        sum(len(objs) for objs in dictionary.values())))
+def read_journal_data(json_path, offset=0):
+    try:
+        with open(get_journal_path(json_path), 'rb') as f:
+            f.seek(offset)
+            return f.read()
+    except IOError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+        return b''
 
-    logger.debug("Convert to JSON and write to cache file")
 
-    if school:
-        store_school_cache_file(dictionary, school)
-        for (dirpath, dirnames, filenames) in os.walk(JSON_DIR + 'schools/' + school + '/'):
-            for filename in filenames:
-                regex = re.compile('license-.*json')
-                if regex.match(filename):
-                    os.unlink(dirpath + filename)
-            break
+def get_journal_offsets(school=None):
+    """Return the end of the journal of every school (or only of school) with a journal.
 
+    The records up to there were appended by the UMC module before the LDAP objects are fetched, so
+    the changes they record are part of the fetched objects.
+    """
+    if school:
+        schools = [school]
+    elif os.path.isdir(JSON_DIR + 'schools'):
+        schools = os.listdir(JSON_DIR + 'schools')
     else:
-        for _school in dictionary.get('schools', []):
-            store_school_cache_file(
-                filter_dictionary_by_school(dictionary, _school.get('ou')),
-                _school.get('ou')
-            )
-            logger.debug("Finished cache write for school: " + _school.get('ou'))
-            for (dirpath, dirnames, filenames) in os.walk(JSON_DIR + 'schools/' + _school.get('ou') + '/'):
-                for filename in filenames:
-                    regex = re.compile('license-.*json')
-                    if regex.match(filename):
-                        os.unlink(dirpath + filename)
-                break
+        schools = []
+    offsets = {}
+    for name in schools:
+        data = read_journal_data(get_school_cache_path(name))
+        if data:
+            offsets[name] = get_journal_end(data)
+    return offsets
+
+
+def compact_journal(json_path, offset):
+    """Write the records of the journal of the cache file at json_path after offset to a temporary file.
+
+    Return its path or None if there are no such records. Incomplete records are dropped.
+
+    >>> import tempfile
+    >>> json_path = os.path.join(tempfile.mkdtemp(), 'cache.json')
+    >>> compact_journal(json_path, 0) is None
+    True
+    >>> with open(get_journal_path(json_path), 'wb') as f:
+    ...     _ = f.write(struct.pack('<I', 2) + b'{}' + struct.pack('<I', 3) + b'[1]' + struct.pack('<I', 2) + b'{')
+    >>> with open(compact_journal(json_path, 6), 'rb') as f:
+    ...     f.read() == struct.pack('<I', 3) + b'[1]'
+    True
+    >>> compact_journal(json_path, 13) is None
+    True
+    """
+    data = read_journal_data(json_path, offset)
+    data = data[:get_journal_end(data)]
+    if not data:
+        return None
+    return write_temp_file(get_journal_path(json_path), lambda f: f.write(data), 'wb')
+
+
+def write_cache_file(json_path, dictionary, dictionary_encoding=False, journal_offset=None):
+    """Write the cache file at json_path with its binary sidecar and return its new generation.
+
+    Both files are written to temporary files first. They are renamed under the exclusive lock, which
+    also covers incrementing the generation. If a journal_offset is given, the cache file is a school
+    cache file: the records of its journal before the offset are dropped (see get_journal_offsets())
+    and the license-*.json files of older versions of the UMC module are removed.
+    """
+    data = encode_dictionary(dictionary) if dictionary_encoding else dictionary
+    tmp_filepath = write_temp_file(json_path, lambda f: json.dump(data, f))
+    binary_path = get_binary_path(json_path)
+    binary_tmp_filepath = write_binary_cache(dictionary, json_path)
+    with file_lock(get_lock_path(json_path)):
+        replacements = [(tmp_filepath, json_path)]
+        if binary_tmp_filepath:
+            replacements.append((binary_tmp_filepath, binary_path))
+        elif os.path.isfile(binary_path):
+            os.unlink(binary_path)
+        if journal_offset is not None:
+            journal_path = get_journal_path(json_path)
+            journal_tmp_filepath = compact_journal(json_path, journal_offset)
+            if journal_tmp_filepath:
+                replacements.append((journal_tmp_filepath, journal_path))
+            elif os.path.isfile(journal_path):
+                os.unlink(journal_path)
+        generation = read_generation(json_path) + 1
+        generation_path = get_generation_path(json_path)
+        generation_tmp_filepath = write_temp_file(generation_path, lambda f: f.write(str(generation)))
+        replacements.append((generation_tmp_filepath, generation_path))
+        replace_files(replacements)
+        if journal_offset is not None:
+            remove_license_files(os.path.dirname(json_path) + '/')
+    return generation
+
+
+def get_field_types(objs):
+    """Return the sorted names and the types of the fields of the objects for the encoded formats.
+
+    >>> get_field_types([{'uid': 'a', 'ucsschoolSchool': ['s']}, {'quantity_assigned': 1}])
+    [['quantity_assigned', 'i'], ['ucsschoolSchool', 'l'], ['uid', 's']]
+    """
+    kinds = {}
+    for obj in objs:
+        for name, value in obj.items():
+            if isinstance(value, list):
+                kind = 'l'
+            elif isinstance(value, (bool, int)):
+                kind = 'i'
+            elif isinstance(value, (str, type(u''))):
+                kind = 's'
+            else:
+                raise ValueError('Unsupported value {!r} of field {}'.format(value, name))
+            if kinds.setdefault(name, kind) != kind:
+                raise ValueError('Field {} has values of different types'.format(name))
+    return [[name, kinds[name]] for name in sorted(kinds)]
+
+
+def encode_dictionary(dictionary):
+    """Return the dictionary in the dictionary encoded JSON layout.
+
+    Every distinct string is stored once in a string table, the objects become rows of string
+    numbers (lists of string numbers, integers) in the order of the fields of their section.
+
+    >>> encoded = encode_dictionary({'users': [{'uid': 'a', 'ucsschoolSchool': ['s']}, {'uid': 'a'}]})
+    >>> encoded['strings'], encoded['sections']['users']
+    (['s', 'a'], {'fields': [['ucsschoolSchool', 'l'], ['uid', 's']], 'rows': [[[0], 1], [None, 1]]})
+    """
+    strings = {}
+
+    def get_number(value):
+        number = strings.get(value)
+        if number is None:
+            number = strings[value] = len(strings)
+        return number
+
+    sections = {}
+    for name, objs in dictionary.items():
+        fields = get_field_types(objs)
+        rows = []
+        for obj in objs:
+            row = []
+            for field, kind in fields:
+                if field not in obj:
+                    row.append(None)
+                elif kind == 's':
+                    row.append(get_number(obj[field]))
+                elif kind == 'l':
+                    row.append([get_number(value) for value in obj[field]])
+                else:
+                    row.append(obj[field])
+            rows.append(row)
+        sections[name] = {'fields': fields, 'rows': rows}
+    return {
+        'encoding': DICTIONARY_ENCODING,
+        'strings': [value for value, number in sorted(strings.items(), key=lambda item: item[1])],
+        'sections': sections,
+    }
 
-        store_api_cache(dictionary, cache_file)
-        logger.debug("Finished cache write for api.")
 
-    for (dirpath, dirnames, filenames) in os.walk(JSON_DIR):
+def _to_bytes(value):
+    return value if isinstance(value, bytes) else value.encode('utf-8')
+
+
+def encode_binary_cache(dictionary):
+    """Return the dictionary in the binary cache format.
+
+    All strings are stored once in a string table and referenced by their number, so repeated DNs,
+    UUIDs and roles only cost four bytes per use.
+
+    >>> data = encode_binary_cache({'users': [{'uid': 'a'}, {'uid': 'a'}]})
+    >>> data[:8] == BINARY_MAGIC, data.count(b'a')
+    (True, 1)
+    """
+    strings = {}
+    uint = struct.Struct('<I')
+    int64 = struct.Struct('<q')
+
+    def get_number(value):
+        number = strings.get(value)
+        if number is None:
+            number = strings[value] = len(strings)
+        return number
+
+    sections = {}
+    section_data = []
+    offset = 0
+    for name in sorted(dictionary):
+        fields = get_field_types(dictionary[name])
+        records = []
+        for obj in dictionary[name]:
+            parts = []
+            for field, kind in fields:
+                if kind == 's':
+                    parts.append(uint.pack(get_number(obj[field]) if field in obj else BINARY_MISSING))
+                elif kind == 'l':
+                    if field in obj:
+                        numbers = [get_number(value) for value in obj[field]]
+                        parts.append(struct.pack('<{}I'.format(len(numbers) + 1), len(numbers), *numbers))
+                    else:
+                        parts.append(uint.pack(BINARY_MISSING))
+                else:
+                    parts.append(int64.pack(int(obj[field]) if field in obj else BINARY_MISSING_INT))
+            record = b''.join(parts)
+            records.append(uint.pack(len(record)))
+            records.append(record)
+        data = b''.join(records)
+        sections[name] = {'offset': offset, 'count': len(dictionary[name]), 'fields': fields}
+        section_data.append(data)
+        offset += len(data)
+
+    string_values = [_to_bytes(value) for value, number in sorted(strings.items(), key=lambda item: item[1])]
+    string_ends = []
+    end = 0
+    for value in string_values:
+        end += len(value)
+        string_ends.append(end)
+    string_table = struct.pack('<{}I'.format(len(string_ends)), *string_ends) + b''.join(string_values)
+    for section in sections.values():
+        section['offset'] += len(string_table)
+
+    header = _to_bytes(json.dumps({'strings': [0, len(string_values)], 'sections': sections}))
+    return b''.join([BINARY_MAGIC, uint.pack(len(header)), header, string_table] + section_data)
+
+
+def write_binary_cache(dictionary, json_path):
+    """Write the binary sidecar of the cache file at json_path to a temporary file and return its path.
+
+    It has to be written after the JSON file: the readers only use it if it is not older than the
+    JSON file. If it can't be written, None is returned and the old sidecar has to be removed, so that
+    the readers use the JSON file.
+    """
+    binary_path = get_binary_path(json_path)
+    try:
+        data = encode_binary_cache(dictionary)
+        return write_temp_file(binary_path, lambda f: f.write(data), 'wb')
+    except (ValueError, struct.error, EnvironmentError) as exc:
+        logger.warning('Could not write the binary cache file %s: %s', binary_path, exc)
+        return None
+
+
+def remove_license_files(directory):
+    """Remove the license-*.json files older versions of the UMC module wrote for single license changes."""
+    regex = re.compile('license-.*json')
+    for (dirpath, dirnames, filenames) in os.walk(directory):
         for filename in filenames:
-            regex = re.compile('license-.*json')
             if regex.match(filename):
                 os.unlink(dirpath + filename)
         break
 
-    logger.info("Finished")
+
+def search_pages(ldap_access, search_filter, attributes, page_size=1000):
+    """Search LDAP and yield the found objects one page at a time.
+
+    A page is only referenced until the next one is requested, so the caller should convert and drop
+    the raw LDAP objects before continuing the iteration.
+    """
+    logger.info('Start searching objects in LDAP')
+    if not page_size:
+        response = ldap_access.search(filter=search_filter, scope='sub', attr=attributes)
+        logger.debug('Found {} objects'.format(len(response)))
+        yield response
+        return
+
+    page_control = SimplePagedResultsControl(True, size=page_size, cookie='')
+    count = 0
+    while True:
+        response = {}
+        page = ldap_access.search(
+            filter=search_filter,
+            scope='sub',
+            attr=attributes,
+            serverctrls=[page_control],
+            response=response,
+        )
+        count += len(page)
+        yield page
+        del page
+
+        cookies = [
+            control.cookie for control in response.get('ctrls', [])
+            if control.controlType == SimplePagedResultsControl.controlType
+        ]
+        if not cookies or not cookies[0]:
+            break
+        page_control.cookie = cookies[0]
+    logger.debug('Found {} objects'.format(count))
+
+
+_thread_data = threading.local()
+
+
+def get_ldap_access():
+    """Return the LDAP connection of the current thread, it is opened on first use."""
+    if not hasattr(_thread_data, 'ldap_access'):
+        import univention.admin.uldap as uldap
+        _thread_data.ldap_access, _ = uldap.getAdminConnection()
+    return _thread_data.ldap_access
+
+
+def run_parallel(function, arguments, connections):
+    """Call function with each of the argument tuples in up to `connections` threads.
+
+    Every thread uses its own LDAP connection (see get_ldap_access). The results are returned in
+    the order of the arguments.
+    """
+    if connections <= 1 or len(arguments) <= 1:
+        return [function(*args) for args in arguments]
+    pool = ThreadPool(min(connections, len(arguments)))
+    try:
+        return pool.map(lambda args: function(*args), arguments)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_search(search, page_size, modified_since=None, with_uuids=False):
+    """Fetch and convert the LDAP objects of one search page by page.
+
+    Returns the converted objects, the latest modifyTimestamp of the found objects and the
+    entryUUIDs of all found objects (also those not converted) if with_uuids is set.
+    """
+    search_filter, attributes, converter = search
+    if modified_since:
+        search_filter = '(&(modifyTimestamp>={}){})'.format(modified_since, search_filter)
+    processed_list = new_processed_list()
+    latest_timestamp = None
+    uuids = set()
+    for page in search_pages(get_ldap_access(), search_filter, attributes, page_size):
+        timestamp = get_latest_timestamp(page)
+        if timestamp and (latest_timestamp is None or timestamp > latest_timestamp):
+            latest_timestamp = timestamp
+        for (entry_dn, dict_entry) in page:
+            if with_uuids:
+                uuids.add(str(dict_entry['entryUUID'][0]))
+            converter(entry_dn, dict_entry, processed_list)
+    return processed_list, latest_timestamp, uuids
+
+
+def list_uuids(search, page_size):
+    """Return the entryUUIDs of all objects found by the search."""
+    search_filter, attributes, converter = search
+    uuids = set()
+    for page in search_pages(get_ldap_access(), search_filter, ['entryUUID'], page_size):
+        uuids.update(str(dict_entry['entryUUID'][0]) for (entry_dn, dict_entry) in page)
+    return uuids
+
+
+def fetch_dictionary(searches, page_size, connections, modified_since=None, with_uuids=False):
+    """Run the searches in parallel and collect their converted objects in one dictionary.
+
+    Returns the converted (not yet expanded) dictionary, the latest modifyTimestamp of the objects
+    and the entryUUIDs of the found objects (only if with_uuids is set).
+    """
+    processed_list = new_processed_list()
+    latest_timestamp = None
+    uuids = set()
+    results = run_parallel(
+        run_search,
+        [(search, page_size, modified_since, with_uuids) for search in searches],
+        connections,
+    )
+    for result, timestamp, found_uuids in results:
+        for category, objs in result.items():
+            processed_list[category].extend(objs)
+        if timestamp and (latest_timestamp is None or timestamp > latest_timestamp):
+            latest_timestamp = timestamp
+        uuids.update(found_uuids)
+    return processed_list, latest_timestamp, uuids
+
+
+def get_peak_memory():
+    """Return the peak resident memory of the process in MiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def get_latest_timestamp(entries):
+    """Return the latest modifyTimestamp of the given LDAP objects.
+
+    >>> get_latest_timestamp([
+    ...   ('foo', {'modifyTimestamp': ['20221010080000Z']}),
+    ...   ('bar', {}),
+    ...   ('baz', {'modifyTimestamp': ['20221011080000Z']}),
+    ... ])
+    '20221011080000Z'
+    >>> get_latest_timestamp([]) is None
+    True
+    """
+    timestamps = [
+        str(dict_entry['modifyTimestamp'][0]) for (entry_dn, dict_entry) in entries
+        if 'modifyTimestamp' in dict_entry
+    ]
+    return max(timestamps) if timestamps else None
+
+
+def get_context_csn(ldap_access):
+    """Return the contextCSN values of the LDAP base or an empty list if slapd doesn't keep one."""
+    response = ldap_access.search(base=ldap_access.base, scope='base', attr=['contextCSN'])
+    if not response:
+        return []
+    return sorted(str(csn) for csn in response[0][1].get('contextCSN', []))
+
+
+def get_high_water_mark(context_csn):
+    """Return the time of the latest write in LDAP as generalized time.
+
+    >>> get_high_water_mark([
+    ...   '20221010080000.123456Z#000000#000#000000',
+    ...   '20221011080000.123456Z#000000#001#000000',
+    ... ])
+    '20221011080000Z'
+    >>> get_high_water_mark([]) is None
+    True
+    """
+    if not context_csn:
+        return None
+    return max(csn[:14] for csn in context_csn) + 'Z'
+
+
+def _to_native_strings(value):
+    """Convert the unicode strings returned by json.load on Python 2 to the str used for LDAP values."""
+    if isinstance(value, dict):
+        return dict((_to_native_strings(key), _to_native_strings(val)) for key, val in value.items())
+    if isinstance(value, list):
+        return [_to_native_strings(val) for val in value]
+    if not isinstance(value, str) and isinstance(value, type(u'')):
+        return value.encode('utf-8')
+    return value
+
+
+def read_state(state_file):
+    """Return the state saved by the last incremental run or None if there is no usable one.
+
+    >>> import tempfile
+    >>> state_file = os.path.join(tempfile.mkdtemp(), 'state.json')
+    >>> read_state(state_file) is None
+    True
+    >>> with open(state_file, 'w') as f:
+    ...     _ = f.write('{"version": 1, "high_water')
+    >>> read_state(state_file) is None
+    True
+    >>> with open(state_file, 'w') as f:
+    ...     json.dump({'version': STATE_VERSION + 1, 'high_water_mark': '20221010080000Z', 'entries': {}}, f)
+    >>> read_state(state_file) is None
+    True
+    >>> write_state(state_file, {'licenses': [{'entryUUID': 'l1', 'groups': []}]}, [], '20221010080000Z')
+    >>> state = read_state(state_file)
+    >>> state['high_water_mark'], state['entries']
+    ('20221010080000Z', {'licenses': [{'entryUUID': 'l1'}]})
+    """
+    if not os.path.isfile(state_file):
+        logger.info('No state file found at %s, doing a full rebuild.', state_file)
+        return None
+    try:
+        with open(state_file, 'r') as f:
+            state = _to_native_strings(json.load(f))
+    except ValueError as exc:
+        logger.warning('Could not read the state file %s, doing a full rebuild: %s', state_file, exc)
+        return None
+    if state.get('version') != STATE_VERSION or not state.get('high_water_mark'):
+        logger.info('State file %s is not usable, doing a full rebuild.', state_file)
+        return None
+    return state
+
+
+def write_state(state_file, dictionary, context_csn, high_water_mark):
+    entries = dict(dictionary)
+    entries['licenses'] = [
+        {key: value for key, value in _license.items() if key not in DERIVED_LICENSE_ATTRIBUTES}
+        for _license in dictionary['licenses']
+    ]
+    state = {
+        'version': STATE_VERSION,
+        'context_csn': context_csn,
+        'high_water_mark': high_water_mark,
+        'entries': entries,
+    }
+    write_file_atomically(state_file, lambda f: json.dump(state, f))
+
+
+def get_object_schools(category, obj, licenses_by_dn):
+    """Return the names of the schools whose cache contains the object, None for all schools.
+
+    >>> get_object_schools('users', {'ucsschoolSchool': ['a', 'b']}, {})
+    ['a', 'b']
+    >>> get_object_schools('workgroups', {'ucsschoolRole': 'workgroup:school:a'}, {})
+    ['a']
+    >>> get_object_schools('assignments', {'entry_dn': 'cn=x,cn=l'},
+    ...                    {'cn=l': {'bildungsloginLicenseSchool': 'a'}})
+    ['a']
+    >>> get_object_schools('metadata', {}, {}) is None
+    True
+    """
+    if category == 'users':
+        return obj['ucsschoolSchool']
+    if category == 'licenses':
+        return [obj['bildungsloginLicenseSchool']]
+    if category == 'assignments':
+        _license = licenses_by_dn.get(obj['entry_dn'].split(',', 1)[1])
+        return [_license['bildungsloginLicenseSchool']] if _license else []
+    if category == 'schools':
+        return [obj['ou']]
+    if category in ('workgroups', 'classes'):
+        return [obj['ucsschoolRole'].split(':')[-1]]
+    return None
+
+
+def apply_ldap_changes(searches, state, max_delta, page_size, connections):
+    """Patch the objects saved by the last run with the changes made in LDAP since then.
+
+    Returns the patched (not yet expanded) dictionary, the names of the affected schools (None if
+    all schools are affected) and the latest modifyTimestamp of the changed objects (None if there
+    are none), or None if the delta is too big and a full rebuild should be done.
+
+    The deleted objects are found by comparing the known entryUUIDs with the entryUUIDs of all
+    objects currently found by the searches, so this lists the whole tree once.
+
+    The LDAP searches are replaced by stubs returning the changed objects and the current entryUUIDs:
+
+    >>> import sys
+    >>> module = sys.modules[apply_ldap_changes.__module__]
+    >>> original_functions = module.fetch_dictionary, module.list_uuids
+    >>> def stub_ldap(changed, current_uuids):
+    ...     def fetch_dictionary(searches, page_size, connections, modified_since=None, with_uuids=False):
+    ...         dictionary = new_processed_list()
+    ...         for category, obj in changed:
+    ...             dictionary[category].append(obj)
+    ...         uuids = set(obj['entryUUID'] for category, obj in changed)
+    ...         return dictionary, '20221011080000Z' if changed else None, uuids
+    ...     module.fetch_dictionary = fetch_dictionary
+    ...     module.list_uuids = lambda search, page_size: set(current_uuids)
+    >>> state = {'high_water_mark': '20221010080000Z', 'entries': {
+    ...     'users': [{'entryUUID': 'u1', 'uid': 'u1', 'ucsschoolSchool': ['A']},
+    ...               {'entryUUID': 'u2', 'uid': 'u2', 'ucsschoolSchool': ['A']}],
+    ...     'schools': [{'entryUUID': 'sA', 'ou': 'A'}, {'entryUUID': 'sB', 'ou': 'B'}],
+    ...     'metadata': [{'entryUUID': 'm1', 'bildungsloginProductId': 'p1'}],
+    ... }}
+    >>> all_uuids = ['u1', 'u2', 'sA', 'sB', 'm1']
+
+    A changed object replaces the known one:
+
+    >>> stub_ldap([('users', {'entryUUID': 'u1', 'uid': 'renamed', 'ucsschoolSchool': ['A']})], all_uuids)
+    >>> dictionary, schools, timestamp = apply_ldap_changes([None], state, 1, 1000, 1)
+    >>> sorted(obj['uid'] for obj in dictionary['users']), sorted(schools), timestamp
+    (['renamed', 'u2'], ['A'], '20221011080000Z')
+    >>> len(dictionary['schools']), len(dictionary['metadata'])
+    (2, 1)
+
+    A deleted object is removed:
+
+    >>> stub_ldap([], ['u1', 'sA', 'sB', 'm1'])
+    >>> dictionary, schools, timestamp = apply_ldap_changes([None], state, 1, 1000, 1)
+    >>> sorted(obj['uid'] for obj in dictionary['users']), sorted(schools), timestamp
+    (['u1'], ['A'], None)
+
+    A user moved to another school affects both schools:
+
+    >>> stub_ldap([('users', {'entryUUID': 'u1', 'uid': 'u1', 'ucsschoolSchool': ['B']})], all_uuids)
+    >>> dictionary, schools, timestamp = apply_ldap_changes([None], state, 1, 1000, 1)
+    >>> sorted(schools)
+    ['A', 'B']
+
+    Metadata is part of the cache files of all schools:
+
+    >>> stub_ldap([('metadata', {'entryUUID': 'm1', 'bildungsloginProductId': 'p1'})], all_uuids)
+    >>> dictionary, schools, timestamp = apply_ldap_changes([None], state, 1, 1000, 1)
+    >>> schools is None, timestamp
+    (True, '20221011080000Z')
+
+    Too many changes lead to a full rebuild:
+
+    >>> moved_user = {'entryUUID': 'u1', 'uid': 'u1', 'ucsschoolSchool': ['B']}
+    >>> stub_ldap([('users', moved_user)], ['u1', 'sA', 'sB', 'm1'])
+    >>> apply_ldap_changes([None], state, 0.2, 1000, 1) is None
+    True
+    >>> module.fetch_dictionary, module.list_uuids = original_functions
+    """
+    known = {}
+    for category, objs in state['entries'].items():
+        for obj in objs:
+            known[obj['entryUUID']] = (category, obj)
+
+    changed, latest_timestamp, changed_uuids = fetch_dictionary(
+        searches, page_size, connections, state['high_water_mark'], with_uuids=True)
+    current_uuids = set()
+    for uuids in run_parallel(list_uuids, [(search, page_size) for search in searches], connections):
+        current_uuids.update(uuids)
+    deleted_uuids = set(known) - current_uuids
+    logger.info('Found %d changed and %d deleted objects since %s.',
+                len(changed_uuids), len(deleted_uuids), state['high_water_mark'])
+
+    if len(changed_uuids) + len(deleted_uuids) > max_delta * len(known):
+        logger.info('Too many changes for an incremental update, doing a full rebuild.')
+        return None
+
+    # objects changed in a way that they are not converted anymore (e.g. a user without
+    # ucsschoolRole) are removed just like deleted ones
+    touched = [known.pop(uuid) for uuid in (changed_uuids | deleted_uuids) if uuid in known]
+    for category, objs in changed.items():
+        for obj in objs:
+            known[obj['entryUUID']] = (category, obj)
+            touched.append((category, obj))
+
+    dictionary = new_processed_list()
+    for category, obj in known.values():
+        dictionary[category].append(obj)
+
+    licenses_by_dn = dict(
+        (obj['entry_dn'], obj)
+        for category, obj in touched + [('licenses', _license) for _license in dictionary['licenses']]
+        if category == 'licenses'
+    )
+    schools = set()
+    for category, obj in touched:
+        object_schools = get_object_schools(category, obj, licenses_by_dn)
+        if object_schools is None:
+            return dictionary, None, latest_timestamp
+        schools.update(object_schools)
+    return dictionary, schools, latest_timestamp
+
+
+def main(cache_file, school, incremental=False, state_file=STATE_PATH, max_delta=0.2, page_size=1000,
+         connections=4, workers=1, dictionary_encoding=False):
+    """Start the main routine of the script.
+
+    Fetch the LDAP objects, transform and filter them as needed and write the JSON objects to the
+    given cache_file, holding the build lock.
+    """
+    with build_lock():
+        build_cache(cache_file, school, incremental, state_file, max_delta, page_size, connections, workers,
+                    dictionary_encoding)
+
+
+def build_cache(cache_file, school, incremental, state_file, max_delta, page_size, connections, workers,
+                dictionary_encoding):
+    searches = get_searches(school)
+
+    if school:
+        journal_offsets = get_journal_offsets(school)
+        dictionary, _, _ = fetch_dictionary(searches, page_size, connections)
+        index = CacheIndex(dictionary)
+        expand_licenses(dictionary, index)
+        logger.debug('After filtering and transformation {} objects remaining'.format(
+            sum(len(objs) for objs in dictionary.values())))
+        logger.debug('Peak memory usage after transformation: %.1f MiB', get_peak_memory())
+
+        logger.debug("Convert to JSON and write to cache file")
+        store_school_cache_file(dictionary, school, index, dictionary_encoding, journal_offsets)
+        index.log_statistics()
+
+    else:
+        journal_offsets = get_journal_offsets()
+        context_csn = get_context_csn(get_ldap_access())
+        high_water_mark = get_high_water_mark(context_csn)
+        state = read_state(state_file) if incremental else None
+        dictionary = None
+        schools = None
+
+        if state is not None:
+            if context_csn and context_csn == state['context_csn']:
+                logger.info("No changes in LDAP since the last run.")
+                return
+            result = apply_ldap_changes(searches, state, max_delta, page_size, connections)
+            if result is not None:
+                dictionary, schools, latest_timestamp = result
+                # without contextCSN the mark moves forward with the changes, otherwise every run
+                # would fetch all changes since the full build again
+                high_water_mark = high_water_mark or max(state['high_water_mark'], latest_timestamp or '')
+
+        if dictionary is None:
+            dictionary, latest_timestamp, _ = fetch_dictionary(searches, page_size, connections)
+            high_water_mark = high_water_mark or latest_timestamp
+
+        index = CacheIndex(dictionary)
+        expand_licenses(dictionary, index)
+
+        logger.debug('After filtering and transformation {} objects remaining'.format(
+            sum(len(objs) for objs in dictionary.values())))
+        logger.debug('Peak memory usage after transformation: %.1f MiB', get_peak_memory())
+
+        logger.debug("Convert to JSON and write to cache file")
+        store_school_cache_files(partition_by_school(dictionary, schools, index), workers, dictionary_encoding,
+                                 journal_offsets)
+        index.log_statistics()
+
+        if schools is None or schools:
+            store_api_cache(dictionary, cache_file, dictionary_encoding)
+            logger.debug("Finished cache write for api.")
+
+        if incremental:
+            write_state(state_file, dictionary, context_csn, high_water_mark)
+
+    remove_license_files(JSON_DIR)
+
+    logger.info("Finished, peak memory usage: %.1f MiB", get_peak_memory())
 
 
 if __name__ == '__main__':
     args = PARSER.parse_args()
     logging.basicConfig(level=args.log_level, format='%(levelname)s - %(message)s')
     logger.debug('Parsed arguments: {}'.format(args))
-    main(args.cache_file, args.school)
+    main(args.cache_file, args.school, args.incremental, args.state_file, args.max_delta, args.page_size,
+         args.ldap_connections, args.workers, args.dictionary_encoding)
@@ -3,7 +3,6 @@ from __future__ import annotations
 
 import asyncio
 import enum
-import json
 import logging
 import os
 from hashlib import sha256
@@ -15,6 +14,7 @@ from udm_rest_client.udm import UDM, UdmObject
 from ucsschool.apis.utils import LDAPAccess
 from bildungslogin_plugin.backend import UserNotFound
 from .backend import DbBackend
+from .cache_format import open_cache, read_generation, shared_lock
 from .models import AssignmentStatus, Class, SchoolContext, User, UserRole, Workgroup
 
 UCR_CONTAINER_CLASS = ("ucsschool_ldap_default_container_class", "klassen")
@@ -109,6 +109,7 @@ class LdapRepository:
     def __init__(self, ldap_auth: LDAPAccess):
         self._ldap_auth = ldap_auth
         self._timestamp: float | None = None
+        self._generation: int | None = None
         self._clear()
 
     def update(self, start_up=False):
@@ -118,18 +119,20 @@ class LdapRepository:
                 raise FileNotFoundError(f"JSON file not found at {JSON_PATH}. Please check if it is updating.")
             return
 
-        stat = os.stat(JSON_PATH)
-        file_time = stat.st_mtime
-
-        if self._timestamp is not None and file_time <= self._timestamp:
-            return
+        with shared_lock(JSON_PATH) as locked:
+            if not locked and self._generation is not None:
+                # the cache builder is replacing the files right now, keep the loaded snapshot
+                return
+            generation = read_generation(JSON_PATH)
+            file_time = os.stat(JSON_PATH).st_mtime
+            # without generation file (written by an older cache builder) only the mtime shows changes
+            if self._generation == generation and (generation or file_time <= self._timestamp):
+                return
+            load = open_cache(JSON_PATH)
 
         self._clear()
-        f = open(JSON_PATH, 'r')
-        json_string = f.read()
-        f.close()
-        json_dictionary = json.loads(json_string)
-        self._process_entries(json_dictionary)
+        self._process_entries(load())
+        self._generation = generation
         self._timestamp = file_time
 
     def count_objects(self):
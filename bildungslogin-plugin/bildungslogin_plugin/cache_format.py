@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Readers of the cache file formats written by bildungslogin_build_ucs_school_api_cache.py.
+
+The cache builder writes bildungslogin.json together with a binary sidecar (bildungslogin.bin) that
+is read without JSON parsing: the file is mapped into memory and the records are decoded one at a
+time while they are iterated. Every distinct string is decoded only once. The JSON file may be
+dictionary encoded, its records then share the strings of a single string table.
+
+See the cache_format module of the UMC module ucs-school-umc-licenses for a description of the
+layouts and the locking, both readers have to be kept in sync with the cache builder.
+"""
+from __future__ import annotations
+
+import contextlib
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+logger = logging.getLogger()
+
+MAGIC = b"BLCACHE1"
+DICTIONARY_ENCODING = "dictionary"
+MISSING = 0xFFFFFFFF
+MISSING_INT = -(2 ** 63)
+
+_UINT = struct.Struct("<I")
+_INT = struct.Struct("<q")
+
+
+class BinaryCacheError(Exception):
+    pass
+
+
+def get_binary_path(json_path: str) -> str:
+    return os.path.splitext(json_path)[0] + ".bin"
+
+
+def compile_fields(fields: List[Tuple[str, str]]) -> List[Tuple[str, List[Tuple[str, str]], Any]]:
+    """
+    Return the steps to decode a record with the given fields.
+
+    Consecutive fields of fixed size are decoded with a single struct, a list field needs a step of
+    its own.
+    """
+    steps = []
+    for name, kind in fields:
+        if kind == "l":
+            steps.append(("list", [(name, kind)]))
+        elif kind in ("s", "i"):
+            if not steps or steps[-1][0] != "fixed":
+                steps.append(("fixed", []))
+            steps[-1][1].append((name, kind))
+        else:
+            raise BinaryCacheError(f"Unknown field type {kind!r} of field {name!r}")
+    return [
+        (
+            step,
+            names,
+            struct.Struct("<" + "".join("I" if kind == "s" else "q" for _, kind in names))
+            if step == "fixed"
+            else None,
+        )
+        for step, names in steps
+    ]
+
+
+class BinaryCacheSection:
+    """The records of one section, decoded to dictionaries while iterating."""
+
+    def __init__(self, cache: BinaryCache, offset: int, count: int, fields: List[Tuple[str, str]]):
+        self._cache = cache
+        self._offset = offset
+        self._count = count
+        self._steps = compile_fields(fields)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        offset = self._offset
+        for _ in range(self._count):
+            (size,) = _UINT.unpack_from(self._cache.buffer, offset)
+            yield self._decode(offset + _UINT.size)
+            offset += _UINT.size + size
+
+    def _decode(self, offset: int) -> Dict[str, Any]:
+        buffer = self._cache.buffer
+        strings = self._cache.strings
+        get_string = self._cache.get_string
+        record = {}
+        for step, names, unpacker in self._steps:
+            if step == "fixed":
+                values = unpacker.unpack_from(buffer, offset)
+                offset += unpacker.size
+                for (name, kind), value in zip(names, values):
+                    if kind == "s":
+                        if value != MISSING:
+                            record[name] = strings[value] or get_string(value)
+                    elif value != MISSING_INT:
+                        record[name] = value
+            else:
+                (count,) = _UINT.unpack_from(buffer, offset)
+                offset += _UINT.size
+                if count != MISSING:
+                    numbers = struct.unpack_from(f"<{count}I", buffer, offset)
+                    offset += _UINT.size * count
+                    record[names[0][0]] = [strings[number] or get_string(number) for number in numbers]
+        return record
+
+
+class BinaryCache:
+    """A memory mapped binary cache file, used like the dictionary loaded from the JSON file."""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if self.buffer[: len(MAGIC)] != MAGIC:
+                raise BinaryCacheError(f"{path} is not a binary cache file")
+            (header_size,) = _UINT.unpack_from(self.buffer, len(MAGIC))
+            header_offset = len(MAGIC) + _UINT.size
+            header = json.loads(self.buffer[header_offset : header_offset + header_size].decode("utf-8"))
+            body_offset = header_offset + header_size
+            string_offset, string_count = header["strings"]
+            string_offset += body_offset
+            self._string_ends = struct.unpack_from(f"<{string_count}I", self.buffer, string_offset)
+            self._string_data = string_offset + _UINT.size * string_count
+            self.strings: List[Optional[str]] = [None] * string_count
+            self._sections = {
+                name: BinaryCacheSection(
+                    self, body_offset + section["offset"], section["count"], section["fields"]
+                )
+                for name, section in header["sections"].items()
+            }
+        except (KeyError, TypeError, ValueError, struct.error) as exc:
+            self.close()
+            raise BinaryCacheError(f"Invalid binary cache file {path}: {exc}") from exc
+
+    def get_string(self, number: int) -> str:
+        """Return the string with the given number, decoded on first use."""
+        string = self.strings[number]
+        if string is None:
+            start = self._string_ends[number - 1] if number else 0
+            end = self._string_ends[number]
+            string = self.strings[number] = self.buffer[
+                self._string_data + start : self._string_data + end
+            ].decode("utf-8")
+        return string
+
+    def __getitem__(self, name: str) -> Union[BinaryCacheSection, Tuple]:
+        return self._sections.get(name, ())
+
+    def get(self, name: str, default: Any = None) -> Any:
+        return self._sections.get(name, default)
+
+    def keys(self):
+        return self._sections.keys()
+
+    def close(self) -> None:
+        self.buffer.close()
+
+
+class DictionaryEncodedSection:
+    """The rows of one section of a dictionary encoded JSON file, decoded while iterating."""
+
+    def __init__(self, strings: List[str], fields: List[Tuple[str, str]], rows: List[List[Any]]):
+        self._strings = strings
+        self._fields = fields
+        self._rows = rows
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        strings = self._strings
+        fields = self._fields
+        for row in self._rows:
+            record = {}
+            for (name, kind), value in zip(fields, row):
+                if value is None:
+                    continue
+                if kind == "s":
+                    record[name] = strings[value]
+                elif kind == "l":
+                    record[name] = [strings[number] for number in value]
+                else:
+                    record[name] = value
+            yield record
+
+
+class DictionaryEncodedCache:
+    """The contents of a dictionary encoded JSON file, used like the dictionary of a plain one."""
+
+    def __init__(self, entries: Dict[str, Any]):
+        strings = entries["strings"]
+        self._sections = {
+            name: DictionaryEncodedSection(strings, section["fields"], section["rows"])
+            for name, section in entries["sections"].items()
+        }
+
+    def __getitem__(self, name: str) -> Union[DictionaryEncodedSection, Tuple]:
+        return self._sections.get(name, ())
+
+    def get(self, name: str, default: Any = None) -> Any:
+        return self._sections.get(name, default)
+
+    def keys(self):
+        return self._sections.keys()
+
+
+CacheEntries = Union[BinaryCache, DictionaryEncodedCache, Dict[str, Any]]
+
+
+def open_cache(json_path: str) -> Callable[[], CacheEntries]:
+    """
+    Open the cache file at `json_path` and return a function which returns its entries.
+
+    They are read from the binary sidecar if it is at least as new as the JSON file, otherwise (or if
+    the binary file can't be read) from the plain or dictionary encoded JSON file. Only opening the
+    files needs the lock, the returned function can parse them after it was released.
+    """
+    binary_path = get_binary_path(json_path)
+    if os.path.exists(binary_path) and os.stat(binary_path).st_mtime >= os.stat(json_path).st_mtime:
+        try:
+            cache = BinaryCache(binary_path)
+            return lambda: cache
+        except (BinaryCacheError, OSError) as exc:
+            logger.warning("Falling back to %r: %s", json_path, exc)
+    json_file = open(json_path, "r")
+
+    def load() -> CacheEntries:
+        with json_file:
+            entries = json.load(json_file)
+        if entries.get("encoding") == DICTIONARY_ENCODING:
+            return DictionaryEncodedCache(entries)
+        return entries
+
+    return load
+
+
+def get_lock_path(json_path: str) -> str:
+    return os.path.splitext(json_path)[0] + ".lock"
+
+
+def get_generation_path(json_path: str) -> str:
+    return os.path.splitext(json_path)[0] + ".generation"
+
+
+def read_generation(json_path: str) -> int:
+    """Return the generation of the cache file at `json_path`, 0 if the builder didn't write one."""
+    try:
+        with open(get_generation_path(json_path)) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 0
+
+
+@contextlib.contextmanager
+def shared_lock(json_path: str) -> Iterator[bool]:
+    """
+    Try to take the lock of the cache file at `json_path` shared, without blocking.
+
+    Yields whether the lock was taken. True is also yielded if there is no lock file, because then
+    the builder never wrote the cache file.
+    """
+    try:
+        fd = os.open(get_lock_path(json_path), os.O_RDONLY)
+    except OSError:
+        yield True
+        return
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            locked = False
+        else:
+            locked = True
+        yield locked
+    finally:
+        os.close(fd)
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import copy
+import json
+import os
+import shutil
+from typing import Any, Dict, List, Optional
 from unittest.mock import patch, Mock
 
 import faker
@@ -8,7 +12,8 @@ import nest_asyncio
 import pytest
 
 from bildungslogin_plugin.backend import ConfigurationError, DbConnectionError
-from bildungslogin_plugin.backend_udm_rest_api import UdmRestApiBackend
+from bildungslogin_plugin.backend_udm_rest_api import LdapRepository, UdmRestApiBackend
+from bildungslogin_plugin.cache_format import BinaryCache, get_binary_path, get_generation_path
 from bildungslogin_plugin.models import Class, SchoolContext, Workgroup
 from bildungslogin_plugin.routes.v1.users import get_backend, set_backend
 
@@ -221,3 +226,114 @@ def test_get_roles_oc_fallback(data):
             UdmRestApiBackend._get_roles_oc_fallback(options)
     else:
         assert expected == UdmRestApiBackend._get_roles_oc_fallback(options)
+
+
+def cache_entries(uid: str) -> Dict[str, List[Dict[str, Any]]]:
+    return {
+        "users": [
+            {
+                "entryUUID": f"uuid-{uid}",
+                "entry_dn": f"uid={uid},cn=users,ou=School1,dc=test",
+                "objectClass": ["person"],
+                "uid": uid,
+                "givenName": "Given",
+                "sn": "Surname",
+                "ucsschoolSchool": ["School1"],
+                "ucsschoolRole": ["student:school:School1"],
+            }
+        ],
+        "licenses": [],
+        "assignments": [],
+        "schools": [
+            {
+                "entryUUID": "uuid-School1",
+                "entry_dn": "ou=School1,dc=test",
+                "objectClass": ["ucsschoolOrganizationalUnit"],
+                "ou": "School1",
+            }
+        ],
+        "workgroups": [],
+        "classes": [],
+    }
+
+
+# data/bildungslogin.bin was written by encode_binary_cache() of the cache builder from
+# data/bildungslogin.json, so the reader is tested against the format the builder writes. It has to be
+# written again (on a UCS system, the builder needs its LDAP modules) when the format changes.
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+GOLDEN_BINARY_CACHE = os.path.join(DATA_DIR, "bildungslogin.bin")
+GOLDEN_JSON_CACHE = os.path.join(DATA_DIR, "bildungslogin.json")
+
+
+@pytest.fixture()
+def json_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "bildungslogin.json")
+    monkeypatch.setattr("bildungslogin_plugin.backend_udm_rest_api.JSON_PATH", path)
+    return path
+
+
+def write_cache_file(json_path: str, entries, generation: Optional[int] = None) -> None:
+    with open(json_path, "w") as f:
+        json.dump(entries, f)
+    if generation is not None:
+        with open(get_generation_path(json_path), "w") as f:
+            f.write(str(generation))
+
+
+def test_binary_cache_golden_file():
+    with open(GOLDEN_JSON_CACHE) as f:
+        entries = json.load(f)
+    cache = BinaryCache(GOLDEN_BINARY_CACHE)
+    try:
+        assert sorted(cache.keys()) == sorted(entries)
+        for name, objs in entries.items():
+            assert list(cache[name]) == objs
+        licenses = list(cache["licenses"])
+        assert licenses[0]["quantity_assigned"] == 1
+        # a missing field is left out of the record
+        assignments = list(cache["assignments"])
+        assert "bildungsloginAssignmentAssignee" in assignments[0]
+        assert "bildungsloginAssignmentAssignee" not in assignments[1]
+        assert len(cache["classes"]) == 0
+    finally:
+        cache.close()
+
+
+def test_ldap_repository_loads_binary_sidecar(json_path):
+    write_cache_file(json_path, cache_entries("json-user"), generation=1)
+    # the sidecar is newer than the JSON file, so it is read instead
+    shutil.copyfile(GOLDEN_BINARY_CACHE, get_binary_path(json_path))
+    repository = LdapRepository(Mock())
+    repository.update()
+    assert repository.get_user("json-user") is None
+    user = repository.get_user("binary-user")
+    assert (user.entryUUID, user.ucsschoolRole) == ("uuid-binary-user", ["student:school:School1"])
+    assert repository.get_school("School1").entryUUID == "uuid-School1"
+    # the assignment without assignee is skipped
+    assignments = repository.get_assignments_by_assignee(user)
+    assert [assignment.entryUUID for assignment in assignments] == ["uuid-assignment1"]
+    assert repository.get_license_by_assignment(assignments[0]).bildungsloginLicenseCode == "code"
+    assert repository.count_objects() == 5
+
+
+def test_ldap_repository_loads_json_only(json_path):
+    write_cache_file(json_path, cache_entries("json-user"), generation=1)
+    repository = LdapRepository(Mock())
+    repository.update()
+    assert repository.get_user("json-user").entryUUID == "uuid-json-user"
+    assert repository.count_objects() == 2
+
+
+def test_ldap_repository_skips_reload_with_unchanged_generation(json_path):
+    write_cache_file(json_path, cache_entries("user1"), generation=1)
+    repository = LdapRepository(Mock())
+    repository.update()
+    write_cache_file(json_path, cache_entries("user2"))
+    with patch("bildungslogin_plugin.backend_udm_rest_api.open_cache") as open_cache_mock:
+        repository.update()
+    open_cache_mock.assert_not_called()
+    assert repository.get_user("user1") is not None
+    write_cache_file(json_path, cache_entries("user2"), generation=2)
+    repository.update()
+    assert repository.get_user("user1") is None
+    assert repository.get_user("user2") is not None
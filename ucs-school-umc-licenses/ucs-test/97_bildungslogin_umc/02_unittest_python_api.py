@@ -1,5 +1,7 @@
+import imp
+
 import pytest
-from univention.management.console.modules.licenses import Instance
+from univention.management.console.modules.licenses import Instance, cache, cache_format
 
 
 @pytest.mark.parametrize("pickup_number,school,expected_pickup_number", [
@@ -41,3 +43,233 @@ def test_get_license(mock, pickup_number, school, expected_pickup_number):
         "school": school,
         "licenses": license_data_mock
     })
+
+
+BUILDER_PATH = "/usr/sbin/bildungslogin_build_ucs_school_api_cache.py"
+
+
+def school_partition(school, users=1):
+    """ A school cache with users, one assigned SINGLE license and its medium """
+    return {
+        "users": [{
+            "entryUUID": "user-%s-%d" % (school, number),
+            "entry_dn": "uid=%s-%d,cn=users,ou=%s,dc=test" % (school, number, school),
+            "objectClass": ["person"],
+            "uid": "%s-%d" % (school, number),
+            "givenName": "Given%d" % (number,),
+            "sn": "Surname%d" % (number,),
+            "ucsschoolRole": ["student:school:%s" % (school,)],
+            "ucsschoolSchool": [school],
+        } for number in range(users)],
+        "schools": [{
+            "entryUUID": "school-%s" % (school,),
+            "entry_dn": "ou=%s,dc=test" % (school,),
+            "objectClass": ["ucsschoolOrganizationalUnit"],
+            "ou": school,
+        }],
+        "licenses": [{
+            "entryUUID": "license-%s" % (school,),
+            "entry_dn": "cn=code-%s,cn=licenses,dc=test" % (school,),
+            "objectClass": ["bildungsloginLicense"],
+            "bildungsloginLicenseCode": "code-%s" % (school,),
+            "bildungsloginLicenseSchool": school,
+            "bildungsloginLicenseType": "SINGLE",
+            "bildungsloginLicenseSpecialType": "",
+            "bildungsloginLicenseQuantity": "1",
+            "bildungsloginLicenseProvider": "provider",
+            "bildungsloginProductId": "product",
+            "bildungsloginDeliveryDate": "2022-01-01",
+            "bildungsloginExpiryDate": "2030-01-01",
+            "bildungsloginIgnoredForDisplay": "0",
+            "bildungsloginUsageStatus": "",
+            "bildungsloginUtilizationSystems": "",
+            "bildungsloginValidityDuration": "",
+            "bildungsloginValidityStatus": "",
+            "quantity_assigned": 1,
+            "groups": [],
+            "user_ids": ["%s-0" % (school,)],
+        }],
+        "assignments": [{
+            "entryUUID": "assignment-%s" % (school,),
+            "entry_dn": "cn=assignment,cn=code-%s,cn=licenses,dc=test" % (school,),
+            "objectClass": ["bildungsloginAssignment"],
+            "bildungsloginAssignmentAssignee": "user-%s-0" % (school,),
+            "bildungsloginAssignmentStatus": "ASSIGNED",
+            "bildungsloginAssignmentTimeOfAssignment": "2022-02-02",
+        }],
+        "workgroups": [],
+        "classes": [],
+        "metadata": [{
+            "entryUUID": "metadata-product",
+            "entry_dn": "cn=product,cn=metadata,dc=test",
+            "objectClass": ["bildungsloginMetaData"],
+            "bildungsloginProductId": "product",
+            "bildungsloginMetaDataTitle": "Title",
+            "bildungsloginMetaDataPublisher": "Publisher",
+            "bildungsloginMetaDataAuthor": "",
+            "bildungsloginMetaDataCover": "",
+            "bildungsloginMetaDataCoverSmall": "",
+            "bildungsloginMetaDataDescription": "",
+        }],
+    }
+
+
+@pytest.fixture()
+def builder():
+    """ The cache builder script, which writes the school cache files """
+    return imp.load_source("bildungslogin_build_ucs_school_api_cache", BUILDER_PATH)
+
+
+@pytest.fixture()
+def cache_dir(tmpdir, monkeypatch, builder):
+    """ Let the cache builder and the UMC module use a temporary cache directory """
+    json_dir = str(tmpdir) + "/"
+    monkeypatch.setattr(builder, "JSON_DIR", json_dir)
+    monkeypatch.setattr(cache, "JSON_DIR", json_dir)
+    return json_dir
+
+
+def test_repository_cache_hits_misses_and_evictions(cache_dir, builder):
+    """ The least recently used school is dropped once the schools hold too many objects """
+    for school in ("s1", "s2", "s3"):
+        builder.write_school_cache_file(school, school_partition(school, users=2))
+    # every school holds 5 objects: 2 users, the school, the license and the assignment
+    repositories = cache.RepositoryCache(max_objects=10)
+    for school in ("s1", "s2", "s1", "s3"):
+        repositories.update(school)
+        assert repositories.get_school(school) is not None
+    statistics = repositories.statistics()
+    assert statistics["schools"] == ["s1", "s3"]
+    assert statistics["objects"] == 10
+    assert (statistics["hits"], statistics["misses"], statistics["evictions"]) == (1, 3, 1)
+
+
+def test_repository_cache_keeps_current(cache_dir, builder):
+    """ The current school is kept even if it alone holds more objects than allowed """
+    for school in ("s1", "s2"):
+        builder.write_school_cache_file(school, school_partition(school, users=3))
+    repositories = cache.RepositoryCache(max_objects=1)
+    repositories.update("s1")
+    repositories.update("s2")
+    assert repositories.statistics()["schools"] == ["s2"]
+    assert repositories.get_school("s2") is not None
+    assert repositories.get_school("s1") is None
+    repositories.update(None)
+    assert repositories.get_school("s2") is not None
+
+
+def test_repository_cache_missing_school(cache_dir, builder):
+    """ A school without cache file is not cached, the previous school stays the current one """
+    builder.write_school_cache_file("s1", school_partition("s1"))
+    repositories = cache.RepositoryCache(max_objects=100)
+    repositories.update("s1")
+    repositories.update("missing", start_up=True)
+    assert repositories.statistics()["schools"] == ["s1"]
+    assert repositories.get_school("s1") is not None
+    with pytest.raises(Exception):
+        repositories.update("missing")
+    assert repositories.statistics()["schools"] == ["s1"]
+
+
+def test_repository_legacy_user_strings(cache_dir, builder):
+    """ The users of licenses in cache files of older cache builders are looked up by their names """
+    partition = school_partition("s1", users=2)
+    del partition["licenses"][0]["user_ids"]
+    partition["licenses"][0]["user_strings"] = ["Given0", "Surname0", "s1-0", "unknown"]
+    builder.write_school_cache_file("s1", partition)
+    repository = cache.LdapRepository()
+    repository.update("s1")
+    assert list(repository.get_license_by_code("code-s1").user_ids) == ["s1-0"]
+    assert repository.filter_licenses(school="s1", user_pattern="s1-0") == [
+        repository.get_license_by_code("code-s1")]
+
+
+def test_repository_cache_refresh(cache_dir, builder):
+    """ refresh() replaces the repositories whose cache file changed """
+    for school in ("s1", "s2"):
+        builder.write_school_cache_file(school, school_partition(school))
+    repositories = cache.RepositoryCache(max_objects=100)
+    repositories.update("s2")
+    repositories.update("s1")
+    repositories.refresh()
+    assert repositories.statistics()["refreshes"] == 0
+
+    builder.write_school_cache_file("s1", school_partition("s1", users=3))
+    repositories.refresh()
+    assert repositories.statistics()["refreshes"] == 1
+    # the current repository is only replaced by the next update of its school
+    assert repositories.get_user("s1-2") is None
+    repositories.update("s1")
+    assert repositories.get_user("s1-2") is not None
+    assert repositories.statistics()["objects"] == 6 + 4
+
+
+def test_journal_append_and_read(tmpdir):
+    """ The records of the journal are read back from an offset """
+    json_path = str(tmpdir.join("cache.json"))
+    assert cache_format.read_journal(json_path) == ([], 0)
+    cache_format.append_journal(json_path, {"license": {"entryUUID": "a"}})
+    cache_format.append_journal(json_path, {"license": {"entryUUID": "b"}, "deleted": True})
+    records, offset = cache_format.read_journal(json_path)
+    assert records == [{"license": {"entryUUID": "a"}}, {"license": {"entryUUID": "b"}, "deleted": True}]
+    cache_format.append_journal(json_path, {"license": {"entryUUID": "c"}})
+    records, new_offset = cache_format.read_journal(json_path, offset)
+    assert records == [{"license": {"entryUUID": "c"}}]
+    assert new_offset > offset
+    assert cache_format.read_journal(json_path, new_offset) == ([], new_offset)
+
+
+def test_journal_compacted_by_builder(cache_dir, builder):
+    """ Replacing the cache file drops the records appended before the LDAP objects were fetched """
+    builder.write_school_cache_file("s1", school_partition("s1"))
+    json_path = builder.get_school_cache_path("s1")
+    cache_format.append_journal(json_path, {"license": {"entryUUID": "old"}})
+    journal_offsets = builder.get_journal_offsets("s1")
+    cache_format.append_journal(json_path, {"license": {"entryUUID": "new"}})
+    builder.write_school_cache_file("s1", school_partition("s1"), journal_offset=journal_offsets["s1"])
+    records, offset = cache_format.read_journal(json_path)
+    assert records == [{"license": {"entryUUID": "new"}}]
+
+    builder.write_school_cache_file("s1", school_partition("s1"), journal_offset=offset)
+    assert cache_format.read_journal(json_path) == ([], 0)
+
+
+def test_journal_applied_to_repository(cache_dir, builder):
+    """ The repositories apply the changed and deleted licenses of the journal """
+    builder.write_school_cache_file("s1", school_partition("s1"))
+    repository = cache.LdapRepository()
+    repository.update("s1")
+    _license = repository.get_license_by_code("code-s1")
+    assert _license.quantity_assigned == 1
+    assert repository.filter_licenses(school="s1", user_pattern="s1-0") == [_license]
+
+    json_path = builder.get_school_cache_path("s1")
+    cache_format.append_journal(json_path, {
+        "license": {
+            "entryUUID": "license-s1",
+            "quantity_assigned": 0,
+            "groups": [],
+            "user_ids": [],
+        },
+        "assignments": [{
+            "entryUUID": "assignment-s1",
+            "bildungsloginAssignmentAssignee": "",
+            "bildungsloginAssignmentStatus": "AVAILABLE",
+            "bildungsloginAssignmentTimeOfAssignment": "",
+        }],
+    })
+    repository.update("s1")
+    assert repository.get_license_by_code("code-s1").quantity_assigned == 0
+    assert repository.get_assignment_by_uuid("assignment-s1").bildungsloginAssignmentStatus == "AVAILABLE"
+    # the license is not found by its former user anymore
+    assert repository.filter_licenses(school="s1", user_pattern="s1-0") == []
+
+    repository.delete_licenses(["code-s1"])
+    # a repository which loads the school now applies all records of the journal
+    other_repository = cache.LdapRepository()
+    other_repository.update("s1")
+    for _repository in (repository, other_repository):
+        _repository.update("s1")
+        assert _repository.get_license_by_code("code-s1") is None
+        assert _repository.get_license_by_uuid("license-s1") is None
+        assert _repository.get_assignment_by_uuid("assignment-s1") is None
@@ -0,0 +1,84 @@
+/*
+ * Copyright 2021 Univention GmbH
+ *
+ * http://www.univention.de/
+ *
+ * All rights reserved.
+ *
+ * The source code of this program is made available
+ * under the terms of the GNU Affero General Public License version 3
+ * (GNU AGPL V3) as published by the Free Software Foundation.
+ *
+ * Binary versions of this program provided by Univention to you as
+ * well as other copyrighted, protected or trademarked materials like
+ * Logos, graphics, fonts, specific documentations and configurations,
+ * cryptographic keys etc. are subject to a license agreement between
+ * you and Univention and not subject to the GNU AGPL V3.
+ *
+ * In the case you use this program under the terms of the GNU AGPL V3,
+ * the program is provided in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU Affero General Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License with the Debian GNU/Linux or Univention distribution in file
+ * /usr/share/common-licenses/AGPL-3; if not, see
+ * <http://www.gnu.org/licenses/>.
+ */
+/*global define,downloadFile*/
+
+define([
+      'dojo/_base/declare',
+      'dojo/_base/lang',
+      'dojo/Deferred',
+      'umc/tools',
+      'umc/i18n!umc/modules/licenses',
+      '../../libraries/FileHelper'],
+    function(declare, lang, Deferred, tools, _) {
+      return declare('umc.modules.licenses.ExportMixin', [], {
+        exportPollInterval: 1000,
+
+        // Start the export job of command in the background, poll its status and download the
+        // file when it is done. The returned Deferred reports the status of the job as progress.
+        // The optional button is disabled and shows the progress until the export is finished.
+        runExport: function(command, values, fileName, button) {
+          const deferred = new Deferred();
+          if (button) {
+            const label = button.get('label');
+            const restore = function() {
+              button.set('label', label);
+              button.set('disabled', false);
+            };
+            button.set('disabled', true);
+            deferred.then(restore, restore, function(job) {
+              button.set('label', job.total === null ?
+                  _('Exporting (%(rows)s rows)', job) :
+                  _('Exporting (%(rows)s of %(total)s rows)', job));
+            });
+          }
+          tools.umcpCommand(command, lang.mixin({background: true}, values)).then(
+              lang.hitch(this, function(response) {
+                this._waitForExport(response.result, fileName, deferred);
+              }),
+              lang.hitch(deferred, 'reject'));
+          return deferred;
+        },
+
+        _waitForExport: function(job, fileName, deferred) {
+          if (job.state === 'done') {
+            downloadFile(job.URL, fileName);
+            deferred.resolve(job);
+            return;
+          }
+          deferred.progress(job);
+          window.setTimeout(lang.hitch(this, function() {
+            tools.umcpCommand('licenses/export_status', {id: job.id}).then(
+                lang.hitch(this, function(response) {
+                  this._waitForExport(response.result, fileName, deferred);
+                }),
+                lang.hitch(deferred, 'reject'));
+          }), this.exportPollInterval);
+        },
+      });
+    });
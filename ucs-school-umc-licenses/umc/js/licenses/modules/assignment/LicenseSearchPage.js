@@ -53,13 +53,14 @@ define([
       'umc/widgets/ProgressInfo',
       'umc/widgets/Form',
       '../../common/LicenseColumns',
+      '../../common/ExportMixin',
       'umc/i18n!umc/modules/licenses'],
     function(declare, lang, dom, domClass, on, dateLocale, Deferred, entities,
         Tooltip, dialog, store, tools, Page, Grid, CheckBox, DateBox, ComboBox,
         SearchForm, Text, TextBox, SuggestionBox, ProgressInfo, Form,
-        LicenseColumns, _) {
+        LicenseColumns, ExportMixin, _) {
       return declare('umc.modules.licenses.LicenseSearchPage',
-          [Page, LicenseColumns], {
+          [Page, LicenseColumns, ExportMixin], {
             //// overwrites
             fullWidth: true,
 
@@ -615,17 +616,8 @@ define([
                 values.licenseType = ['WORKGROUP'];
               }
 
-              tools.umcpCommand('licenses/export_to_excel', values).
-                  then(lang.hitch(this, function(response) {
-                    const res = response.result;
-                    if (res.errorMessage) {
-                      dialog.alert(result.errorMessage);
-                    } else {
-                      downloadFile(res.URL, 'license.xlsx');
-                    }
-                    this._excelExportForm._buttons.submit.set('disabled',
-                        false);
-                  }));
+              this.runExport('licenses/export_to_excel', values, 'license.xlsx',
+                  this._excelExportForm._buttons.submit);
             },
 
             afterPageChange: function() {
@@ -50,6 +50,7 @@ define([
   'umc/widgets/Form',
   'umc/tools',
   '../../common/ProductColumns',
+  '../../common/ExportMixin',
   'umc/i18n!umc/modules/licenses',
 ], function(
     declare,
@@ -73,9 +74,10 @@ define([
     Form,
     tools,
     ProductColumns,
+    ExportMixin,
     _,
 ) {
-  return declare('umc.modules.licenses.ProductSearchPage', [Page, ProductColumns], {
+  return declare('umc.modules.licenses.ProductSearchPage', [Page, ProductColumns, ExportMixin], {
     //// overwrites
     fullWidth: true,
 
@@ -280,17 +282,8 @@ define([
         values.licenseType = ['WORKGROUP'];
         values.showOnlyAvailable = true;
       }
-      tools.umcpCommand('licenses/products/export_to_excel', values).then(
-          lang.hitch(this, function(response) {
-            const res = response.result;
-            if (res.errorMessage) {
-              dialog.alert(result.errorMessage);
-            } else {
-              downloadFile(res.URL, 'products.xlsx');
-            }
-            this._excelExportForm._buttons.submit.set('disabled', false);
-          }),
-      );
+      this.runExport('licenses/products/export_to_excel', values, 'products.xlsx',
+          this._excelExportForm._buttons.submit);
     },
 
     refreshGrid: function(values, resize = false) {
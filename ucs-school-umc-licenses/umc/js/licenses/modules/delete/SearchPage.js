@@ -48,6 +48,7 @@ define([
   'umc/widgets/ProgressInfo',
   '../../common/LicenseSearchformMixin',
   '../../common/FormatterMixin',
+  '../../common/ExportMixin',
   'umc/i18n!umc/modules/licenses',
   '../../../libraries/FileHelper',
   '../../../libraries/base64',
@@ -71,10 +72,11 @@ define([
     ProgressInfo,
     LicenseSearchformMixin,
     FormatterMixin,
+    ExportMixin,
     _,
 ) {
   return declare('umc.modules.licenses.license.SearchPage',
-      [Page, LicenseSearchformMixin, FormatterMixin], {
+      [Page, LicenseSearchformMixin, FormatterMixin, ExportMixin], {
         //// overwrites
         fullWidth: true,
 
@@ -254,17 +256,8 @@ define([
         },
 
         exportToExcel: function(values) {
-          tools.umcpCommand('licenses/export_to_excel', values).then(
-              lang.hitch(this, function(response) {
-                const res = response.result;
-                if (res.errorMessage) {
-                  dialog.alert(result.errorMessage);
-                } else {
-                  downloadFile(res.URL, 'license.xlsx');
-                }
-                this._excelExportForm._buttons.submit.set('disabled', false);
-              }),
-          );
+          this.runExport('licenses/export_to_excel', values, 'license.xlsx',
+              this._excelExportForm._buttons.submit);
         },// allow only either class or workgroup to be set
 
         createAfterSchoolChoose: function() {
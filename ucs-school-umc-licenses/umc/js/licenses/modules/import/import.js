@@ -50,6 +50,7 @@ define([
     'umc/widgets/TextBox',
     'put-selector/put',
     'umc/dialog',
+    '../../common/ExportMixin',
     'umc/i18n!umc/modules/licenses',
 ], function (
     declare,
@@ -73,9 +74,10 @@ define([
     TextBox,
     put,
     dialog,
+    ExportMixin,
     _,
 ) {
-    return declare('umc.modules.licenses.import.ImportMediaLicensePage', [Page], {
+    return declare('umc.modules.licenses.import.ImportMediaLicensePage', [Page, ExportMixin], {
         //// overwrites
         fullWidth: true,
 
@@ -183,10 +185,14 @@ define([
             this.getCacheStatus();
         },
 
-        setCacheStatus: function (running) {
+        setCacheStatus: function (running, progress) {
             if (running) {
+                let status = _('Updating');
+                if (progress && progress.total) {
+                    status = _('Updating (%(done)s of %(total)s schools)', progress);
+                }
                 this._cacheForm.getWidget('cache_build_status').set('content',
-                    _('Cache update status:') + ' ' + _('Updating'));
+                    _('Cache update status:') + ' ' + status);
                 this._cacheForm.getButton('submit').set('disabled', true);
             } else {
                 this._cacheForm.getWidget('cache_build_status').set('content',
@@ -209,7 +215,7 @@ define([
                             } else {
                                 this._cacheForm.getWidget('last_cache_build').set('content',
                                     _('Cache last updated:') + ' ' + result.time);
-                                this.setCacheStatus(result.status);
+                                this.setCacheStatus(result.status, result.progress);
                                 if (result.status) {
                                     window.setTimeout(lang.hitch(this, function () {
                                         this.getCacheStatus(10000);
@@ -299,16 +305,8 @@ define([
                 school: this.getSchoolId()
             }
 
-            tools.umcpCommand('licenses/export_single_to_excel', values).then(lang.hitch(this, function (response) {
-                const res = response.result;
-                if (res.errorMessage) {
-                    dialog.alert(result.errorMessage);
-                } else {
-                    downloadFile(res.URL, 'user.xlsx');
-                }
-                this._excelExportForm._buttons.submit.set('disabled',
-                    false);
-            }));
+            this.runExport('licenses/export_single_to_excel', values, 'user.xlsx',
+                this._excelExportForm._buttons.submit);
         },
 
         buildRendering: function () {
@@ -49,6 +49,7 @@ define([
   '../../common/LicenseSearchformMixin',
   '../../common/FormatterMixin',
   '../../common/LicenseColumns',
+  '../../common/ExportMixin',
   'umc/i18n!umc/modules/licenses',
   '../../../libraries/FileHelper',
   '../../../libraries/base64',
@@ -73,10 +74,11 @@ define([
     LicenseSearchformMixin,
     FormatterMixin,
     LicenseColumns,
+    ExportMixin,
     _,
 ) {
   return declare('umc.modules.licenses.license.SearchPage',
-      [Page, LicenseSearchformMixin, FormatterMixin, LicenseColumns], {
+      [Page, LicenseSearchformMixin, FormatterMixin, LicenseColumns, ExportMixin], {
         //// overwrites
         fullWidth: true,
 
@@ -157,17 +159,8 @@ define([
         ),
 
         exportToExcel: function(values) {
-          tools.umcpCommand('licenses/export_to_excel', values).then(
-              lang.hitch(this, function(response) {
-                const res = response.result;
-                if (res.errorMessage) {
-                  dialog.alert(result.errorMessage);
-                } else {
-                  downloadFile(res.URL, 'license.xlsx');
-                }
-                this._excelExportForm._buttons.submit.set('disabled', false);
-              }),
-          );
+          this.runExport('licenses/export_to_excel', values, 'license.xlsx',
+              this._excelExportForm._buttons.submit);
         },// allow only either class or workgroup to be set
 
         //// lifecycle
@@ -50,6 +50,7 @@ define([
   'umc/widgets/TextBox',
   'put-selector/put',
   '../../common/ProductColumns',
+  '../../common/ExportMixin',
   'umc/i18n!umc/modules/licenses',
   '../../../libraries/FileHelper',
   '../../../libraries/base64',
@@ -75,10 +76,11 @@ define([
     TextBox,
     put,
     ProductColumns,
+    ExportMixin,
     _,
 ) {
   return declare('umc.modules.licenses.product.SearchPage',
-      [Page, ProductColumns], {
+      [Page, ProductColumns, ExportMixin], {
         //// overwrites
         fullWidth: true,
 
@@ -287,17 +289,8 @@ define([
         },
 
         exportToExcel: function(values) {
-          tools.umcpCommand('licenses/products/export_to_excel', values).then(
-              lang.hitch(this, function(response) {
-                const res = response.result;
-                if (res.errorMessage) {
-                  dialog.alert(result.errorMessage);
-                } else {
-                  downloadFile(res.URL, 'license.xlsx');
-                }
-                this._excelExportForm._buttons.submit.set('disabled', false);
-              }),
-          );
+          this.runExport('licenses/products/export_to_excel', values, 'license.xlsx',
+              this._excelExportForm._buttons.submit);
         },
 
         createAfterSchoolChoose() {
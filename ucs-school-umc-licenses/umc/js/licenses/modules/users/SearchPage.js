@@ -56,6 +56,7 @@ define([
   'dojo/Deferred',
   'umc/widgets/ProgressInfo',
   '../../common/FormatterMixin',
+  '../../common/ExportMixin',
   'umc/i18n!umc/modules/licenses',
   '../../../libraries/FileHelper',
   '../../../libraries/base64',
@@ -87,10 +88,11 @@ define([
     Deferred,
     ProgressInfo,
     FormatterMixin,
+    ExportMixin,
     _,
 ) {
   return declare('umc.modules.licenses.users.SearchPage',
-      [Page, FormatterMixin], {
+      [Page, FormatterMixin, ExportMixin], {
         //// overwrites
         fullWidth: true,
 
@@ -136,17 +138,8 @@ define([
         },
 
         exportToExcel: function(values) {
-          tools.umcpCommand('licenses/users/export_to_excel', values).then(
-              lang.hitch(this, function(response) {
-                const res = response.result;
-                if (res.errorMessage) {
-                  dialog.alert(result.errorMessage);
-                } else {
-                  downloadFile(res.URL, 'user.xlsx');
-                }
-                this._excelExportForm._buttons.submit.set('disabled', false);
-              }),
-          );
+          this.runExport('licenses/users/export_to_excel', values, 'user.xlsx',
+              this._excelExportForm._buttons.submit);
         },
 
         removeLicenseFromUsers: function() {
@@ -30,14 +30,10 @@
 # License with the Debian GNU/Linux or Univention distribution in file
 # /usr/share/common-licenses/AGPL-3; if not, see
 # <http://www.gnu.org/licenses/>.
-import os
-import random
-import string
+import json
 from typing import Dict, List, Optional, Union
 from subprocess import Popen
-from .xlsxwriter import Workbook
 
-import psutil
 from ucsschool.lib.school_umc_base import SchoolBaseModule, SchoolSanitizer
 from ucsschool.lib.school_umc_ldap_connection import USER_WRITE, USER_READ, LDAP_Connection
 from univention.admin.syntax import iso8601Date
@@ -56,13 +52,19 @@ from univention.management.console.log import MODULE
 from univention.management.console.modules.decorators import sanitize, allow_get_request
 from univention.management.console.modules.sanitizers import (
     BooleanSanitizer,
+    IntegerSanitizer,
     LDAPSearchSanitizer,
     ListSanitizer,
     StringSanitizer,
 )
 from univention.udm.exceptions import SearchLimitReached
-from .cache import LdapRepository
-from .constants import JSON_PATH, JSON_DIR, CACHE_BUILD_SCRIPT
+from .cache import RepositoryCache
+from .cache_format import is_locked
+from .constants import (
+    JSON_PATH, JSON_DIR, CACHE_BUILD_SCRIPT, CACHE_BUILD_LOCK_PATH, CACHE_PROGRESS_PATH, EXPORT_SPOOL_DIR
+)
+from .export_jobs import DONE, FAILED, ExportSpool
+from .pagination import decode_cursor
 from six.moves.urllib_parse import quote
 
 _ = Translation("ucs-school-umc-licenses").translate
@@ -84,11 +86,184 @@ def optional_date2str(date):
     return ""
 
 
+def get_group_names(school, groups):
+    return ', '.join(group.cn.split(school + "-")[1] for group in groups)
+
+
+def get_license_row(_license):
+    metadata = _license.medium
+    return {
+        "licenseCode": _license.bildungsloginLicenseCode,
+        "productId": _license.bildungsloginProductId,
+        "productName": metadata.bildungsloginMetaDataTitle if metadata else '',
+        "publisher": _license.publisher,
+        "licenseTypeLabel": LicenseType.label(_license.bildungsloginLicenseType),
+        "for": _license.bildungsloginLicenseSpecialType,
+        "importDate": iso8601Date.from_datetime(_license.bildungsloginDeliveryDate),
+        "validityStart": iso8601Date.from_datetime(
+            _license.bildungsloginValidityStartDate) if _license.bildungsloginValidityStartDate else None,
+        "validityEnd": iso8601Date.from_datetime(
+            _license.bildungsloginValidityEndDate) if _license.bildungsloginValidityEndDate else None,
+        "countAquired": undefined_if_none(_license.quantity, zero_as_none=True),
+        "countAssigned": undefined_if_none(_license.quantity_assigned),
+        "countAvailable": str(
+            undefined_if_none(None if _license.quantity == 0 else _license.quantity_available)),
+        "countExpired": undefined_if_none(_license.quantity_expired),
+        "usageStatus": _license.bildungsloginUsageStatus,
+        "expiryDate": optional_date2str(_license.bildungsloginExpiryDate),
+        "validityStatus": _license.bildungsloginValidityStatus,
+    }
+
+
+def get_user_row(school, user):
+    return {
+        'assignment': user['assignment'].entryUUID,
+        'uid': user['user'].uid,
+        'license': user['license'].bildungsloginLicenseCode,
+        'status': user['assignment'].bildungsloginAssignmentStatus,
+        'medium': user['product'].bildungsloginMetaDataTitle if user['product'] else '',
+        'classes': get_group_names(school, user['classes']),
+        'workgroups': get_group_names(school, user['workgroups']),
+        'roles': Role.label(user['user'].ucsschoolRole),
+        'publisher': user['license'].publisher,
+        'date_assignment': iso8601Date.from_datetime(
+            user['assignment'].bildungsloginAssignmentTimeOfAssignment),
+        'import_date': iso8601Date.from_datetime(user['license'].bildungsloginDeliveryDate),
+        "validityStatus": user['license'].bildungsloginValidityStatus,
+    }
+
+
+def iter_license_export_rows(licenses):
+    for _license in licenses:
+        metadata = _license.medium
+
+        if _license.bildungsloginValidityStatus == '1':
+            validity_status = _('valid')
+        elif _license.bildungsloginValidityStatus == '0':
+            validity_status = _('invalid')
+        else:
+            validity_status = _('unknown')
+
+        if _license.bildungsloginUsageStatus == '1':
+            usage_status = _('activated')
+        elif _license.bildungsloginUsageStatus == '0':
+            usage_status = _('not activated')
+        else:
+            usage_status = _('unknown')
+
+        yield [
+            _license.bildungsloginLicenseCode,
+            _license.bildungsloginProductId,
+            metadata.bildungsloginMetaDataTitle if metadata else '',
+            _license.publisher,
+            LicenseType.label(_license.bildungsloginLicenseType),
+            _license.bildungsloginLicenseSpecialType,
+            iso8601Date.from_datetime(_license.bildungsloginDeliveryDate),
+            iso8601Date.from_datetime(
+                _license.bildungsloginValidityStartDate) if _license.bildungsloginValidityStartDate else None,
+            iso8601Date.from_datetime(
+                _license.bildungsloginValidityEndDate) if _license.bildungsloginValidityEndDate else None,
+            undefined_if_none(_license.quantity, zero_as_none=True),
+            undefined_if_none(_license.quantity_assigned),
+            undefined_if_none(_license.quantity_available),
+            undefined_if_none(_license.quantity_expired),
+            validity_status,
+            usage_status,
+            optional_date2str(_license.bildungsloginExpiryDate)
+        ]
+
+
+def iter_product_export_rows(products):
+    for meta_datum_obj, aggregate in products:
+        yield [
+            meta_datum_obj.bildungsloginProductId,
+            meta_datum_obj.bildungsloginMetaDataTitle,
+            meta_datum_obj.bildungsloginMetaDataPublisher,
+            undefined_if_none(aggregate.quantity),
+            aggregate.assigned,
+            undefined_if_none(aggregate.expired),
+            undefined_if_none(aggregate.available),
+            iso8601Date.from_datetime(aggregate.latest_delivery_date),
+            aggregate.licenses,
+            aggregate.licenses_assigned,
+            aggregate.licenses_expired,
+            aggregate.licenses_available
+        ]
+
+
+def iter_user_export_rows(school, users):
+    for user in users:
+        yield [
+            user['user'].uid,
+            get_group_names(school, user['classes']),
+            get_group_names(school, user['workgroups']),
+            ', '.join(Role.label(user['user'].ucsschoolRole)),
+            user['license'].publisher,
+            iso8601Date.from_datetime(
+                user['assignment'].bildungsloginAssignmentTimeOfAssignment),
+            iso8601Date.from_datetime(user['license'].bildungsloginDeliveryDate),
+            user['product'].bildungsloginProductId,
+            user['product'].bildungsloginMetaDataTitle,
+            user['license'].bildungsloginLicenseCode,
+            LicenseType.label(user['license'].bildungsloginLicenseType),
+            Status.label(user['assignment'].bildungsloginAssignmentStatus),
+        ]
+
+
+# the sort keys of the columns of licenses_query()
+LICENSE_SORT_KEYS = {
+    "licenseCode": lambda _license: _license.bildungsloginLicenseCode,
+    "productId": lambda _license: _license.bildungsloginProductId,
+    "productName": lambda _license: _license.medium.bildungsloginMetaDataTitle if _license.medium else '',
+    "publisher": lambda _license: _license.publisher,
+    "licenseTypeLabel": lambda _license: LicenseType.label(_license.bildungsloginLicenseType),
+    "for": lambda _license: _license.bildungsloginLicenseSpecialType,
+    "importDate": lambda _license: _license.bildungsloginDeliveryDate,
+    "validityStart": lambda _license: _license.bildungsloginValidityStartDate,
+    "validityEnd": lambda _license: _license.bildungsloginValidityEndDate,
+    "countAquired": lambda _license: _license.quantity,
+    "countAssigned": lambda _license: _license.quantity_assigned,
+    "countAvailable": lambda _license: _license.quantity_available,
+    "countExpired": lambda _license: _license.quantity_expired,
+    "usageStatus": lambda _license: _license.bildungsloginUsageStatus,
+    "expiryDate": lambda _license: _license.bildungsloginExpiryDate,
+    "validityStatus": lambda _license: _license.bildungsloginValidityStatus,
+}
+
+# the sort keys of the columns of users_list()
+USER_SORT_KEYS = {
+    'uid': lambda user: user['user'].uid,
+    'license': lambda user: user['license'].bildungsloginLicenseCode,
+    'status': lambda user: user['assignment'].bildungsloginAssignmentStatus,
+    'medium': lambda user: user['product'].bildungsloginMetaDataTitle if user['product'] else '',
+    'classes': lambda user: ','.join(group.cn for group in user['classes']),
+    'workgroups': lambda user: ','.join(group.cn for group in user['workgroups']),
+    'roles': lambda user: ','.join(Role.label(user['user'].ucsschoolRole)),
+    'publisher': lambda user: user['license'].publisher,
+    'date_assignment': lambda user: user['assignment'].bildungsloginAssignmentTimeOfAssignment,
+    'import_date': lambda user: user['license'].bildungsloginDeliveryDate,
+    'validityStatus': lambda user: user['license'].bildungsloginValidityStatus,
+}
+
+# the options of a query which returns a page of its results, see Instance._finish_page()
+PAGE_SANITIZERS = {
+    'offset': IntegerSanitizer(minimum=0, default=0),
+    'limit': IntegerSanitizer(minimum=1, allow_none=True, default=None),
+    'cursor': StringSanitizer(allow_none=True, default=None),
+    'sortBy': StringSanitizer(default=''),
+    'sortDescending': BooleanSanitizer(default=False),
+}
+
+
 class Instance(SchoolBaseModule):
 
     def __init__(self, *args, **kwargs):
         super(Instance, self).__init__(*args, **kwargs)
-        self.repository = LdapRepository()
+        self.repository = RepositoryCache(int(ucr.get('bildungslogin/umc/cache-max-objects', 200000)))
+        refresh_interval = int(ucr.get('bildungslogin/umc/cache-refresh-interval', 10))
+        if refresh_interval > 0:
+            self.repository.start_refresher(refresh_interval)
+        self.export_spool = ExportSpool(EXPORT_SPOOL_DIR, int(ucr.get('bildungslogin/umc/export-ttl', 3600)))
 
     @sanitize(
         isAdvancedSearch=BooleanSanitizer(required=True),
@@ -106,6 +281,7 @@ class Instance(SchoolBaseModule):
         notProvisioned=BooleanSanitizer(),
         notUsable=BooleanSanitizer(),
         allocationProductId=LDAPSearchSanitizer(add_asterisks=False, default=""),
+        **PAGE_SANITIZERS
     )
     @LDAP_Connection(USER_WRITE)
     def licenses_query(self, request, ldap_user_write=None):
@@ -125,13 +301,17 @@ class Instance(SchoolBaseModule):
             licenseCode -- str
             pattern -- str
             class -- str
+            offset, limit, cursor, sortBy, sortDescending -- see _finish_page()
         }
         """
         self.repository.update(request.options.get("school"))
-        try:
-            sizelimit = int(ucr.get("directory/manager/web/sizelimit", 2000))
-        except ValueError:
-            sizelimit = None
+        sort_key, descending = self._get_sorting(request, LICENSE_SORT_KEYS, "licenseCode")
+        sizelimit = None
+        if sort_key is None:
+            try:
+                sizelimit = int(ucr.get("directory/manager/web/sizelimit", 2000))
+            except ValueError:
+                pass
 
         time_from = request.options.get("timeFrom")
         time_from = iso8601Date.to_datetime(time_from) if time_from else None
@@ -171,7 +351,9 @@ class Instance(SchoolBaseModule):
                 only_provisioned=request.options.get("onlyProvisionedLicenses"),
                 not_usable=request.options.get("notUsable"),
                 expiry_date_from=expiry_from,
-                expiry_date_to=expiry_to
+                expiry_date_to=expiry_to,
+                sort_key=sort_key,
+                descending=descending,
             )
         except SearchLimitReached:
             raise UMC_Error(
@@ -182,32 +364,50 @@ class Instance(SchoolBaseModule):
                   "the UCR variable directory/manager/web/sizelimit."
                   ).format(sizelimit)
             )
-        result = []
-        for _license in licenses:
-            metadata = _license.medium
-            result.append({
-                "licenseCode": _license.bildungsloginLicenseCode,
-                "productId": _license.bildungsloginProductId,
-                "productName": metadata.bildungsloginMetaDataTitle if metadata else '',
-                "publisher": _license.publisher,
-                "licenseTypeLabel": LicenseType.label(_license.bildungsloginLicenseType),
-                "for": _license.bildungsloginLicenseSpecialType,
-                "importDate": iso8601Date.from_datetime(_license.bildungsloginDeliveryDate),
-                "validityStart": iso8601Date.from_datetime(
-                    _license.bildungsloginValidityStartDate) if _license.bildungsloginValidityStartDate else None,
-                "validityEnd": iso8601Date.from_datetime(
-                    _license.bildungsloginValidityEndDate) if _license.bildungsloginValidityEndDate else None,
-                "countAquired": undefined_if_none(_license.quantity, zero_as_none=True),
-                "countAssigned": undefined_if_none(_license.quantity_assigned),
-                "countAvailable": str(
-                    undefined_if_none(None if _license.quantity == 0 else _license.quantity_available)),
-                "countExpired": undefined_if_none(_license.quantity_expired),
-                "usageStatus": _license.bildungsloginUsageStatus,
-                "expiryDate": optional_date2str(_license.bildungsloginExpiryDate),
-                "validityStatus": _license.bildungsloginValidityStatus,
-            })
+        if sort_key is None:
+            self.finished(request.id, [get_license_row(_license) for _license in licenses])
+        else:
+            self._finish_page(request, licenses, get_license_row)
 
-        self.finished(request.id, result)
+    @staticmethod
+    def _get_sorting(request, sort_keys, default):
+        """Return the sort key and direction of a query for a page of its results.
+
+        The sort key is None if neither a limit nor a cursor was given, all results are returned then.
+        """
+        if request.options.get("limit") is None and not request.options.get("cursor"):
+            return None, False
+        sort_by = request.options.get("sortBy") or default
+        if sort_by not in sort_keys:
+            raise UMC_Error(_("The results can not be sorted by {}.").format(sort_by))
+        return sort_keys[sort_by], request.options.get("sortDescending")
+
+    def _finish_page(self, request, view, get_row):
+        """Return a page of the SortedView view, the rows are created with get_row.
+
+        requests.options = {
+            offset -- int, the number of results to skip
+            limit -- int, the maximal number of results of the page
+            cursor -- str, the cursor of the previous page, the page starts after its last result
+            sortBy -- str, the name of the column the results are sorted by
+            sortDescending -- boolean
+        }
+        The result contains the rows of the page, the number of all results and the cursor of the
+        next page, which is None after the last page.
+        """
+        after = None
+        if request.options.get("cursor"):
+            try:
+                after = decode_cursor(request.options.get("cursor"))
+            except ValueError:
+                raise UMC_Error(_("The page of the results is invalid, please repeat the search."))
+        limit = request.options.get("limit")
+        objects = view.page(request.options.get("offset"), limit, after)
+        self.finished(request.id, {
+            "items": [get_row(obj) for obj in objects],
+            "total": len(view),
+            "cursor": view.cursor(objects[-1]) if objects and len(objects) == limit else None,
+        })
 
     @sanitize(
         isAdvancedSearch=BooleanSanitizer(required=True),
@@ -223,6 +423,7 @@ class Instance(SchoolBaseModule):
         licenseCode=LDAPSearchSanitizer(default=""),
         pattern=LDAPSearchSanitizer(default=""),
         allocationProductId=LDAPSearchSanitizer(add_asterisks=False, default=""),
+        background=BooleanSanitizer(default=False),
     )
     @LDAP_Connection(USER_WRITE)
     def licenses_to_excel(self, request, ldap_user_write=None):
@@ -285,48 +486,6 @@ class Instance(SchoolBaseModule):
                   "the UCR variable directory/manager/web/sizelimit."
                   ).format(sizelimit)
             )
-        result = []
-        for _license in licenses:
-            metadata = _license.medium
-
-            if _license.bildungsloginValidityStatus == '1':
-                validity_status = _('valid')
-            elif _license.bildungsloginValidityStatus == '0':
-                validity_status = _('invalid')
-            else:
-                validity_status = _('unknown')
-
-            if _license.bildungsloginUsageStatus == '1':
-                usage_status = _('activated')
-            elif _license.bildungsloginUsageStatus == '0':
-                usage_status = _('not activated')
-            else:
-                usage_status = _('unknown')
-
-            result.append([
-                _license.bildungsloginLicenseCode,
-                _license.bildungsloginProductId,
-                metadata.bildungsloginMetaDataTitle if metadata else '',
-                _license.publisher,
-                LicenseType.label(_license.bildungsloginLicenseType),
-                _license.bildungsloginLicenseSpecialType,
-                iso8601Date.from_datetime(_license.bildungsloginDeliveryDate),
-                iso8601Date.from_datetime(
-                    _license.bildungsloginValidityStartDate) if _license.bildungsloginValidityStartDate else None,
-                iso8601Date.from_datetime(
-                    _license.bildungsloginValidityEndDate) if _license.bildungsloginValidityEndDate else None,
-                undefined_if_none(_license.quantity, zero_as_none=True),
-                undefined_if_none(_license.quantity_assigned),
-                undefined_if_none(_license.quantity_available),
-                undefined_if_none(_license.quantity_expired),
-                validity_status,
-                usage_status,
-                optional_date2str(_license.bildungsloginExpiryDate)
-            ])
-
-        filename = 'bildungsloginLicense_' + ''.join(
-            random.choice(string.ascii_letters) for _ in range(0, 20)) + '.xlsx'
-
         columns = [_('License code'), _('Medium ID'), _('Medium'), _('Publisher'), _('License type'),
                    _('Special License type'),
                    _('Delivery Date'), _('Validity start'), _('Redemption period'), _('Number of licenses'),
@@ -334,18 +493,14 @@ class Instance(SchoolBaseModule):
                    _('Number of available licenses'), _('Number of expired licenses'), _('Validity status'),
                    _('Usage status'), _('Expiry date')]
 
-        self._create_worksheet(filename, columns, result)
+        rows = iter_license_export_rows(licenses)
+        self._start_export(request, 'bildungsloginLicense', columns, rows, len(licenses))
 
-        self.finished(request.id, {'URL': '/univention/command/licenses/download_export?export=%s' % (
-            quote(filename),)})
-
-    @sanitize(school=StringSanitizer(required=True))
+    @sanitize(school=StringSanitizer(required=True), background=BooleanSanitizer(default=False))
     def licenses_single_to_excel(self, request):
         self.repository.update(request.options.get("school"))
-        result = self.repository.get_single_license_assigned_users(request.options.get("school"))
-
-        filename = 'bildungsloginSingleLicense_' + ''.join(
-            random.choice(string.ascii_letters) for _ in range(0, 20)) + '.xlsx'
+        # the export job may run in the background, the rows are read from the repository now
+        rows = list(self.repository.get_single_license_assigned_users(request.options.get("school")))
 
         columns = [
             _('User id'),
@@ -358,17 +513,60 @@ class Instance(SchoolBaseModule):
             _('Status')
         ]
 
-        self._create_worksheet(filename, columns, result)
+        self._start_export(request, 'bildungsloginSingleLicense', columns, rows, len(rows))
 
-        self.finished(request.id, {'URL': '/univention/command/licenses/download_export?export=%s' % (
-            quote(filename),)})
+    def _start_export(self, request, prefix, columns, rows, total=None):
+        """Create an export job of the rows and answer the request with its status.
+
+        If the option background is set, the job is built by the worker thread of the export spool
+        and the client polls export_status until the state is done. Otherwise it is built in the
+        request, which is answered with the URL of the file like before.
+        """
+        job = self.export_spool.create(prefix, columns, rows, total)
+        if request.options.get("background"):
+            self.export_spool.submit(job)
+        else:
+            self.export_spool.run(job)
+            if job.state == FAILED:
+                raise UMC_Error(_("The export failed."))
+        self.finished(request.id, self._get_export_status(job))
+
+    @staticmethod
+    def _get_export_status(job):
+        status = job.get_status()
+        if job.state == DONE:
+            status["URL"] = "/univention/command/licenses/download_export?export=%s" % (quote(job.id),)
+        return status
+
+    def _get_export_job(self, job_id):
+        job = self.export_spool.get(job_id)
+        if job is None:
+            raise UMC_Error(_("The export is not available anymore, please export again."), status=404)
+        return job
+
+    @sanitize(id=StringSanitizer(required=True))
+    def export_status(self, request):
+        """Returns the state and the number of written rows of an export job
+        requests.options = {
+            id -- str, the id returned by the export
+        }
+        """
+        job = self._get_export_job(request.options.get("id"))
+        if job.state == FAILED:
+            self.export_spool.remove(job)
+            raise UMC_Error(_("The export failed."))
+        self.finished(request.id, self._get_export_status(job))
 
     @allow_get_request
     @sanitize(export=StringSanitizer(required=True))
     def download_export(self, request):
-        with open('/tmp/' + request.options.get("export"), 'rb') as fd:
+        job = self._get_export_job(request.options.get("export"))
+        if job.state != DONE:
+            raise UMC_Error(_("The export is not finished yet."))
+        # a UMC request is answered with one message, the file is sent as a whole
+        with open(self.export_spool.get_path(job), 'rb') as fd:
             self.finished(request.id, fd.read(), mimetype="application/excel")
-        os.remove('/tmp/' + request.options.get("export"))
+        self.export_spool.remove(job)
 
     @sanitize(
         #  school=StringSanitizer(required=True),
@@ -737,6 +935,27 @@ class Instance(SchoolBaseModule):
         MODULE.info("licenses.query: result: %s" % str(result))
         self.finished(request.id, result)
 
+    def _get_product_aggregates(self, request):
+        """Return the metadata and the license aggregates of the products matching the options of
+        products_query() and products_to_excel().
+
+        The licenses of the school are aggregated per product in one pass, products without
+        licenses are left out.
+        """
+        aggregates = self.repository.aggregate_products(
+            request.options.get("school"), request.options.get("licenseType", None))
+        only_available = request.options.get('showOnlyAvailable')
+        products = []
+        for meta_datum_obj in self.repository.filter_metadata(request.options.get("pattern")):
+            aggregate = aggregates.get(meta_datum_obj.bildungsloginProductId)
+            if aggregate is None:
+                continue
+            # Caller (grid query) can now request products with 'all' or 'only available' licenses
+            if only_available and aggregate.licenses_available < 1:
+                continue
+            products.append((meta_datum_obj, aggregate))
+        return products
+
     @sanitize(
         school=SchoolSanitizer(required=True),
         pattern=LDAPSearchSanitizer(),
@@ -756,8 +975,6 @@ class Instance(SchoolBaseModule):
         MODULE.info("licenses.products.query: options: %s" % str(request.options))
         result = []
 
-        school = request.options.get("school")
-        pattern = request.options.get("pattern")
         license_types = request.options.get("licenseType", None)
 
         user_count = None
@@ -770,75 +987,36 @@ class Instance(SchoolBaseModule):
 
                 if group:
                     user_count = len(group.memberUid)
-        meta_data_objs = self.repository.filter_metadata(pattern)
-        for meta_datum_obj in meta_data_objs:
-            licenses = self.repository.filter_licenses(meta_datum_obj.bildungsloginProductId, school, license_types)
-
-            if licenses:
-                non_ignored_licenses = [license for license in licenses if not license.bildungsloginIgnoredForDisplay]
-
-                sum_quantity = 0
-                for license in non_ignored_licenses:
-                    if license.is_group_type and license.quantity_available == 0:
-                        sum_quantity = None
-                        break
-                    else:
-                        sum_quantity += license.quantity
-
-                sum_num_assigned = 0
-                for license in non_ignored_licenses:
-                    sum_num_assigned += license.quantity_assigned
-
-                sum_num_expired = 0
-                sum_num_available = 0
-                for license in non_ignored_licenses:
-                    if license.is_expired:
-                        sum_num_expired += license.quantity_expired
-                    else:
-                        if license.is_group_type and license.quantity_available == 0:
-                            sum_num_available = None
-                            break
-                        sum_num_available += license.quantity_available
-
-                # count info about licenses
-                number_of_licenses = len(non_ignored_licenses)
-                number_of_assigned_licenses = \
-                    sum(1 for l in non_ignored_licenses if l.quantity_assigned > 0)
-                number_of_expired_licenses = sum(1 for license in non_ignored_licenses if license.is_expired)
-                # Counting of assignments depends on the license type: _get_total_number_of_assignments() encapsulates the logic.
-                number_of_available_licenses = \
-                    sum(1 for license in non_ignored_licenses if license.is_available)
-                # Caller (grid query) can now request products with 'all' or 'only available' licenses
-                if 'showOnlyAvailable' in request.options and request.options['showOnlyAvailable']:
-                    if number_of_available_licenses < 1:
-                        continue
-
-                latest_delivery_date = max(lic_udm.bildungsloginDeliveryDate for lic_udm in licenses)
-                result.append(
-                    {
-                        "productId": meta_datum_obj.bildungsloginProductId,
-                        "title": meta_datum_obj.bildungsloginMetaDataTitle,
-                        "publisher": meta_datum_obj.bildungsloginMetaDataPublisher,
-                        "cover": meta_datum_obj.bildungsloginMetaDataCoverSmall or meta_datum_obj.bildungsloginMetaDataCover,
-                        "countAquired": undefined_if_none(sum_quantity),
-                        "countAssigned": sum_num_assigned,
-                        "countExpired": undefined_if_none(sum_num_expired),
-                        "countAvailable": undefined_if_none(sum_num_available),
-                        "latestDeliveryDate": iso8601Date.from_datetime(latest_delivery_date),
-                        "countLicenses": number_of_licenses,
-                        "countLicensesAssigned": number_of_assigned_licenses,
-                        "countLicensesExpired": number_of_expired_licenses,
-                        "countLicensesAvailable": number_of_available_licenses,
-                        "user_count": user_count
-                    }
-                )
+        for meta_datum_obj, aggregate in self._get_product_aggregates(request):
+            quantity = None if aggregate.quantity_unknown else aggregate.quantity
+            available = None if aggregate.available_unknown else aggregate.available
+            result.append(
+                {
+                    "productId": meta_datum_obj.bildungsloginProductId,
+                    "title": meta_datum_obj.bildungsloginMetaDataTitle,
+                    "publisher": meta_datum_obj.bildungsloginMetaDataPublisher,
+                    "cover": (meta_datum_obj.bildungsloginMetaDataCoverSmall
+                              or meta_datum_obj.bildungsloginMetaDataCover),
+                    "countAquired": undefined_if_none(quantity),
+                    "countAssigned": aggregate.assigned,
+                    "countExpired": undefined_if_none(aggregate.expired),
+                    "countAvailable": undefined_if_none(available),
+                    "latestDeliveryDate": iso8601Date.from_datetime(aggregate.latest_delivery_date),
+                    "countLicenses": aggregate.licenses,
+                    "countLicensesAssigned": aggregate.licenses_assigned,
+                    "countLicensesExpired": aggregate.licenses_expired,
+                    "countLicensesAvailable": aggregate.licenses_available,
+                    "user_count": user_count
+                }
+            )
         MODULE.info("licenses.products.query: result: %s" % str(result))
         self.finished(request.id, result)
 
     @sanitize(
         school=SchoolSanitizer(required=True),
         pattern=LDAPSearchSanitizer(),
-        licenseType=ListSanitizer(sanitizer=LDAPSearchSanitizer(add_asterisks=False))
+        licenseType=ListSanitizer(sanitizer=LDAPSearchSanitizer(add_asterisks=False)),
+        background=BooleanSanitizer(default=False)
     )
     @LDAP_Connection(USER_WRITE)
     def products_to_excel(self, request, ldap_user_write=None):
@@ -851,71 +1029,6 @@ class Instance(SchoolBaseModule):
         }
         """
         self.repository.update(request.options.get("school"))
-        result = []
-
-        school = request.options.get("school")
-        pattern = request.options.get("pattern")
-        license_types = request.options.get("licenseType", None)
-        meta_data_objs = self.repository.filter_metadata(pattern)
-
-        for meta_datum_obj in meta_data_objs:
-            licenses = self.repository.filter_licenses(meta_datum_obj.bildungsloginProductId, school, license_types)
-
-            if licenses:
-                non_ignored_licenses = [license for license in licenses if not license.bildungsloginIgnoredForDisplay]
-
-                sum_quantity = 0
-                for license in non_ignored_licenses:
-                    sum_quantity += license.quantity
-
-                sum_num_assigned = 0
-                for license in non_ignored_licenses:
-                    sum_num_assigned += license.quantity_assigned
-
-                sum_num_expired = 0
-                sum_num_available = 0
-                for license in non_ignored_licenses:
-                    if license.is_expired:
-                        sum_num_expired += license.quantity_expired
-                    else:
-                        sum_num_available += license.quantity_available
-
-                # count info about licenses
-                number_of_licenses = len(non_ignored_licenses)
-                number_of_assigned_licenses = \
-                    sum(1 for l in non_ignored_licenses if l.quantity_assigned > 0)
-                number_of_expired_licenses = sum(1 for license in non_ignored_licenses if license.is_expired)
-                # Counting of assignments depends on the license type: _get_total_number_of_assignments() encapsulates the logic.
-                number_of_available_licenses = \
-                    sum(1 for license in non_ignored_licenses if license.is_available)
-                # Caller (grid query) can now request products with 'all' or 'only available' licenses
-                if 'showOnlyAvailable' in request.options and request.options['showOnlyAvailable']:
-                    if number_of_available_licenses < 1:
-                        continue
-
-                latest_delivery_date = max(lic_udm.bildungsloginDeliveryDate for lic_udm in licenses)
-                result.append(
-                    [
-                        meta_datum_obj.bildungsloginProductId,
-                        meta_datum_obj.bildungsloginMetaDataTitle,
-                        meta_datum_obj.bildungsloginMetaDataPublisher,
-                        undefined_if_none(sum_quantity),
-                        sum_num_assigned,
-                        undefined_if_none(sum_num_expired),
-                        undefined_if_none(sum_num_available),
-                        iso8601Date.from_datetime(latest_delivery_date),
-                        number_of_licenses,
-                        number_of_assigned_licenses,
-                        number_of_expired_licenses,
-                        number_of_available_licenses
-                    ]
-                )
-
-        filename = 'bildungsloginProducts_' + ''.join(
-            random.choice(string.ascii_letters) for _ in range(0, 20)) + '.xlsx'
-        workbook = Workbook('/tmp/' + filename)
-        worksheet = workbook.add_worksheet()
-
         columns = [_('Medium ID'), _('Medium'), _('Publisher'), _('Maximal number of users'), _('Assigned'),
                    _('Expired'),
                    _('Available'),
@@ -923,10 +1036,9 @@ class Instance(SchoolBaseModule):
                    _('Number of expired licenses'),
                    _('Number of available licenses')]
 
-        self._create_worksheet(filename, columns, result)
-
-        self.finished(request.id, {'URL': '/univention/command/licenses/download_export?export=%s' % (
-            quote(filename),)})
+        products = self._get_product_aggregates(request)
+        rows = iter_product_export_rows(products)
+        self._start_export(request, 'bildungsloginProducts', columns, rows, len(products))
 
     @sanitize(
         school=SchoolSanitizer(required=True),
@@ -1067,14 +1179,10 @@ class Instance(SchoolBaseModule):
             workgroups
         )
 
-    def _cache_is_running(self):
-        for process in psutil.process_iter():
-            try:
-                if CACHE_BUILD_SCRIPT in process.cmdline():
-                    return True
-            except psutil.NoSuchProcess:
-                pass
-        return False
+    @staticmethod
+    def _cache_is_running():
+        """Return whether the cache builder is running, it holds the build lock while it runs."""
+        return is_locked(CACHE_BUILD_LOCK_PATH)
 
     def cache_rebuild(self, request):
         school = request.options.get("school")
@@ -1090,14 +1198,29 @@ class Instance(SchoolBaseModule):
                 {'status': 2}
             )
 
+    @staticmethod
+    def _cache_progress():
+        """Return the number of written and total school cache files of a running full rebuild."""
+        try:
+            with open(CACHE_PROGRESS_PATH) as progress_file:
+                progress = json.load(progress_file)
+        except (IOError, ValueError):
+            return None
+        if progress.get('finished'):
+            return None
+        return {'done': progress.get('schools_done', 0), 'total': progress.get('schools_total', 0)}
+
     @sanitize(school=SchoolSanitizer(required=True))
     def cache_status(self, request):
         self.repository.update(request.options.get("school"))
+        status = self._cache_is_running()
         self.finished(
             request.id,
             {
                 'time': self.repository.cache_date(),
-                'status': self._cache_is_running()
+                'status': status,
+                'progress': self._cache_progress() if status else None,
+                'repositories': self.repository.statistics(),
             }
         )
 
@@ -1148,46 +1271,37 @@ class Instance(SchoolBaseModule):
         publisher=LDAPSearchSanitizer(add_asterisks=False, default=''),
         validStatus=StringSanitizer(default=''),
         usageStatus=StringSanitizer(default=''),
-        notProvisioned=BooleanSanitizer()
+        notProvisioned=BooleanSanitizer(),
+        **PAGE_SANITIZERS
     )
     def users_list(self, request):
         school = request.options.get('school')
         self.repository.update(school)
+        sort_key, descending = self._get_sorting(request, USER_SORT_KEYS, 'uid')
         import_date_start = request.options.get('import_date_start')
         import_date_start = iso8601Date.to_datetime(import_date_start) if import_date_start else None
         import_date_end = request.options.get('import_date_end')
         import_date_end = iso8601Date.to_datetime(import_date_end) if import_date_end else None
-        users = self.repository.filter_user_to_medium_and_license(school,
-                                                                  import_date_start=import_date_start,
-                                                                  import_date_end=import_date_end,
-                                                                  class_group=request.options.get('class_group'),
-                                                                  workgroup=request.options.get('workgroup'),
-                                                                  username=request.options.get('username'),
-                                                                  medium=request.options.get('medium'),
-                                                                  medium_id=request.options.get('medium_id'),
-                                                                  publisher=request.options.get('publisher'),
-                                                                  valid_status=request.options.get('validStatus'),
-                                                                  usage_status=request.options.get('usageStatus'),
-                                                                  not_provisioned=request.options.get('notProvisioned')
-                                                                  )
-        result = []
-        for user in users:
-            result.append({
-                'assignment': user['assignment'].entryUUID,
-                'uid': user['user'].uid,
-                'license': user['license'].bildungsloginLicenseCode,
-                'status': user['assignment'].bildungsloginAssignmentStatus,
-                'medium': user['product'].bildungsloginMetaDataTitle if user['product'] else '',
-                'classes': ', '.join(group.cn.split(school + "-")[1] for group in user['classes']),
-                'workgroups': ', '.join(group.cn.split(school + "-")[1] for group in user['workgroups']),
-                'roles': Role.label(user['user'].ucsschoolRole),
-                'publisher': user['license'].publisher,
-                'date_assignment': iso8601Date.from_datetime(
-                    user['assignment'].bildungsloginAssignmentTimeOfAssignment),
-                'import_date': iso8601Date.from_datetime(user['license'].bildungsloginDeliveryDate),
-                "validityStatus": user['license'].bildungsloginValidityStatus,
-            })
-        self.finished(request.id, result)
+        users = self.repository.filter_user_to_medium_and_license(
+            school,
+            import_date_start=import_date_start,
+            import_date_end=import_date_end,
+            class_group=request.options.get('class_group'),
+            workgroup=request.options.get('workgroup'),
+            username=request.options.get('username'),
+            medium=request.options.get('medium'),
+            medium_id=request.options.get('medium_id'),
+            publisher=request.options.get('publisher'),
+            valid_status=request.options.get('validStatus'),
+            usage_status=request.options.get('usageStatus'),
+            not_provisioned=request.options.get('notProvisioned'),
+            sort_key=sort_key,
+            descending=descending
+        )
+        if sort_key is None:
+            self.finished(request.id, [get_user_row(school, user) for user in users])
+        else:
+            self._finish_page(request, users, lambda user: get_user_row(school, user))
 
     @sanitize(
         school=SchoolSanitizer(required=True),
@@ -1201,7 +1315,8 @@ class Instance(SchoolBaseModule):
         publisher=LDAPSearchSanitizer(add_asterisks=False, default=''),
         validStatus=StringSanitizer(default=''),
         usageStatus=StringSanitizer(default=''),
-        notProvisioned=BooleanSanitizer()
+        notProvisioned=BooleanSanitizer(),
+        background=BooleanSanitizer(default=False)
     )
     def users_to_excel(self, request):
         school = request.options.get('school')
@@ -1223,24 +1338,8 @@ class Instance(SchoolBaseModule):
                                                                   usage_status=request.options.get('usageStatus'),
                                                                   not_provisioned=request.options.get('notProvisioned')
                                                                   )
-        result = []
-        for user in users:
-            result.append([
-                user['user'].uid,
-                ', '.join(group.cn.split(school + "-")[1] for group in user['classes']),
-                ', '.join(group.cn.split(school + "-")[1] for group in user['workgroups']),
-                ', '.join(Role.label(user['user'].ucsschoolRole)),
-                user['license'].publisher,
-                iso8601Date.from_datetime(
-                    user['assignment'].bildungsloginAssignmentTimeOfAssignment),
-                iso8601Date.from_datetime(user['license'].bildungsloginDeliveryDate),
-                user['product'].bildungsloginProductId,
-                user['product'].bildungsloginMetaDataTitle,
-                user['license'].bildungsloginLicenseCode,
-                LicenseType.label(user['license'].bildungsloginLicenseType),
-                Status.label(user['assignment'].bildungsloginAssignmentStatus),
-            ])
-
+        # the export job formats the rows in the background, the users are selected now
+        users = list(users)
         columns = [
             _('User id'),
             _('Classes'),
@@ -1256,13 +1355,7 @@ class Instance(SchoolBaseModule):
             _('Status')
         ]
 
-        filename = 'bildungsloginUser_' + ''.join(
-            random.choice(string.ascii_letters) for _ in range(0, 20)) + '.xlsx'
-        self._create_worksheet(filename, columns, result)
-
-        self.finished(request.id, {'URL': '/univention/command/licenses/download_export?export=%s' % (
-            quote(filename),)})
-        self.finished(request.id, result)
+        self._start_export(request, 'bildungsloginUser', columns, iter_user_export_rows(school, users), len(users))
 
     def cache_rebuild_debug(self, request):
         if not self._cache_is_running() and ucr.get('bildungslogin/debug') == 'true':
@@ -1276,19 +1369,3 @@ class Instance(SchoolBaseModule):
                 request.id,
                 {'status': 2}
             )
-
-    @staticmethod
-    def _create_worksheet(filename, columns, result):
-        workbook = Workbook('/tmp/' + filename)
-        worksheet = workbook.add_worksheet()
-        header_format = workbook.add_format({'bold': True})
-        result.insert(0, columns)
-        worksheet.set_column(0, len(columns) - 1, 25)
-
-        for row_num, row in enumerate(result):
-            for col_num, data in enumerate(row):
-                if row_num == 0:
-                    worksheet.write(row_num, col_num, data, header_format)
-                else:
-                    worksheet.write(row_num, col_num, data)
-        workbook.close()
@@ -0,0 +1,92 @@
+"""Aggregation of the licenses of a school per product.
+
+The product grid of the UMC module and its export show sums and counts of the licenses of every
+product. aggregate_licenses() computes them for all products in one pass over the licenses, instead
+of searching the licenses of every product on its own.
+"""
+
+
+class ProductAggregate(object):
+    """The sums and counts of the licenses of one product which aren't ignored for display.
+
+    quantity_unknown and available_unknown tell if a group license without available quantity was
+    found, the UMC module shows no sum then. latest_delivery_date includes the ignored licenses.
+    """
+    __slots__ = (
+        'licenses', 'quantity', 'quantity_unknown', 'assigned', 'expired', 'available', 'available_unknown',
+        'licenses_assigned', 'licenses_expired', 'licenses_available', 'latest_delivery_date',
+    )
+
+    def __init__(self):
+        self.licenses = 0
+        self.quantity = 0
+        self.quantity_unknown = False
+        self.assigned = 0
+        self.expired = 0
+        self.available = 0
+        self.available_unknown = False
+        self.licenses_assigned = 0
+        self.licenses_expired = 0
+        self.licenses_available = 0
+        self.latest_delivery_date = None
+
+    def add(self, license):
+        if self.latest_delivery_date is None or license.bildungsloginDeliveryDate > self.latest_delivery_date:
+            self.latest_delivery_date = license.bildungsloginDeliveryDate
+        if license.bildungsloginIgnoredForDisplay:
+            return
+
+        # the properties are computed once per license
+        is_expired = license.is_expired
+        quantity_available = license.quantity_available
+        no_group_quantity = license.is_group_type and quantity_available == 0
+
+        self.licenses += 1
+        self.quantity += license.quantity
+        self.quantity_unknown = self.quantity_unknown or no_group_quantity
+        self.assigned += license.quantity_assigned
+        if license.quantity_assigned > 0:
+            self.licenses_assigned += 1
+        if is_expired:
+            self.expired += license.quantity_expired
+            self.licenses_expired += 1
+        else:
+            self.available += quantity_available
+            self.available_unknown = self.available_unknown or no_group_quantity
+        if license.is_available:
+            self.licenses_available += 1
+
+
+def aggregate_licenses(licenses):
+    """Return a ProductAggregate for each product id of the licenses.
+
+    >>> class License(object):
+    ...     def __init__(self, product_id, quantity, assigned, ignored=0, expired=False, group=False):
+    ...         self.bildungsloginProductId = product_id
+    ...         self.bildungsloginDeliveryDate = quantity
+    ...         self.bildungsloginIgnoredForDisplay = ignored
+    ...         self.quantity = quantity
+    ...         self.quantity_assigned = assigned
+    ...         self.is_expired = expired
+    ...         self.is_group_type = group
+    ...         self.quantity_available = 0 if expired else quantity - assigned
+    ...         self.quantity_expired = quantity - assigned if expired else 0
+    ...         self.is_available = self.quantity_available > 0
+    >>> aggregates = aggregate_licenses([
+    ...     License('p1', 3, 1), License('p1', 2, 0, expired=True), License('p1', 5, 5, ignored=1),
+    ...     License('p2', 1, 1, group=True)])
+    >>> p1 = aggregates['p1']
+    >>> p1.licenses, p1.quantity, p1.assigned, p1.expired, p1.available, p1.latest_delivery_date
+    (2, 5, 1, 2, 2, 5)
+    >>> p1.licenses_assigned, p1.licenses_expired, p1.licenses_available, p1.available_unknown
+    (1, 1, 1, False)
+    >>> aggregates['p2'].available_unknown
+    True
+    """
+    aggregates = {}
+    for license in licenses:
+        aggregate = aggregates.get(license.bildungsloginProductId)
+        if aggregate is None:
+            aggregate = aggregates[license.bildungsloginProductId] = ProductAggregate()
+        aggregate.add(license)
+    return aggregates
@@ -1,10 +1,13 @@
+import collections
 import os
+import threading
+import time
 from datetime import date, datetime
-import json
 from os.path import exists
 import re
 
-from typing import List, Dict, Union, Any
+from six.moves import filter
+from typing import Iterator, List, Dict, Set, Any
 from univention.management.console.log import MODULE
 
 from univention.bildungslogin.handlers import (
@@ -17,10 +20,34 @@ from univention.bildungslogin.handlers import (
 from univention.bildungslogin.models import LicenseType, Role, Status
 from univention.udm.exceptions import SearchLimitReached
 
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from .aggregation import ProductAggregate, aggregate_licenses
+from .cache_format import append_journal, open_cache, read_generation, read_journal, shared_lock
 from .constants import JSON_PATH, JSON_DIR, CACHE_BUILD_SCRIPT
+from .pagination import SortedView, sort_value
+from .query_plan import COST_PROPERTY, SLOW_PLAN_SECONDS, QueryPlan
+from .search_index import RangeIndex, WildcardIndex
 
 today = date.today()
 
+# the attributes of the licenses with an index of their values, see LdapRepository.filter_licenses()
+INDEXED_LICENSE_ATTRIBUTES = (
+    'bildungsloginLicenseSchool',
+    'bildungsloginProductId',
+    'bildungsloginLicenseType',
+    'bildungsloginValidityStatus',
+    'bildungsloginUsageStatus',
+)
+# the ucsschoolRole of the classes and workgroups of a school is the prefix followed by the school
+CLASS_ROLE_PREFIX = 'school_class:school:'
+WORKGROUP_ROLE_PREFIX = 'workgroup:school:'
+# the dates of the licenses sorted per school for range queries
+INDEXED_LICENSE_DATES = ('bildungsloginDeliveryDate', 'bildungsloginExpiryDate')
+
 
 class LdapUser:
     ucsschoolRole = None  # type: list
@@ -61,7 +88,7 @@ class LdapLicense:
                  bildungslogin_utilization_systems=None, bildungslogin_validity_duration=None,
                  bildungslogin_usage_status=None, bildungslogin_expiry_date=None, bildungslogin_validity_status=None,
                  quantity_assigned=None,
-                 user_strings=None, groups=None, publisher=None, volume_quantity=None):
+                 user_ids=None, groups=None, publisher=None, volume_quantity=None):
         if groups:
             self.groups = groups
         else:
@@ -102,8 +129,13 @@ class LdapLicense:
         self.quantity = int(bildungslogin_license_quantity)
         self.quantity_assigned = int(quantity_assigned)
         self.publisher = publisher
-        self.user_strings = user_strings
+        # the uids of the assigned users, a user is counted once per assignment (e.g. by several groups)
+        self.user_ids = collections.Counter(user_ids or [])
         self.medium = None
+        # the counters of the assignments, see LdapRepository.count_assignments()
+        self.assignment_counts = collections.Counter()
+        self.assignee_uuids = set()  # the assignees of ASSIGNED or PROVISIONED assignments
+        self.orphaned_assignments = 0  # the used assignments of users which aren't in the cache
 
         self.bildungsloginUsageStatus = bildungslogin_usage_status
         self.bildungsloginValidityStatus = bildungslogin_validity_status
@@ -118,18 +150,6 @@ class LdapLicense:
         if self.bildungsloginLicenseType == LicenseType.VOLUME and volume_quantity:
             self.volume_quantity = volume_quantity
 
-    def add_user_string(self, user_string):
-        self.user_strings.append(user_string)
-
-    def remove_duplicates(self):
-        self.user_strings = list(dict.fromkeys(self.user_strings))
-
-    def match_user_regex(self, user_pattern):
-        for user_string in self.user_strings:
-            if user_pattern.match(user_string):
-                return True
-        return False
-
     @property
     def quantity_available(self):
         if self.is_expired or self.bildungsloginValidityStatus == '0':
@@ -183,7 +203,7 @@ class LdapLicense:
             'entryUUID': self.entryUUID,
             'quantity_assigned': self.quantity_assigned,
             'groups': self.groups,
-            'user_strings': self.user_strings,
+            'user_ids': list(self.user_ids.elements()),
         }
 
 
@@ -233,7 +253,7 @@ class LdapSchool:
 
 class LdapGroup:
     def __init__(self, entry_uuid, entry_dn, cn, ucsschool_role, member_uids):
-        self.memberUid = member_uids
+        self.memberUid = frozenset(member_uids)
         self.entry_dn = entry_dn
         self.entryUUID = entry_uuid
         self.cn = cn
@@ -276,13 +296,24 @@ class LdapRepository:
     _classes_by_cn = None  # type: Dict[str, LdapGroup] | None
     _classes_by_dn = None  # type: Dict[str, LdapGroup] | None
     _classes_grouped_by_uid = None  # type: Dict[str, List[LdapGroup]] | None
+    _groups_by_uuid = None  # type: Dict[str, LdapGroup] | None
+    _workgroups_grouped_by_school = None  # type: Dict[str, List[LdapGroup]] | None
+    _classes_grouped_by_school = None  # type: Dict[str, List[LdapGroup]] | None
     _users_by_uuid = None  # type: Dict[str, LdapUser] | None
     _users_by_uid = None  # type: Dict[str, LdapUser] | None
+    _users_by_school = None  # type: Dict[str, List[LdapUser]] | None
+    _user_indexes = None  # type: Dict[str, WildcardIndex] | None
     _metadata_by_productid = None  # type: Dict[str, LdapMetaData] | None
     _licenses_by_uuid = None  # type: Dict[str, LdapLicense] | None
     _licenses_by_dn = None  # type: Dict[str, LdapLicense] | None
     _licenses_by_code = None  # type: Dict[str, LdapLicense] | None
     _licenses_grouped_by_school_and_product_id = None  # type: Dict[str, Dict[str, List[LdapLicense]]] | None
+    _license_uuids_by_uid = None  # type: Dict[str, Set[str]] | None
+    _license_uuids_by_attribute = None  # type: Dict[str, Dict[str, Set[str]]] | None
+    _license_date_indexes = None  # type: Dict[str, Dict[str, RangeIndex]] | None
+    _license_code_index = None  # type: WildcardIndex | None
+    _product_id_index = None  # type: WildcardIndex | None
+    _product_title_index = None  # type: WildcardIndex | None
     _schools_by_uuid = None  # type: Dict[str, LdapSchool] | None
     _schools_by_ou = None  # type: Dict[str, LdapSchool] | None
     _assignments_by_uuid = None  # type: Dict[str, LdapAssignment] | None
@@ -291,10 +322,16 @@ class LdapRepository:
 
     def __init__(self):
         self._timestamp = None
+        self._generation = None
+        self._journal_offset = 0
         self._clear()
 
-    def update(self, school, start_up=False):
+    def update(self, school, start_up=False, reload=True):
+        """Load the cache file of the school if it changed and apply the new records of its journal.
 
+        With reload=False a changed cache file of the current school is not loaded, the loaded
+        snapshot is kept until it is replaced (see CacheRefresher).
+        """
         if school:
             school_changed = school != self._current_school
         else:
@@ -308,102 +345,152 @@ class LdapRepository:
                 raise Exception("JSON file not found at " + cache_path + ". Please check if it is updating.")
             return
 
-        stat = os.stat(cache_path)
-        file_time = stat.st_mtime
-
-        if school_changed or self._timestamp is None or file_time > self._timestamp:
-            self._current_school = school
+        with shared_lock(cache_path) as locked:
+            if not locked and not school_changed and self._generation is not None:
+                # the cache builder is replacing the files right now, keep the loaded snapshot until the
+                # next update instead of waiting for it
+                return
+            generation = read_generation(cache_path)
+            file_time = os.stat(cache_path).st_mtime
+            load = None
+            journal_offset = self._journal_offset
+            if school_changed or self._generation is None or self._is_changed(generation, file_time):
+                if not reload and not school_changed and self._generation is not None:
+                    # the journal belongs to the new cache file, so it is not applied to this snapshot
+                    return
+                load = open_cache(cache_path)
+                journal_offset = 0
+            # only the records appended since the last update are read
+            changes, journal_offset = read_journal(cache_path, journal_offset)
+
+        if load is not None:
+            if school_changed:
+                self._current_school = school
             self._clear()
-            f = open(cache_path, 'r')
-            json_string = f.read()
-            f.close()
-            json_dictionary = json.loads(json_string)
-            self._process_entries(json_dictionary)
+            self._process_entries(load())
+            self._generation = generation
             self._timestamp = file_time
+        self._journal_offset = journal_offset
+        self.apply_license_changes(changes)
 
-        biggest_timestamp = self._timestamp
-        updates = []
-        for (dirpath, dirnames, filenames) in os.walk(JSON_DIR + 'schools/' + self._current_school + '/'):
-            for filename in filenames:
-                regex = re.compile('license-.*json')
-                if regex.match(filename):
-                    timestamp = os.stat(dirpath + filename).st_mtime
-                    if self._timestamp < timestamp:
-                        updates.append(dirpath + filename)
-                        if biggest_timestamp < timestamp:
-                            biggest_timestamp = timestamp
-            break
-
-        self._timestamp = biggest_timestamp
-        self.apply_json_files(updates)
-
-    def apply_json_files(self, filepaths):
-        license_updates = []
-        assignment_updates = []
-        delete_licenses = []
-        delete_assignments = []
-        license_object_to_deletes = []
-        assignment_object_to_deletes = []
-
-        for filepath in filepaths:
-            f = open(filepath, 'r')
-            json_string = f.read()
-            f.close()
-            json_dictionary = json.loads(json_string)
-            if 'deleted' in json_dictionary and json_dictionary['deleted']:
-                delete_licenses.append(json_dictionary['license'])
-                delete_assignments += json_dictionary['assignments']
-            else:
-                license_updates.append(json_dictionary['license'])
-                assignment_updates += json_dictionary['assignments']
+    def _is_changed(self, generation, file_time):
+        # without generation file (written by an older cache builder) only the mtime tells about changes
+        return generation != self._generation or (not generation and file_time > self._timestamp)
 
-        for _license in self._licenses_by_uuid.values():
-            if len(license_updates) <= 0 and len(delete_licenses) <= 0:
-                break
-
-            deleted = False
-            for delete_license in delete_licenses:
-                if _license.entryUUID == delete_license['entryUUID']:
-                    license_object_to_deletes.append(_license)
-                    deleted = True
-                    break
-
-            if not deleted:
-                for license_update in license_updates:
-                    if _license.entryUUID == license_update['entryUUID']:
-                        _license.user_strings = license_update['user_strings']
-                        _license.groups = license_update['groups']
-                        _license.quantity_assigned = license_update['quantity_assigned']
-                        license_updates.remove(license_update)
-                        break
-        for _assignment in self._assignments_by_uuid.values():
-            if len(assignment_updates) <= 0 and len(delete_assignments) <= 0:
-                break
-
-            deleted = False
-            for delete_assignment in delete_assignments:
-                if _assignment.entryUUID == delete_assignment['entryUUID']:
-                    assignment_object_to_deletes.append(_assignment)
-                    deleted = True
-                    break
-
-            if not deleted:
-                for assignment_update in assignment_updates:
-                    if _assignment.entryUUID == assignment_update['entryUUID']:
-                        _assignment.bildungsloginAssignmentAssignee = assignment_update[
-                            'bildungsloginAssignmentAssignee']
-                        _assignment.bildungsloginAssignmentStatus = assignment_update['bildungsloginAssignmentStatus']
-                        _assignment.bildungsloginAssignmentTimeOfAssignment = datetime.strptime(
-                            assignment_update['bildungsloginAssignmentTimeOfAssignment'],
-                            '%Y-%m-%d').date() if assignment_update['bildungsloginAssignmentTimeOfAssignment'] else None
-                        assignment_updates.remove(assignment_update)
-                        break
+    def is_loaded(self):
+        """Return whether a cache file was loaded."""
+        return self._generation is not None
 
-        for license_object_to_delete in license_object_to_deletes:
-            del self._licenses_by_uuid[license_object_to_delete.entryUUID]
+    def is_stale(self):
+        """Return whether the cache file of the loaded school changed since it was loaded."""
+        if self._generation is None:
+            return False
+        cache_path = JSON_DIR + 'schools/' + self._current_school + '/cache.json'
+        try:
+            file_time = os.stat(cache_path).st_mtime
+        except OSError:
+            return False
+        return self._is_changed(read_generation(cache_path), file_time)
 
-        for assignment_object_to_delete in assignment_object_to_deletes:
-            del self._assignments_by_uuid[assignment_object_to_delete.entryUUID]
+    def apply_license_changes(self, changes):
+        """Apply the records of the school's journal to the loaded cache, the latest record of a license wins.
+
+        The changed licenses and assignments are looked up by their entryUUID. Deleted objects are
+        removed from all indexes.
+        """
+        latest_changes = {}
+        for change in changes:
+            latest_changes[change['license']['entryUUID']] = change
+
+        for change in latest_changes.values():
+            deleted = change.get('deleted')
+            license_update = change['license']
+            _license = self._licenses_by_uuid.get(license_update['entryUUID'])
+            if _license is not None:
+                if deleted:
+                    self._remove_license(_license)
+                    _license = None
+                else:
+                    self._set_license_users(_license, self._get_license_user_ids(license_update))
+                    _license.groups = license_update['groups']
+                    _license.quantity_assigned = license_update['quantity_assigned']
+
+            for assignment_update in change['assignments']:
+                _assignment = self._assignments_by_uuid.get(assignment_update['entryUUID'])
+                if _assignment is None:
+                    continue
+                if deleted:
+                    self._remove_assignment(_assignment)
+                else:
+                    _assignment.bildungsloginAssignmentAssignee = assignment_update[
+                        'bildungsloginAssignmentAssignee']
+                    _assignment.bildungsloginAssignmentStatus = assignment_update['bildungsloginAssignmentStatus']
+                    time_of_assignment = assignment_update['bildungsloginAssignmentTimeOfAssignment']
+                    _assignment.bildungsloginAssignmentTimeOfAssignment = datetime.strptime(
+                        time_of_assignment, '%Y-%m-%d').date() if time_of_assignment else None
+            if _license is not None:
+                self.count_assignments(_license)
+
+    def _remove_license(self, _license):
+        del self._licenses_by_uuid[_license.entryUUID]
+        self._set_license_users(_license, [])
+        for attribute, uuids_by_value in self._license_uuids_by_attribute.items():
+            uuids = uuids_by_value.get(getattr(_license, attribute))
+            if uuids is not None:
+                uuids.discard(_license.entryUUID)
+                if not uuids:
+                    del uuids_by_value[getattr(_license, attribute)]
+        _dn = ','.join(_license.entry_dn.split(',')[1:])
+        if self._licenses_by_dn.get(_dn) is _license:
+            del self._licenses_by_dn[_dn]
+        if self._licenses_by_code.get(_license.bildungsloginLicenseCode) is _license:
+            del self._licenses_by_code[_license.bildungsloginLicenseCode]
+        licenses_by_product_id = self._licenses_grouped_by_school_and_product_id.get(
+            _license.bildungsloginLicenseSchool, {})
+        licenses = licenses_by_product_id.get(_license.bildungsloginProductId, [])
+        if _license in licenses:
+            licenses.remove(_license)
+            if not licenses:
+                del licenses_by_product_id[_license.bildungsloginProductId]
+
+    def _get_license_user_ids(self, entry):
+        if 'user_ids' in entry:
+            return entry['user_ids']
+        # cache files and journal records of older versions only have the names of the users
+        return [name for name in entry.get('user_strings', []) if name in self._users_by_uid]
+
+    def _add_license_user(self, _license, uid):
+        _license.user_ids[uid] += 1
+        self._license_uuids_by_uid.setdefault(uid, set()).add(_license.entryUUID)
+
+    def _remove_license_user(self, _license, uid):
+        _license.user_ids[uid] -= 1
+        if _license.user_ids[uid] <= 0:
+            del _license.user_ids[uid]
+            self._discard_license_uuid(uid, _license.entryUUID)
+
+    def _discard_license_uuid(self, uid, license_uuid):
+        license_uuids = self._license_uuids_by_uid.get(uid)
+        if license_uuids is not None:
+            license_uuids.discard(license_uuid)
+            if not license_uuids:
+                del self._license_uuids_by_uid[uid]
+
+    def _set_license_users(self, _license, user_ids):
+        for uid in _license.user_ids:
+            self._discard_license_uuid(uid, _license.entryUUID)
+        _license.user_ids = collections.Counter()
+        for uid in user_ids:
+            self._add_license_user(_license, uid)
+
+    def _remove_assignment(self, _assignment):
+        del self._assignments_by_uuid[_assignment.entryUUID]
+        _dn = ','.join(_assignment.entry_dn.split(',')[1:])
+        assignments = self._assignments_grouped_by_dn.get(_dn, [])
+        if _assignment in assignments:
+            assignments.remove(_assignment)
+            if not assignments:
+                del self._assignments_grouped_by_dn[_dn]
 
     def get_license_by_uuid(self, uuid):
         # type: (str) -> LdapLicense
@@ -423,10 +510,18 @@ class LdapRepository:
     def _clear(self):
         self._users_by_uuid = {}
         self._users_by_uid = {}
+        self._users_by_school = {}
+        self._user_indexes = {}
         self._licenses_by_uuid = {}
         self._licenses_by_dn = {}
         self._licenses_by_code = {}
         self._licenses_grouped_by_school_and_product_id = {}
+        self._license_uuids_by_uid = {}
+        self._license_uuids_by_attribute = dict((attribute, {}) for attribute in INDEXED_LICENSE_ATTRIBUTES)
+        self._license_date_indexes = dict((attribute, {}) for attribute in INDEXED_LICENSE_DATES)
+        self._license_code_index = WildcardIndex()
+        self._product_id_index = WildcardIndex()
+        self._product_title_index = WildcardIndex()
         self._assignments_by_uuid = {}
         self._assignments_grouped_by_dn = {}
         self._schools_by_uuid = {}
@@ -439,6 +534,9 @@ class LdapRepository:
         self._classes_by_cn = {}
         self._classes_by_dn = {}
         self._classes_grouped_by_uid = {}
+        self._groups_by_uuid = {}
+        self._workgroups_grouped_by_school = {}
+        self._classes_grouped_by_school = {}
         self._metadata_by_productid = {}
         self._publishers = []
 
@@ -460,6 +558,8 @@ class LdapRepository:
             self._users_by_uid.update({
                 entry["uid"]: user
             })
+            for school in user.ucsschoolSchool:
+                self._users_by_school.setdefault(school, []).append(user)
         for entry in entries['licenses']:
             _license = LdapLicense(
                 entry_uuid=entry['entryUUID'],
@@ -487,7 +587,7 @@ class LdapRepository:
                     'bildungsloginUtilizationSystems'],
                 bildungslogin_validity_duration=entry['bildungsloginValidityDuration'],
                 quantity_assigned=entry['quantity_assigned'],
-                user_strings=entry['user_strings'],
+                user_ids=self._get_license_user_ids(entry),
                 groups=entry['groups'],
                 publisher=entry['bildungsloginLicenseProvider'],
                 bildungslogin_validity_status=entry['bildungsloginValidityStatus'],
@@ -497,6 +597,10 @@ class LdapRepository:
             self._licenses_by_uuid.update({
                 entry["entryUUID"]: _license
             })
+            for uid in _license.user_ids:
+                self._license_uuids_by_uid.setdefault(uid, set()).add(_license.entryUUID)
+            for attribute, uuids_by_value in self._license_uuids_by_attribute.items():
+                uuids_by_value.setdefault(getattr(_license, attribute), set()).add(_license.entryUUID)
             self._licenses_by_dn.update({
                 ','.join(entry["entry_dn"].split(',')[1:]): _license
             })
@@ -552,12 +656,18 @@ class LdapRepository:
             self._workgroups_by_uuid.update({
                 entry["entryUUID"]: _workgroup
             })
+            self._groups_by_uuid.update({
+                entry["entryUUID"]: _workgroup
+            })
             self._workgroups_by_cn.update({
                 entry["cn"]: _workgroup
             })
             self._workgroups_by_dn.update({
                 entry["entry_dn"]: _workgroup
             })
+            if _workgroup.ucsschoolRole.startswith(WORKGROUP_ROLE_PREFIX):
+                self._workgroups_grouped_by_school.setdefault(
+                    _workgroup.ucsschoolRole[len(WORKGROUP_ROLE_PREFIX):], []).append(_workgroup)
             for uid in entry['memberUid']:
                 if self._workgroups_grouped_by_uid.get(uid) is None:
                     self._workgroups_grouped_by_uid[uid] = []
@@ -573,12 +683,18 @@ class LdapRepository:
             self._classes_by_uuid.update({
                 entry["entryUUID"]: _class
             })
+            self._groups_by_uuid.update({
+                entry["entryUUID"]: _class
+            })
             self._classes_by_cn.update({
                 entry["cn"]: _class
             })
             self._classes_by_dn.update({
                 entry["entry_dn"]: _class
             })
+            if _class.ucsschoolRole.startswith(CLASS_ROLE_PREFIX):
+                school = _class.ucsschoolRole[len(CLASS_ROLE_PREFIX):]
+                self._classes_grouped_by_school.setdefault(school, []).append(_class)
             for uid in entry['memberUid']:
                 if self._classes_grouped_by_uid.get(uid) is None:
                     self._classes_grouped_by_uid[uid] = []
@@ -604,6 +720,28 @@ class LdapRepository:
 
         for _license in self._licenses_by_uuid.values():
             _license.medium = self.get_metadata_by_product_id(_license.bildungsloginProductId)
+            self.count_assignments(_license)
+        self._create_license_indexes()
+
+    def _create_license_indexes(self):
+        """Index the license codes, their dates and the ids and titles of the licensed products.
+
+        The indexes are used by filter_licenses().
+        """
+        self._license_code_index = WildcardIndex(
+            (_license.entryUUID, [_license.bildungsloginLicenseCode])
+            for _license in self._licenses_by_uuid.values())
+        for attribute, indexes in self._license_date_indexes.items():
+            for school, uuids in self._license_uuids_by_attribute['bildungsloginLicenseSchool'].items():
+                indexes[school] = RangeIndex(
+                    (uuid, getattr(self._licenses_by_uuid[uuid], attribute, None)) for uuid in uuids)
+        product_ids = set()
+        for licenses_by_product_id in self._licenses_grouped_by_school_and_product_id.values():
+            product_ids.update(licenses_by_product_id)
+        self._product_id_index = WildcardIndex((product_id, [product_id]) for product_id in product_ids)
+        self._product_title_index = WildcardIndex(
+            (product_id, [self._metadata_by_productid[product_id].bildungsloginMetaDataTitle])
+            for product_id in product_ids if product_id in self._metadata_by_productid)
 
     def get_publishers(self):
         return self._publishers
@@ -612,37 +750,41 @@ class LdapRepository:
         return self._users_by_uid.get(userid)
 
     def _get_users_by_school(self, school):
-        users = []
-        for user in self._users_by_uuid.values():
-            if school in user.ucsschoolSchool:
-                users.append(user)
-        return users
-
-    def _filter_user_by_group(self, users, workgroup):
-        filtered_users = []
-        for user in users:
-            if user.userId in workgroup.memberUid:
-                filtered_users.append(user)
-
-        return filtered_users
+        return self._users_by_school.get(school, [])
+
+    def _get_user_index(self, school=None):
+        # type: (str | None) -> WildcardIndex
+        """The index of the user names of the school or of all users, it is created with the first search."""
+        index = self._user_indexes.get(school)
+        if index is None:
+            users = self._users_by_uid.values() if school is None else self._get_users_by_school(school)
+            index = WildcardIndex((user.userId, [user.userId, user.givenName, user.sn]) for user in users)
+            self._user_indexes[school] = index
+        return index
 
     def filter_users(self, pattern, school, workgroup, school_class):
-        users = []
-        pattern = re.compile(pattern.replace('*', '.*'))
-
-        for user in self._get_users_by_school(school):
-            if pattern.match(user.userId) or pattern.match(user.givenName) or pattern.match(user.sn):
-                users.append(user)
-
+        # the index and the groups only narrow down the users which are matched with the pattern
+        uids = self._get_user_index(school).candidates(pattern)
+        groups = []
         if workgroup != '__all__' and workgroup != '':
-            workgroup = self.get_workgroup_by_dn(workgroup)
-            users = self._filter_user_by_group(users, workgroup)
-
+            groups.append(self.get_workgroup_by_dn(workgroup))
         if school_class != '__all__' and school_class != '':
-            school_class = self.get_class_by_dn(school_class)
-            users = self._filter_user_by_group(users, school_class)
+            groups.append(self.get_class_by_dn(school_class))
+        for group in groups:
+            uids = set(group.memberUid) if uids is None else uids.intersection(group.memberUid)
 
-        return users
+        if uids is None:
+            users = self._get_users_by_school(school)
+        else:
+            users = []
+            for uid in uids:
+                user = self._users_by_uid.get(uid)
+                if user and school in user.ucsschoolSchool:
+                    users.append(user)
+
+        pattern = re.compile(pattern.replace('*', '.*'))
+        return [user for user in users
+                if pattern.match(user.userId) or pattern.match(user.givenName) or pattern.match(user.sn)]
 
     def filter_metadata(self, pattern):
         filtered_metadata = []
@@ -654,41 +796,78 @@ class LdapRepository:
                 filtered_metadata.append(metadata)
         return filtered_metadata
 
-    def _match_license_by_product(self, license, regex):
-        metadata = license.medium
-        return regex.match(metadata.bildungsloginMetaDataTitle.lower()) if metadata else False
-
-    def _match_license_search_pattern(self, license, regex):
-        if regex.match(license.bildungsloginLicenseCode.lower()):
-            return True
-
-        if license.medium:
-            return regex.match(
-                license.medium.bildungsloginMetaDataTitle.lower()) or regex.match(
-                license.medium.bildungsloginProductId.lower())
-
-        return False
-
-    def get_user_to_medium_and_license(self, school):
-        result = []  # type: List[Dict[str, Union[LdapLicense, LdapMetaData, None, List[Any], LdapUser, LdapAssignment]]]
-
-        for license in self._licenses_by_uuid.values():  # type: LdapLicense
-            if (license.bildungsloginLicenseType in [LicenseType.SINGLE, LicenseType.VOLUME]
-                    and license.bildungsloginLicenseSchool == school):
+    def _get_license_uuids(self, attribute, values):
+        """Return the entryUUIDs of the licenses with one of the values of the indexed attribute."""
+        uuids_by_value = self._license_uuids_by_attribute[attribute]
+        if len(values) == 1:
+            return uuids_by_value.get(next(iter(values)), set())
+        uuids = set()
+        for value in values:
+            uuids.update(uuids_by_value.get(value, ()))
+        return uuids
+
+    def _get_license_uuids_in_range(self, attribute, start=None, end=None, school=None):
+        """Return the entryUUIDs of the licenses of the school (or of all schools) with a date in the range."""
+        indexes = self._license_date_indexes[attribute]
+        if school is not None:
+            return indexes[school].range(start, end) if school in indexes else set()
+        uuids = set()
+        for index in indexes.values():
+            uuids.update(index.range(start, end))
+        return uuids
+
+    # The wildcard patterns of the license search are matched case-insensitively from the start of
+    # the values, they are resolved with the license indexes instead of matching every license.
+
+    def _search_licenses_by_product_id(self, pattern):
+        return self._get_license_uuids('bildungsloginProductId', self._product_id_index.search(pattern))
+
+    def _search_licenses_by_product(self, pattern):
+        return self._get_license_uuids('bildungsloginProductId', self._product_title_index.search(pattern))
+
+    def _search_licenses_by_code(self, pattern):
+        # licenses without a code never match this filter, even if the pattern matches empty values
+        return set(
+            uuid for uuid in self._license_code_index.search(pattern)
+            if uuid in self._licenses_by_uuid and self._licenses_by_uuid[uuid].bildungsloginLicenseCode)
+
+    def _search_licenses_by_text(self, pattern):
+        # the product id is only searched for products with metadata, like the title
+        product_ids = self._product_title_index.search(pattern)
+        product_ids.update(
+            _id for _id in self._product_id_index.search(pattern) if _id in self._metadata_by_productid)
+        return (self._license_code_index.search(pattern)
+                | self._get_license_uuids('bildungsloginProductId', product_ids))
+
+    def _search_licenses_by_user(self, pattern):
+        uuids = set()
+        for uid in self._get_user_index().search(pattern):
+            uuids.update(self._license_uuids_by_uid.get(uid, ()))
+        return uuids
+
+    def get_user_to_medium_and_license(self, school, license_uuids=None):
+        # type: (str, Set[str] | None) -> Iterator[Dict[str, Any]]
+        """Generate the users with a single or volume license of the school, limited to license_uuids if given."""
+        uuids = self._get_license_uuids('bildungsloginLicenseSchool', [school])
+        if license_uuids is not None:
+            uuids = uuids.intersection(license_uuids)
+        for uuid in uuids:
+            license = self._licenses_by_uuid.get(uuid)  # type: LdapLicense
+            if license is None:
+                continue
+            if license.bildungsloginLicenseType in [LicenseType.SINGLE, LicenseType.VOLUME]:
                 assignments = self.get_assignments_by_license(license)
                 for assignment in assignments:  # type: LdapAssignment
                     user = self.get_user_by_uuid(assignment.bildungsloginAssignmentAssignee)
                     if user is not None:
-                        result.append({
+                        yield {
                             'user': user,
                             'product': self.get_metadata_by_product_id(license.bildungsloginProductId),
                             'license': license,
                             'workgroups': self.get_workgroups_by_user(user),
                             'classes': self.get_classes_by_user(user),
                             'assignment': assignment
-                        })
-
-        return result
+                        }
 
     def filter_user_to_medium_and_license(self, school,
                                           import_date_start=None,
@@ -701,17 +880,16 @@ class LdapRepository:
                                           publisher=None,
                                           valid_status=None,
                                           usage_status=None,
-                                          not_provisioned=None
+                                          not_provisioned=None,
+                                          sort_key=None,
+                                          descending=False
                                           ):
-        results = self.get_user_to_medium_and_license(school)
-
-        if import_date_start:
-            results = filter(lambda item: item['license'].bildungsloginDeliveryDate and item[
-                'license'].bildungsloginDeliveryDate >= import_date_start, results)
-
-        if import_date_end:
-            results = filter(lambda item: item['license'].bildungsloginDeliveryDate and item[
-                'license'].bildungsloginDeliveryDate <= import_date_end, results)
+        """Generate the rows of the users with their licenses, return a SortedView of them if sort_key is given."""
+        license_uuids = None
+        if import_date_start or import_date_end:
+            license_uuids = self._get_license_uuids_in_range(
+                'bildungsloginDeliveryDate', import_date_start or None, import_date_end or None, school)
+        results = self.get_user_to_medium_and_license(school, license_uuids)
 
         if class_group:
             results = filter(lambda item: class_group in [group.entry_dn for group in item['classes']], results)
@@ -751,11 +929,13 @@ class LdapRepository:
         if not_provisioned:
             results = filter(lambda item: item['assignment'].bildungsloginAssignmentStatus == Status.ASSIGNED, results)
 
+        if sort_key is not None:
+            return SortedView(
+                list(results), lambda item: (sort_value(sort_key(item)), item['assignment'].entryUUID), descending)
         return results
 
     def get_single_license_assigned_users(self, school):
-        result = []
-
+        """Generate the export rows of the users with a single or volume license of the school."""
         for license in self._licenses_by_uuid.values():
             if license.bildungsloginLicenseType in [LicenseType.SINGLE, LicenseType.VOLUME] and license.bildungsloginLicenseSchool == school:
                 assignments = self.get_assignments_by_license(license)
@@ -764,7 +944,7 @@ class LdapRepository:
                         user = self.get_user_by_uuid(assignment.bildungsloginAssignmentAssignee)
                         product = self.get_metadata_by_product_id(license.bildungsloginProductId)
                         if user:
-                            result.append([
+                            yield [
                                 user.userId,
                                 ', '.join(group.cn for group in self.get_classes_by_user(user)),
                                 ', '.join(group.cn for group in self.get_workgroups_by_user(user)),
@@ -773,8 +953,7 @@ class LdapRepository:
                                 license.bildungsloginLicenseCode,
                                 LicenseType.label(license.bildungsloginLicenseType),
                                 Status.label(assignment.bildungsloginAssignmentStatus),
-                            ])
-        return result
+                            ]
 
     def filter_licenses(self, product_id=None, school=None, license_types=None,
                         is_advanced_search=None,
@@ -796,96 +975,102 @@ class LdapRepository:
                         not_usable=None,
                         expiry_date_from=None,
                         expiry_date_to=None,
+                        sort_key=None,
+                        descending=False,
                         ):
+        """Return the licenses matching the filters, a SortedView of them if sort_key is given.
 
-        licenses = self._licenses_by_uuid.values()
-        if restrict_to_this_product_id:
-            licenses = filter(lambda _license: _license.bildungsloginProductId == restrict_to_this_product_id, licenses)
+        The sizelimit only applies if the licenses aren't sorted, a SortedView is displayed page by page.
+        """
 
+        plan = QueryPlan()
+        if restrict_to_this_product_id:
+            plan.add_index('product id', lambda: self._get_license_uuids(
+                'bildungsloginProductId', [restrict_to_this_product_id]))
         if school:
-            licenses = filter(lambda _license: _license.bildungsloginLicenseSchool == school, licenses)
-
-        if product_id and product_id != '*':
-            product_id = re.compile(product_id.lower().replace('*', '.*'))
-            licenses = filter(lambda _license: product_id.match(_license.bildungsloginProductId.lower()), licenses)
-
+            plan.add_index('school', lambda: self._get_license_uuids('bildungsloginLicenseSchool', [school]))
         if license_types:
-            licenses = filter(lambda _license: _license.bildungsloginLicenseType in license_types, licenses)
-
-        if is_advanced_search:
-            if time_from:
-                licenses = filter(lambda _license: _license.bildungsloginDeliveryDate >= time_from, licenses)
-
-            if time_to:
-                licenses = filter(lambda _license: _license.bildungsloginDeliveryDate <= time_to, licenses)
-
+            plan.add_index(
+                'license types', lambda: self._get_license_uuids('bildungsloginLicenseType', license_types))
+        if valid_status:
+            plan.add_index('validity status', lambda: self._get_license_uuids(
+                'bildungsloginValidityStatus', ['' if valid_status == '-' else valid_status]))
+        if usage_status:
+            plan.add_index('usage status', lambda: self._get_license_uuids(
+                'bildungsloginUsageStatus', ['' if usage_status == '-' else usage_status]))
+        if product_id and product_id != '*':
+            plan.add_index('product id pattern', lambda: self._search_licenses_by_product_id(product_id))
+        if product and product != '*':
+            plan.add_index('product pattern', lambda: self._search_licenses_by_product(product))
+        if license_code and license_code != '*':
+            plan.add_index('license code pattern', lambda: self._search_licenses_by_code(license_code))
         if pattern and pattern != '*':
-            pattern = re.compile(pattern.lower().replace('*', '.*'))
-            licenses = filter(
-                lambda _license: self._match_license_search_pattern(_license, pattern), licenses)
-
-        if publisher:
-            licenses = filter(
-                lambda _license: publisher == _license.publisher if _license.publisher else False,
-                licenses)
-
-        if only_available_licenses:
-            licenses = filter(lambda _license: _license.is_available, licenses)
-
+            plan.add_index('pattern', lambda: self._search_licenses_by_text(pattern))
         if user_pattern and user_pattern != '*':
-            user_pattern = re.compile(user_pattern.lower().replace('*', '.*'))
-            licenses = filter(lambda _license: _license.match_user_regex(user_pattern), licenses)
-
-        if license_code and license_code != '*':
-            license_code = re.compile(license_code.lower().replace('*', '.*'))
-            licenses = filter(lambda _license: license_code.match(
-                _license.bildungsloginLicenseCode.lower()) if _license.bildungsloginLicenseCode else False,
-                              licenses)
-
-        if product and product != '*':
-            product = re.compile(product.lower().replace('*', '.*'))
-            licenses = filter(lambda _license: self._match_license_by_product(_license, product), licenses)
-
+            plan.add_index('user pattern', lambda: self._search_licenses_by_user(user_pattern))
+
+        if is_advanced_search and (time_from or time_to):
+            plan.add_index('delivery date', lambda: self._get_license_uuids_in_range(
+                'bildungsloginDeliveryDate', time_from or None, time_to or None, school or None))
+        if expiry_date_from or expiry_date_to:
+            plan.add_index('expiry date', lambda: self._get_license_uuids_in_range(
+                'bildungsloginExpiryDate', expiry_date_from or None, expiry_date_to or None, school or None))
+        if publisher:
+            plan.add_filter('publisher', lambda _license: (
+                publisher == _license.publisher if _license.publisher else False))
         if school_class:
-            licenses = filter(lambda _license: school_class in _license.groups, licenses)
-
-        if valid_status:
-            if valid_status == '-':
-                licenses = filter(lambda _license: _license.bildungsloginValidityStatus == '', licenses)
-            else:
-                licenses = filter(lambda _license: _license.bildungsloginValidityStatus == valid_status, licenses)
-
-        if usage_status:
-            if usage_status == '-':
-                licenses = filter(lambda _license: _license.bildungsloginUsageStatus == '', licenses)
-            else:
-                licenses = filter(lambda _license: _license.bildungsloginUsageStatus == usage_status, licenses)
-
-        if expiry_date_from:
-            licenses = filter(lambda
-                                  _license: _license.bildungsloginExpiryDate and _license.bildungsloginExpiryDate >= expiry_date_from,
-                              licenses)
-
-        if expiry_date_to:
-            licenses = filter(lambda
-                                  _license: _license.bildungsloginExpiryDate and _license.bildungsloginExpiryDate <= expiry_date_to,
-                              licenses)
-
+            plan.add_filter('school class', lambda _license: school_class in _license.groups)
+        if only_available_licenses:
+            plan.add_filter('available', lambda _license: _license.is_available, COST_PROPERTY)
         if not_provisioned:
-            licenses = filter(lambda _license: self.is_license_only_assigned(_license), licenses)
-            
+            plan.add_filter('not provisioned', self.is_license_only_assigned, COST_PROPERTY)
         if only_provisioned:
-            licenses = filter(lambda _license: self.is_license_only_provisioned(_license), licenses)
-
+            plan.add_filter('only provisioned', self.is_license_only_provisioned, COST_PROPERTY)
         if not_usable:
-            licenses = filter(lambda _license: self.is_license_not_usable(_license), licenses)
+            plan.add_filter('not usable', self.is_license_not_usable, COST_PROPERTY)
 
+        licenses = plan.execute(self._licenses_by_uuid)
+        if plan.seconds > SLOW_PLAN_SECONDS:
+            MODULE.process('Slow license search: ' + plan.explain())
+
+        if sort_key is not None:
+            return SortedView(
+                licenses, lambda _license: (sort_value(sort_key(_license)), _license.entryUUID), descending)
         if sizelimit:
             if len(licenses) > sizelimit:
                 raise SearchLimitReached
 
         return licenses
 
+    def count_assignments(self, license):
+        """Update the counters of the assignments of the license.
+
+        They are computed when the cache is loaded and after the assignments of the license changed
+        (see cache_single_license() and apply_license_changes()), so the filters don't have to walk
+        the assignments.
+
+        @type license: LdapLicense
+        """
+        license.assignment_counts = collections.Counter()
+        license.assignee_uuids = set()
+        license.orphaned_assignments = 0
+        for assignment in self.get_assignments_by_license(license):
+            status = assignment.bildungsloginAssignmentStatus
+            license.assignment_counts[status] += 1
+            if status in [Status.ASSIGNED, Status.PROVISIONED]:
+                license.assignee_uuids.add(assignment.bildungsloginAssignmentAssignee)
+            assignee = assignment.bildungsloginAssignmentAssignee
+            if status != Status.AVAILABLE and not self.get_user_by_uuid(assignee):
+                license.orphaned_assignments += 1
+
+    def aggregate_products(self, school, license_types=None):
+        # type: (str, List[str] | None) -> Dict[str, ProductAggregate]
+        """Return the aggregates of the licenses of the school by product id, see aggregate_licenses()."""
+        uuids = self._get_license_uuids('bildungsloginLicenseSchool', [school])
+        if license_types:
+            uuids = uuids.intersection(self._get_license_uuids('bildungsloginLicenseType', license_types))
+        return aggregate_licenses(self._licenses_by_uuid[uuid] for uuid in uuids if uuid in self._licenses_by_uuid)
+
     def is_license_not_usable(self, license):
         """
 
@@ -894,31 +1079,17 @@ class LdapRepository:
         if hasattr(license, 'volume_quantity') and license.volume_quantity == 0:
             return True
         if license.bildungsloginLicenseType == LicenseType.SINGLE:
-            assignments = self.get_assignments_by_license(license)
-            # single licenses only have one assignment
-            assignment = assignments[0]
-            if assignment.bildungsloginAssignmentStatus != Status.AVAILABLE:
-                return not bool(self.get_user_by_uuid(assignment.bildungsloginAssignmentAssignee))
+            # single licenses only have one assignment, it is not usable if its user is gone
+            return license.orphaned_assignments > 0
         return False
 
     def is_license_only_assigned(self, license):
         if license.bildungsloginLicenseType in [LicenseType.SCHOOL, LicenseType.WORKGROUP]:
             return False
+        return license.assignment_counts[Status.ASSIGNED] > 0
 
-        assignments = self.get_assignments_by_license(license)
-        for assignment in assignments:
-            if assignment.bildungsloginAssignmentStatus == Status.ASSIGNED:
-                return True
-
-        return False
-    
     def is_license_only_provisioned(self, license):
-        assignments = self.get_assignments_by_license(license)
-        for assignment in assignments:
-            if assignment.bildungsloginAssignmentStatus == Status.PROVISIONED:
-                return True
-
-        return False
+        return license.assignment_counts[Status.PROVISIONED] > 0
 
     def get_metadata_by_product_id(self, product_id):
         return self._metadata_by_productid.get(product_id)
@@ -937,20 +1108,10 @@ class LdapRepository:
         return self._classes_by_cn.get(name)
 
     def get_workgroup_names_by_user(self, user):
-        groups = []
-
-        for group in self._workgroups_by_uuid.values():
-            if user.uid in group.memberUid:
-                groups.append(group.cn.split('-')[1])
-        return groups
+        return [group.cn.split('-')[1] for group in self._workgroups_grouped_by_uid.get(user.uid, [])]
 
     def get_class_names_by_user(self, user):
-        groups = []
-
-        for group in self._classes_by_uuid.values():
-            if user.uid in group.memberUid:
-                groups.append(group.cn.split('-')[1])
-        return groups
+        return [group.cn.split('-')[1] for group in self._classes_grouped_by_uid.get(user.uid, [])]
 
     def get_workgroup_by_dn(self, dn):
         return self._workgroups_by_dn.get(dn)
@@ -959,7 +1120,7 @@ class LdapRepository:
         return self._classes_by_dn.get(dn)
 
     def get_group_by_uuid(self, entry_uuid):
-        return dict((group.entryUUID, group) for group in self.groups).get(entry_uuid)
+        return self._groups_by_uuid.get(entry_uuid)
 
     def get_workgroup_by_uuid(self, entry_uuid):
         return self._workgroups_by_uuid.get(entry_uuid)
@@ -989,32 +1150,21 @@ class LdapRepository:
         return self._schools_by_ou.get(name)
 
     def get_classes_by_school(self, school):
-        classes = []
-        for _class in self._classes_by_uuid.values():
-            if _class.ucsschoolRole == "school_class:school:" + school:
-                classes.append(_class)
-        return classes
+        return list(self._classes_grouped_by_school.get(school, []))
 
     def get_classes(self, school, user):
-        classes = []
-        for _class in self._classes_by_uuid.values():
-            if _class.ucsschoolRole == "school_class:school:" + school.ou and user.uid in _class.memberUid:
-                classes.append(_class)
-        return classes
+        # the classes of the user are few, they are looked up by uid and then checked for the school
+        role = CLASS_ROLE_PREFIX + school.ou
+        return [
+            _class for _class in self._classes_grouped_by_uid.get(user.uid, []) if _class.ucsschoolRole == role]
 
     def get_workgroups_by_school(self, school):
-        workgroups = []
-        for workgroup in self._workgroups_by_uuid.values():
-            if workgroup.ucsschoolRole == "workgroup:school:" + school:
-                workgroups.append(workgroup)
-        return workgroups
+        return list(self._workgroups_grouped_by_school.get(school, []))
 
     def get_workgroups(self, school, user):
-        workgroups = []
-        for workgroup in self._workgroups_by_uuid.values():
-            if workgroup.ucsschoolRole == "workgroup:school:" + school.ou and user.uid in workgroup.memberUid:
-                workgroups.append(workgroup)
-        return workgroups
+        role = WORKGROUP_ROLE_PREFIX + school.ou
+        return [workgroup for workgroup in self._workgroups_grouped_by_uid.get(user.uid, [])
+                if workgroup.ucsschoolRole == role]
 
     def get_all_workgroups(self):
         return list(self._workgroups_by_uuid.values())
@@ -1117,19 +1267,12 @@ class LdapRepository:
         return self._classes_grouped_by_uid.get(user.userId, [])
 
     def get_users_by_group(self, group):
-        users = []
-        for user in self._users_by_uuid.values():
-            if user.userId in group.memberUid:
-                users.append(user)
-
-        return users
+        return [self._users_by_uid[uid] for uid in group.memberUid if uid in self._users_by_uid]
 
     def add_user_to_license(self, license, user):
         if license.bildungsloginLicenseSpecialType != 'Lehrkraft' or (
                 license.bildungsloginLicenseSpecialType == 'Lehrkraft' and 'teacher' in user.get_roles()):
-            license.user_strings.append(user.uid)
-            license.user_strings.append(user.givenName)
-            license.user_strings.append(user.sn)
+            self._add_license_user(license, user.uid)
             license.quantity_assigned += 1
             return True
         return False
@@ -1137,9 +1280,7 @@ class LdapRepository:
     def remove_user_from_license(self, license, user):
         if license.bildungsloginLicenseSpecialType != 'Lehrkraft' or (
                 license.bildungsloginLicenseSpecialType == 'Lehrkraft' and 'teacher' in user.get_roles()):
-            license.user_strings.remove(user.uid)
-            license.user_strings.remove(user.givenName)
-            license.user_strings.remove(user.sn)
+            self._remove_license_user(license, user.uid)
             license.quantity_assigned -= 1
 
     def add_assignments(self, license_codes, object_type, object_names):
@@ -1273,10 +1414,11 @@ class LdapRepository:
     def get_class_by_uuid(self, uuid):
         return self._classes_by_uuid.get(uuid)
 
-    def _get_license_cache_file(self, entry_uuid):
-        return open(JSON_DIR + 'schools/' + self._current_school + '/license-' + entry_uuid + '.json', 'w')
+    def _append_journal(self, record):
+        append_journal(JSON_DIR + 'schools/' + self._current_school + '/cache.json', record)
 
     def cache_single_license(self, _license, assignments=None):
+        self.count_assignments(_license)
         if not assignments:
             assignments = self.get_assignments_by_license(_license)
 
@@ -1284,9 +1426,7 @@ class LdapRepository:
             'license': _license.get_cache_dictionary(),
             'assignments': [assignment.get_cache_dictionary() for assignment in assignments]
         }
-        license_file = self._get_license_cache_file(_license.entryUUID)
-        json.dump(to_save, license_file)
-        license_file.close()
+        self._append_journal(to_save)
 
     def delete_licenses(self, license_codes):
         licenses = []
@@ -1299,9 +1439,7 @@ class LdapRepository:
                 'license': _license.get_cache_dictionary(),
                 'assignments': [assignment.get_cache_dictionary() for assignment in assignments]
             }
-            license_file = self._get_license_cache_file(_license.entryUUID)
-            json.dump(to_save, license_file)
-            license_file.close()
+            self._append_journal(to_save)
         return licenses
 
     def cache_date(self):
@@ -1315,15 +1453,158 @@ class LdapRepository:
     def users_has_medium(self, school, medium, users):
         users = list(self.get_user(user) for user in users)
         licenses = self.get_licenses_by_product_id(medium, school)
-        entry_uuids = []
+        entry_uuids = set()
         result = []
         for license in licenses:
             if license.bildungsloginLicenseType in [LicenseType.SINGLE, LicenseType.VOLUME]:
-                assignments = self.get_assignments_by_license(license)
-                for assignment in assignments:
-                    if assignment.bildungsloginAssignmentStatus in [Status.ASSIGNED, Status.PROVISIONED]:
-                        entry_uuids.append(assignment.bildungsloginAssignmentAssignee)
+                entry_uuids.update(license.assignee_uuids)
         for user in users:
             if user.entryUUID in entry_uuids:
                 result.append(user.uid)
         return result
+
+
+class RepositoryCache:
+    """The LdapRepository objects of the recently used schools, least recently used first.
+
+    update() makes the repository of the school the current one, every other attribute is looked
+    up in the current repository. Each repository checks the generation of its cache file on its
+    own. If the repositories hold more than max_objects objects together, the least recently used
+    ones are dropped, the current one is always kept.
+
+    If a CacheRefresher was started, changed cache files are loaded by it in the background and
+    update() only applies the journal to the loaded snapshot.
+    """
+
+    def __init__(self, max_objects):
+        self._repositories = collections.OrderedDict()  # type: Dict[str, LdapRepository]
+        self._lock = threading.Lock()
+        self._current = LdapRepository()
+        self._refresher = None
+        self.max_objects = max_objects
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refreshes = 0
+
+    def start_refresher(self, interval):
+        self._refresher = CacheRefresher(self, interval)
+        self._refresher.start()
+
+    def update(self, school, start_up=False):
+        if not school:
+            school = self._current._current_school
+            if not school:
+                self._current.update(school, start_up)
+                return
+
+        with self._lock:
+            repository = self._repositories.pop(school, None)
+            if repository is not None:
+                self._repositories[school] = repository
+        if repository is None:
+            self.misses += 1
+            repository = LdapRepository()
+            repository.update(school, start_up)
+            if not repository.is_loaded():
+                # the cache file of the school is missing (only possible with start_up, otherwise update()
+                # raises), the previous repository stays the current one and nothing is cached
+                return
+            with self._lock:
+                self._repositories[school] = repository
+                self._evict()
+        else:
+            self.hits += 1
+            repository.update(school, start_up, reload=self._refresher is None)
+        self._current = repository
+
+    def refresh(self):
+        """Load the changed cache files of the cached schools and replace their repositories."""
+        with self._lock:
+            repositories = list(self._repositories.items())
+        for school, repository in repositories:
+            if not repository.is_stale():
+                continue
+            new_repository = LdapRepository()
+            new_repository.update(school, start_up=True)
+            if not new_repository.is_loaded():
+                # the cache file was removed in the meantime, the old snapshot is kept
+                continue
+            with self._lock:
+                # the next update() of the school makes the new repository the current one
+                if self._repositories.get(school) is repository:
+                    self._repositories[school] = new_repository
+                    self.refreshes += 1
+            MODULE.info('Reloaded the cache of school %s in the background' % (school,))
+
+    def _evict(self):
+        objects = dict((school, repository.count_objects()) for school, repository in self._repositories.items())
+        total = sum(objects.values())
+        while total > self.max_objects and len(self._repositories) > 1:
+            school, repository = self._repositories.popitem(last=False)
+            total -= objects[school]
+            self.evictions += 1
+            MODULE.info('Dropped the cache of school %s with %d objects' % (school, objects[school]))
+
+    def statistics(self):
+        with self._lock:
+            repositories = list(self._repositories.items())
+        return {
+            'schools': [school for school, repository in repositories],
+            'objects': sum(repository.count_objects() for school, repository in repositories),
+            'max_objects': self.max_objects,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'refreshes': self.refreshes,
+            'watching': self._refresher.watching if self._refresher else None,
+        }
+
+    def __getattr__(self, name):
+        return getattr(self._current, name)
+
+
+class CacheRefresher(threading.Thread):
+    """Let the RepositoryCache load changed cache files in the background.
+
+    The schools directory is watched with inotify (if pyinotify is installed), files renamed into
+    it wake the thread up. Without inotify, or if nothing happens, it checks every interval seconds.
+    """
+
+    def __init__(self, repositories, interval):
+        super(CacheRefresher, self).__init__(name='CacheRefresher')
+        self.daemon = True
+        self.repositories = repositories
+        self.interval = interval
+        self.watching = False
+        self._watch_manager = None
+        self._notifier = None
+
+    def _watch(self):
+        """Watch the schools directory, once it exists."""
+        if pyinotify is None or self.watching or not os.path.isdir(JSON_DIR + 'schools'):
+            return
+        if self._watch_manager is None:
+            self._watch_manager = pyinotify.WatchManager()
+        watches = self._watch_manager.add_watch(
+            JSON_DIR + 'schools', pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE, rec=True, auto_add=True, quiet=True)
+        if watches and all(descriptor > 0 for descriptor in watches.values()):
+            self._notifier = pyinotify.Notifier(self._watch_manager, lambda event: None)
+            self.watching = True
+
+    def _wait(self):
+        self._watch()
+        if self._notifier is None:
+            time.sleep(self.interval)
+        elif self._notifier.check_events(self.interval * 1000):
+            self._notifier.read_events()
+            self._notifier.process_events()
+
+    def run(self):
+        while True:
+            try:
+                self._wait()
+                self.repositories.refresh()
+            except Exception as exc:
+                MODULE.error('Refreshing the cache failed: %s' % (exc,))
+                time.sleep(self.interval)
@@ -0,0 +1,385 @@
+"""Readers of the cache file formats written by bildungslogin_build_ucs_school_api_cache.py.
+
+The cache builder writes every cache.json together with a binary sidecar (cache.bin). Reading it
+needs no JSON parsing: the file is mapped into memory and the records are decoded one at a time
+while they are iterated. Every distinct string is decoded only once.
+
+With '--dictionary-encoding' the cache.json itself is dictionary encoded:
+
+    {"encoding": "dictionary", "strings": [...], "sections": {"users": {"fields": [...], "rows": [...]}}}
+
+Every row is a list with one value per field, strings and lists of strings are given by their
+position in "strings". The decoded records share the strings of the table, so there is only one
+copy of every distinct string in memory.
+
+Binary layout (all numbers little-endian):
+
+    MAGIC | uint32 header size | JSON header | string table | sections
+
+The header holds the position of the string table and, for every section (users, licenses, ...),
+its position, number of records and the names and types of its fields. Positions are relative to
+the end of the header. The string table is a list of uint32 end offsets followed by the UTF-8 data
+of all strings. A section is a sequence of records, each prefixed with its size as uint32. In a
+record, a field of type 's' is a string number, 'l' a uint32 count followed by string numbers and
+'i' an int64. Missing values are stored as MISSING (MISSING_INT for 'i').
+
+The builder replaces the files by renaming complete temporary files while it holds the exclusive
+flock() of the lock file next to them (cache.lock) and increments the number in cache.generation.
+Readers try to take the lock shared without blocking: if they get it, they read the generation and
+open the files, the opened files stay valid when they are replaced.
+
+The UMC module records the licenses it changes in the journal of the school (cache.journal), while
+it holds the lock shared. The journal is a sequence of records, each a uint32 size followed by a
+UTF-8 JSON object. Readers remember the offset after the last record they applied and only read
+the records after it. When the builder replaces a cache file, it drops the records it fetched from
+LDAP in the same step, so the journal belongs to the generation of the cache file.
+"""
+import contextlib
+import errno
+import fcntl
+import json
+import mmap
+import os
+import struct
+
+from univention.management.console.log import MODULE
+
+MAGIC = b'BLCACHE1'
+DICTIONARY_ENCODING = 'dictionary'
+MISSING = 0xFFFFFFFF
+MISSING_INT = -2 ** 63
+
+_UINT = struct.Struct('<I')
+_INT = struct.Struct('<q')
+
+
+class BinaryCacheError(Exception):
+    pass
+
+
+def get_binary_path(json_path):
+    return os.path.splitext(json_path)[0] + '.bin'
+
+
+def compile_fields(fields):
+    """Return the steps to decode a record with the given fields.
+
+    Consecutive fields of fixed size are decoded with a single struct, a list field needs a step of
+    its own.
+
+    >>> [(kind, names, unpacker and unpacker.format) for kind, names, unpacker
+    ...  in compile_fields([['a', 's'], ['b', 'i'], ['c', 'l'], ['d', 's']])]
+    [('fixed', [('a', 's'), ('b', 'i')], '<Iq'), ('list', [('c', 'l')], None), ('fixed', [('d', 's')], '<I')]
+    """
+    steps = []
+    for name, kind in fields:
+        if kind == 'l':
+            steps.append(('list', [(name, kind)], None))
+        elif kind in ('s', 'i'):
+            if not steps or steps[-1][0] != 'fixed':
+                steps.append(('fixed', [], None))
+            steps[-1][1].append((name, kind))
+        else:
+            raise BinaryCacheError('Unknown field type %r of field %r' % (kind, name))
+    return [
+        (step, names, struct.Struct('<' + ''.join('I' if kind == 's' else 'q' for name, kind in names))
+            if step == 'fixed' else None)
+        for step, names, unpacker in steps
+    ]
+
+
+class BinaryCacheSection(object):
+    """The records of one section, decoded to dictionaries while iterating."""
+
+    def __init__(self, cache, offset, count, fields):
+        self._cache = cache
+        self._offset = offset
+        self._count = count
+        self._steps = compile_fields(fields)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        offset = self._offset
+        for _ in range(self._count):
+            (size,) = _UINT.unpack_from(self._cache.buffer, offset)
+            yield self._decode(offset + _UINT.size)
+            offset += _UINT.size + size
+
+    def _decode(self, offset):
+        buffer = self._cache.buffer
+        strings = self._cache.strings
+        get_string = self._cache.get_string
+        record = {}
+        for step, names, unpacker in self._steps:
+            if step == 'fixed':
+                values = unpacker.unpack_from(buffer, offset)
+                offset += unpacker.size
+                for (name, kind), value in zip(names, values):
+                    if kind == 's':
+                        if value != MISSING:
+                            record[name] = strings[value] or get_string(value)
+                    elif value != MISSING_INT:
+                        record[name] = value
+            else:
+                (count,) = _UINT.unpack_from(buffer, offset)
+                offset += _UINT.size
+                if count != MISSING:
+                    numbers = struct.unpack_from('<%dI' % count, buffer, offset)
+                    offset += _UINT.size * count
+                    record[names[0][0]] = [strings[number] or get_string(number) for number in numbers]
+        return record
+
+
+class BinaryCache(object):
+    """A memory mapped binary cache file, used like the dictionary loaded from cache.json."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if self.buffer[:len(MAGIC)] != MAGIC:
+                raise BinaryCacheError('%s is not a binary cache file' % (path,))
+            (header_size,) = _UINT.unpack_from(self.buffer, len(MAGIC))
+            header_offset = len(MAGIC) + _UINT.size
+            header = json.loads(self.buffer[header_offset:header_offset + header_size].decode('utf-8'))
+            body_offset = header_offset + header_size
+            string_offset, string_count = header['strings']
+            string_offset += body_offset
+            self._string_ends = struct.unpack_from('<%dI' % string_count, self.buffer, string_offset)
+            self._string_data = string_offset + _UINT.size * string_count
+            self.strings = [None] * string_count
+            self._sections = dict(
+                (name, BinaryCacheSection(
+                    self, body_offset + section['offset'], section['count'], section['fields']))
+                for name, section in header['sections'].items()
+            )
+        except (KeyError, TypeError, ValueError, struct.error) as exc:
+            self.close()
+            raise BinaryCacheError('Invalid binary cache file %s: %s' % (path, exc))
+
+    def get_string(self, number):
+        """Return the string with the given number, decoded on first use."""
+        string = self.strings[number]
+        if string is None:
+            start = self._string_ends[number - 1] if number else 0
+            string = self.buffer[self._string_data + start:self._string_data + self._string_ends[number]]
+            string = self.strings[number] = string.decode('utf-8')
+        return string
+
+    def __getitem__(self, name):
+        return self._sections.get(name, ())
+
+    def get(self, name, default=None):
+        return self._sections.get(name, default)
+
+    def keys(self):
+        return self._sections.keys()
+
+    def close(self):
+        self.buffer.close()
+
+
+class DictionaryEncodedSection(object):
+    """The rows of one section of a dictionary encoded cache.json, decoded while iterating."""
+
+    def __init__(self, strings, fields, rows):
+        self._strings = strings
+        self._fields = fields
+        self._rows = rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __iter__(self):
+        strings = self._strings
+        fields = self._fields
+        for row in self._rows:
+            record = {}
+            for (name, kind), value in zip(fields, row):
+                if value is None:
+                    continue
+                if kind == 's':
+                    record[name] = strings[value]
+                elif kind == 'l':
+                    record[name] = [strings[number] for number in value]
+                else:
+                    record[name] = value
+            yield record
+
+
+class DictionaryEncodedCache(object):
+    """The contents of a dictionary encoded cache.json, used like the dictionary of a plain one."""
+
+    def __init__(self, entries):
+        strings = entries['strings']
+        self._sections = dict(
+            (name, DictionaryEncodedSection(strings, section['fields'], section['rows']))
+            for name, section in entries['sections'].items()
+        )
+
+    def __getitem__(self, name):
+        return self._sections.get(name, ())
+
+    def get(self, name, default=None):
+        return self._sections.get(name, default)
+
+    def keys(self):
+        return self._sections.keys()
+
+
+def open_cache(json_path):
+    """Open the cache file at json_path and return a function which returns its entries.
+
+    They are read from the binary sidecar if it is at least as new as the JSON file, otherwise (or if
+    the binary file can't be read) from the plain or dictionary encoded JSON file. Only opening the
+    files needs the lock, the returned function can parse them after it was released.
+    """
+    binary_path = get_binary_path(json_path)
+    if os.path.exists(binary_path) and os.stat(binary_path).st_mtime >= os.stat(json_path).st_mtime:
+        try:
+            cache = BinaryCache(binary_path)
+            return lambda: cache
+        except (BinaryCacheError, EnvironmentError) as exc:
+            MODULE.warn('Falling back to %s: %s' % (json_path, exc))
+    json_file = open(json_path, 'r')
+
+    def load():
+        with json_file:
+            entries = json.load(json_file)
+        if entries.get('encoding') == DICTIONARY_ENCODING:
+            return DictionaryEncodedCache(entries)
+        return entries
+    return load
+
+
+def get_lock_path(json_path):
+    return os.path.splitext(json_path)[0] + '.lock'
+
+
+def get_generation_path(json_path):
+    return os.path.splitext(json_path)[0] + '.generation'
+
+
+def read_generation(json_path):
+    """Return the generation of the cache file at json_path, 0 if the builder didn't write one."""
+    try:
+        with open(get_generation_path(json_path)) as f:
+            return int(f.read())
+    except (IOError, ValueError):
+        return 0
+
+
+def _flock(fd, operation):
+    """Return whether the lock was taken, False if operation is non-blocking and the lock is held."""
+    try:
+        fcntl.flock(fd, operation)
+    except IOError as exc:
+        if exc.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def shared_lock(json_path):
+    """Try to take the lock of the cache file at json_path shared, without blocking.
+
+    Yields whether the lock was taken. True is also yielded if there is no lock file, because then
+    the builder never wrote the cache file.
+    """
+    try:
+        fd = os.open(get_lock_path(json_path), os.O_RDONLY)
+    except OSError:
+        yield True
+        return
+    try:
+        yield _flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def file_lock(path, operation=fcntl.LOCK_SH):
+    """Hold the lock of the lock file at path (created if needed) while the block runs."""
+    fd = os.open(path, os.O_RDONLY | os.O_CREAT, 0o644)
+    try:
+        _flock(fd, operation)
+        yield
+    finally:
+        os.close(fd)
+
+
+def is_locked(path):
+    """Return whether another process holds the lock of the lock file at path exclusively."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        return not _flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    finally:
+        os.close(fd)
+
+
+def get_journal_path(json_path):
+    return os.path.splitext(json_path)[0] + '.journal'
+
+
+def append_journal(json_path, record):
+    """Append the record to the journal of the cache file at json_path.
+
+    The appending processes hold the journal exclusively, the builder is kept out by the lock of the
+    cache file.
+    """
+    data = json.dumps(record).encode('utf-8')
+    data = _UINT.pack(len(data)) + data
+    with file_lock(get_lock_path(json_path)):
+        fd = os.open(get_journal_path(json_path), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+
+
+def read_journal(json_path, offset=0):
+    """Return the records of the journal of the cache file at json_path after offset, and the new offset.
+
+    A record which is still being appended is left for the next call.
+
+    >>> import tempfile
+    >>> json_path = os.path.join(tempfile.mkdtemp(), 'cache.json')
+    >>> read_journal(json_path)
+    ([], 0)
+    >>> append_journal(json_path, {'license': {'entryUUID': 'a'}})
+    >>> append_journal(json_path, {'license': {'entryUUID': 'b'}, 'deleted': True})
+    >>> records, offset = read_journal(json_path)
+    >>> [record['license']['entryUUID'] for record in records] == ['a', 'b']
+    True
+    >>> offset == os.stat(get_journal_path(json_path)).st_size
+    True
+    >>> with open(get_journal_path(json_path), 'ab') as f:
+    ...     _ = f.write(_UINT.pack(10) + b'{"lic')
+    >>> read_journal(json_path, offset) == ([], offset)
+    True
+    """
+    try:
+        with open(get_journal_path(json_path), 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+    except IOError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+        return [], offset
+    records = []
+    position = 0
+    while position + _UINT.size <= len(data):
+        end = position + _UINT.size + _UINT.unpack_from(data, position)[0]
+        if end > len(data):
+            break
+        records.append(json.loads(data[position + _UINT.size:end].decode('utf-8')))
+        position = end
+    return records, offset + position
@@ -1,3 +1,6 @@
 JSON_PATH = '/var/lib/univention-appcenter/apps/ucsschool-apis/data/bildungslogin.json'
 JSON_DIR = '/var/lib/univention-appcenter/apps/ucsschool-apis/data/'
-CACHE_BUILD_SCRIPT = '/usr/sbin/bildungslogin_build_ucs_school_api_cache.py'
\ No newline at end of file
+CACHE_PROGRESS_PATH = JSON_DIR + 'cache_progress.json'
+CACHE_BUILD_LOCK_PATH = JSON_DIR + 'cache_build.lock'
+CACHE_BUILD_SCRIPT = '/usr/sbin/bildungslogin_build_ucs_school_api_cache.py'
+EXPORT_SPOOL_DIR = '/var/cache/ucs-school-umc-licenses/exports/'
\ No newline at end of file
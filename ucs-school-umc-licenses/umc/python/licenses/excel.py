@@ -0,0 +1,26 @@
+"""Excel exports of the UMC module.
+
+The rows of an export are written to a workbook in constant_memory mode. xlsxwriter flushes every
+row to a temporary file as soon as the next row is written, so the rows can be generated one by
+one and the memory used by an export doesn't grow with the number of its rows.
+"""
+from .xlsxwriter import Workbook
+
+COLUMN_WIDTH = 25
+
+
+def write_worksheet(path, columns, rows):
+    """Write a workbook with the header columns and the rows, an iterable of lists of cell values.
+
+    The rows have to be generated in order, a row can't be changed once the next one was written.
+    Return the number of rows.
+    """
+    workbook = Workbook(path, {'constant_memory': True})
+    worksheet = workbook.add_worksheet()
+    worksheet.set_column(0, len(columns) - 1, COLUMN_WIDTH)
+    worksheet.write_row(0, 0, columns, workbook.add_format({'bold': True}))
+    row_num = 0
+    for row_num, row in enumerate(rows, 1):
+        worksheet.write_row(row_num, 0, row)
+    workbook.close()
+    return row_num
@@ -0,0 +1,149 @@
+"""Export jobs of the UMC module.
+
+A large Excel export can take longer than the UMC request which starts it. ExportSpool builds the
+exports in a worker thread, one after another, and keeps their state, so the client can poll
+the progress of the job and download the file once it is done. The files are written to a
+spool directory, a file is removed after it was downloaded or ttl seconds after it was finished.
+
+The rows of a job are generated by the worker, they must not iterate over the indexes of the
+repository, which the requests change in the meantime. The request selects the objects and the
+job only formats them.
+"""
+import os
+import random
+import string
+import threading
+import time
+
+from six.moves import queue
+from typing import Dict
+from univention.management.console.log import MODULE
+
+from .excel import write_worksheet
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class ExportJob(object):
+    """An export of rows with the header columns, its id is the name of the file in the spool."""
+
+    def __init__(self, prefix, columns, rows, total=None):
+        self.id = prefix + '_' + ''.join(random.choice(string.ascii_letters) for _ in range(0, 20)) + '.xlsx'
+        self.columns = columns
+        self.rows = rows
+        self.total = total  # the number of rows, if known in advance
+        self.rows_written = 0
+        self.state = QUEUED
+        self.error = None
+        self.finished = None
+
+    def iter_rows(self):
+        """Generate the rows of the job and count them."""
+        for row in self.rows:
+            self.rows_written += 1
+            yield row
+
+    def get_status(self):
+        return {
+            'id': self.id,
+            'state': self.state,
+            'rows': self.rows_written,
+            'total': self.total,
+        }
+
+
+class ExportSpool(object):
+    """The export jobs of the module process and their files in directory."""
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+        self._jobs = {}  # type: Dict[str, ExportJob]
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = None
+
+    def get_path(self, job):
+        return os.path.join(self.directory, job.id)
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def create(self, prefix, columns, rows, total=None):
+        self.cleanup()
+        job = ExportJob(prefix, columns, rows, total)
+        with self._lock:
+            self._jobs[job.id] = job
+        return job
+
+    def submit(self, job):
+        """Let the worker thread build the export of the job."""
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._work, name='ExportWorker')
+                self._worker.daemon = True
+                self._worker.start()
+        self._queue.put(job)
+
+    def run(self, job):
+        """Build the export of the job in the current thread."""
+        job.state = RUNNING
+        start = time.time()
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory, 0o700)
+            write_worksheet(self.get_path(job), job.columns, job.iter_rows())
+        except Exception as exc:
+            MODULE.error('Export %s failed: %s' % (job.id, exc))
+            job.error = str(exc)
+            job.state = FAILED
+            self._remove_file(job)
+        else:
+            MODULE.info('Exported %d rows to %s in %.1f s' % (job.rows_written, job.id, time.time() - start))
+            job.state = DONE
+        finally:
+            job.rows = None
+            job.finished = time.time()
+
+    def _work(self):
+        while True:
+            self.run(self._queue.get())
+
+    def remove(self, job):
+        """Forget the job and remove its file."""
+        with self._lock:
+            self._jobs.pop(job.id, None)
+        self._remove_file(job)
+
+    def _remove_file(self, job):
+        try:
+            os.remove(self.get_path(job))
+        except OSError:
+            pass
+
+    def cleanup(self):
+        """Remove the jobs which finished more than ttl seconds ago and the expired files in the spool.
+
+        Files without job are left over from previous module processes.
+        """
+        expired = time.time() - self.ttl
+        with self._lock:
+            jobs = [job for job in self._jobs.values() if job.finished is not None and job.finished < expired]
+            known = set(self._jobs)
+        for job in jobs:
+            self.remove(job)
+        try:
+            filenames = os.listdir(self.directory)
+        except OSError:
+            return
+        for filename in filenames:
+            path = os.path.join(self.directory, filename)
+            try:
+                if filename not in known and os.path.getmtime(path) < expired:
+                    os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,130 @@
+"""Sorted pages of the search results of the UMC module.
+
+licenses_query() and users_list() can return one page of their results instead of all of them. The
+repository wraps the results in a SortedView. It only computes the sort keys and selects the
+objects of the requested page, so the UMC module formats only the rows which are displayed.
+
+A page is selected by an offset or by a cursor. The cursor holds the sort key of the last object
+of the previous page, the next page starts after it even if objects were added or removed in
+between. Every sort key ends with a unique value of the object, so the order is stable.
+"""
+import base64
+import binascii
+import datetime
+import heapq
+import json
+
+import six
+
+
+def sort_value(value):
+    """Return a value of a sort key which can be stored in a cursor.
+
+    >>> print(sort_value(datetime.date(2022, 1, 31)))
+    2022-01-31
+    >>> sort_value(None) == u'' and sort_value(u'Foo') == u'foo' and sort_value(3) == 3
+    True
+    """
+    if value is None:
+        return u''
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return six.text_type(value.isoformat())
+    if isinstance(value, six.string_types):
+        return value.lower()
+    return value
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Return the sort key of a cursor, raise ValueError if it is invalid.
+
+    >>> decode_cursor(encode_cursor([u'foo', 3])) == (u'foo', 3)
+    True
+    >>> decode_cursor('foo')
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid cursor: 'foo'
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(str(cursor).encode('ascii')).decode('utf-8'))
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError('Invalid cursor: {!r}'.format(cursor))
+    if not isinstance(key, list):
+        raise ValueError('Invalid cursor: {!r}'.format(cursor))
+    return tuple(key)
+
+
+class SortedView(object):
+    """The objects sorted by key, which returns a tuple ending with a unique value of the object.
+
+    The objects are only sorted completely if a page without limit or far from the start is
+    requested, otherwise the first objects are selected with a heap.
+
+    >>> view = SortedView(['b3', 'a2', 'c1', 'a1'], lambda obj: (obj[0], obj[1]))
+    >>> len(view)
+    4
+    >>> view.page(limit=2)
+    ['a1', 'a2']
+    >>> view.page(offset=1, limit=2)
+    ['a2', 'b3']
+    >>> view.page(after=decode_cursor(view.cursor('a2')))
+    ['b3', 'c1']
+    >>> SortedView(['b3', 'a2', 'c1', 'a1'], lambda obj: (obj[0], obj[1]), descending=True).page(limit=3)
+    ['c1', 'b3', 'a2']
+    """
+
+    def __init__(self, objects, key, descending=False):
+        self._objects = objects
+        self._key = key
+        self._descending = descending
+        self._keys = None  # list of (sort key, position in objects)
+        self._sorted = None  # self._keys sorted
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __iter__(self):
+        return iter(self.page())
+
+    def _get_keys(self):
+        if self._keys is None:
+            self._keys = [(tuple(self._key(obj)), position) for position, obj in enumerate(self._objects)]
+        return self._keys
+
+    def _select(self, keys, count, is_sorted=False):
+        if is_sorted:
+            return keys[:count]
+        if count is None or count * 4 > len(keys):
+            return sorted(keys, reverse=self._descending)
+        select = heapq.nlargest if self._descending else heapq.nsmallest
+        return select(count, keys)
+
+    def page(self, offset=0, limit=None, after=None):
+        """Return the objects of a page.
+
+        offset -- number of objects to skip
+        limit -- maximal number of objects, all if None
+        after -- the sort key of a cursor, the page starts after the object with that key
+        """
+        end = None if limit is None else offset + limit
+        if after is not None:
+            if self._descending:
+                keys = [item for item in self._get_keys() if item[0] < after]
+            else:
+                keys = [item for item in self._get_keys() if item[0] > after]
+            keys = self._select(keys, end)
+        else:
+            if self._sorted is None and (end is None or end * 4 > len(self._objects)):
+                self._sorted = self._select(self._get_keys(), None)
+            if self._sorted is not None:
+                keys = self._select(self._sorted, end, is_sorted=True)
+            else:
+                keys = self._select(self._get_keys(), end)
+        return [self._objects[position] for key, position in keys[offset:end]]
+
+    def cursor(self, obj):
+        """Return the cursor of the page after obj."""
+        return encode_cursor(tuple(self._key(obj)))
@@ -0,0 +1,81 @@
+"""Query plans of the license search of the UMC module.
+
+LdapRepository.filter_licenses() collects the filters of a search in a QueryPlan. Filters with an
+index are resolved to sets of entryUUIDs, which are intersected starting with the smallest one. The
+remaining filters are only evaluated for the licenses of that intersection, the cheap ones first.
+explain() describes the executed plan with the number of licenses and the time of every step.
+"""
+import time
+
+# estimated costs of evaluating a filter for one license
+COST_ATTRIBUTE = 1  # compare an attribute of the license
+COST_PROPERTY = 2  # compute a property of the license
+
+SLOW_PLAN_SECONDS = 0.5  # the plans taking longer are logged by filter_licenses()
+
+
+class QueryPlan(object):
+    """
+    >>> licenses = dict((uuid, uuid * 2) for uuid in 'abcde')
+    >>> plan = QueryPlan()
+    >>> plan.add_index('vowels', lambda: set('ae'))
+    >>> plan.add_index('first', lambda: set('abc'))
+    >>> plan.add_filter('slow', lambda value: True, COST_PROPERTY)
+    >>> plan.add_filter('not b', lambda value: value != 'bb')
+    >>> plan.execute(licenses)
+    ['aa']
+    >>> [(step['step'], step['name'], step['objects']) for step in plan.steps]
+    [('index', 'vowels', 2), ('index', 'first', 1), ('filter', 'not b', 1), ('filter', 'slow', 1)]
+    """
+
+    def __init__(self):
+        self._indexes = []  # list of (name, function returning a set of keys)
+        self._filters = []  # list of (cost, name, predicate)
+        self.steps = []  # the executed steps, see explain()
+
+    def add_index(self, name, lookup):
+        self._indexes.append((name, lookup))
+
+    def add_filter(self, name, predicate, cost=COST_ATTRIBUTE):
+        self._filters.append((cost, name, predicate))
+
+    def _add_step(self, step, name, objects, seconds):
+        self.steps.append({'step': step, 'name': name, 'objects': objects, 'seconds': seconds})
+
+    def execute(self, objects_by_key):
+        """Return the objects of objects_by_key matching all indexes and filters of the plan."""
+        self.steps = []
+        results = []
+        for name, lookup in self._indexes:
+            start = time.time()
+            keys = lookup()
+            results.append((len(keys), name, keys, time.time() - start))
+        results.sort(key=lambda result: result[0])
+
+        keys = None
+        for size, name, index_keys, seconds in results:
+            start = time.time()
+            keys = set(index_keys) if keys is None else keys.intersection(index_keys)
+            self._add_step('index', name, len(keys), seconds + time.time() - start)
+        if keys is None:
+            objects = list(objects_by_key.values())
+        else:
+            objects = [objects_by_key[key] for key in keys if key in objects_by_key]
+
+        # sorted() is stable, filters with the same cost keep their order
+        for cost, name, predicate in sorted(self._filters, key=lambda _filter: _filter[0]):
+            start = time.time()
+            objects = [obj for obj in objects if predicate(obj)]
+            self._add_step('filter', name, len(objects), time.time() - start)
+        return objects
+
+    @property
+    def seconds(self):
+        """The time of all executed steps."""
+        return sum(step['seconds'] for step in self.steps)
+
+    def explain(self):
+        """Return a description of the executed steps with their results and timings."""
+        return ', '.join(
+            '{step} {name}: {objects} ({milliseconds:.1f} ms)'.format(milliseconds=step['seconds'] * 1000, **step)
+            for step in self.steps)
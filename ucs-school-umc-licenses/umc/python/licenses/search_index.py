@@ -0,0 +1,161 @@
+"""Indexes for the wildcard searches of the UMC module.
+
+The search fields of the UMC module take patterns with '*' as wildcard, which are turned into
+regular expressions and matched from the start of the searched values (see LdapRepository). A
+WildcardIndex returns the keys of the objects which can match such a pattern, so only those have to
+be matched with the regular expression. It holds the lower-cased values sorted for patterns
+starting with a literal prefix and their trigrams for the literal parts of the other patterns.
+Searches which ignore the case, like the ones of the license search, can be resolved completely by
+the index with search().
+
+A RangeIndex holds the keys of objects sorted by a value like a date, to look up the objects with a
+value in a range by bisection.
+"""
+import bisect
+import collections
+import re
+
+# characters which make the literal parts of a pattern unreliable, such patterns are not indexed
+_UNSUPPORTED = frozenset('\\|()[]{}')
+# characters of the regular expression which match other characters than themselves
+_BREAKS = frozenset('*.^$')
+# quantifiers make the previous character optional or repeat it
+_QUANTIFIERS = frozenset('+?')
+
+
+def split_pattern(pattern):
+    """Return the lower-cased literal parts of the pattern and whether the first one is a prefix.
+
+    None is returned if the pattern contains parts of regular expressions which aren't supported.
+
+    >>> split_pattern('*Max*mu')
+    (['max', 'mu'], False)
+    >>> split_pattern('ab?cd.ef*')
+    (['a', 'cd', 'ef'], True)
+    >>> split_pattern('*')
+    ([], False)
+    >>> split_pattern('a(b)') is None
+    True
+    """
+    if any(char in _UNSUPPORTED for char in pattern):
+        return None
+    parts = []
+    part = ''
+    for char in pattern:
+        if char in _QUANTIFIERS:
+            part = part[:-1]
+            char = '*'
+        if char in _BREAKS:
+            parts.append(part)
+            part = ''
+        else:
+            part += char
+    parts.append(part)
+    return [part.lower() for part in parts if part], bool(parts[0])
+
+
+def get_trigrams(value):
+    return set(value[i:i + 3] for i in range(len(value) - 2))
+
+
+class WildcardIndex(object):
+    """Index of the string values of objects, see candidates().
+
+    >>> index = WildcardIndex([('u1', ['anna', 'Schmidt']), ('u2', ['ben', 'Schmitz']), ('u3', ['Carl', 'Ann'])])
+    >>> sorted(index.candidates('ann'))
+    ['u1', 'u3']
+    >>> sorted(index.candidates('*chmi*'))
+    ['u1', 'u2']
+    >>> sorted(index.candidates('*chm*idt'))
+    ['u1']
+    >>> index.candidates('*a*') is None
+    True
+    >>> index.add('u4', ['Annabell'])
+    >>> sorted(index.candidates('Anna*'))
+    ['u1', 'u4']
+    >>> sorted(index.search('ANN'))
+    ['u1', 'u3', 'u4']
+    """
+
+    def __init__(self, objects=()):
+        self._values = []  # sorted list of (lower-cased value, key)
+        self._values_by_key = {}
+        self._trigrams = collections.defaultdict(set)
+        for key, values in objects:
+            self._add(key, values)
+        self._values.sort()
+
+    def _add(self, key, values):
+        for value in values:
+            if value is None:
+                continue
+            value = value.lower()
+            self._values.append((value, key))
+            self._values_by_key.setdefault(key, []).append(value)
+            for trigram in get_trigrams(value):
+                self._trigrams[trigram].add(key)
+
+    def add(self, key, values):
+        self._add(key, values)
+        self._values.sort()
+
+    def _keys_with_prefix(self, prefix):
+        keys = set()
+        for value, key in self._values[bisect.bisect_left(self._values, (prefix,)):]:
+            if not value.startswith(prefix):
+                break
+            keys.add(key)
+        return keys
+
+    def candidates(self, pattern):
+        """Return the keys of the objects with a value which can match the pattern.
+
+        The result is a superset, the values still have to be matched. None is returned if the pattern
+        can't be narrowed down with the index, then all objects have to be matched.
+        """
+        split = split_pattern(pattern)
+        if split is None:
+            return None
+        parts, is_prefix = split
+        keys = None
+        if is_prefix:
+            keys = self._keys_with_prefix(parts[0])
+        for part in parts:
+            for trigram in get_trigrams(part):
+                trigram_keys = self._trigrams.get(trigram, ())
+                keys = set(trigram_keys) if keys is None else keys.intersection(trigram_keys)
+                if not keys:
+                    return keys
+        return keys
+
+    def search(self, pattern):
+        """Return the keys of the objects with a value matching the pattern, ignoring the case."""
+        keys = self.candidates(pattern)
+        regex = re.compile(pattern.lower().replace('*', '.*'))
+        return set(
+            key for key in (self._values_by_key if keys is None else keys)
+            if any(regex.match(value) for value in self._values_by_key[key]))
+
+
+class RangeIndex(object):
+    """Index of the keys of objects sorted by a value, objects without a value are left out.
+
+    >>> index = RangeIndex([('l1', 3), ('l2', 1), ('l3', None), ('l4', 2), ('l5', 3)])
+    >>> sorted(index.range(2, 3))
+    ['l1', 'l4', 'l5']
+    >>> sorted(index.range(end=1))
+    ['l2']
+    >>> sorted(index.range(start=4))
+    []
+    """
+
+    def __init__(self, objects=()):
+        items = sorted((value, key) for key, value in objects if value is not None)
+        self._values = [value for value, key in items]
+        self._keys = [key for value, key in items]
+
+    def range(self, start=None, end=None):
+        """Return the keys of the objects with start <= value <= end, both limits are optional."""
+        low = 0 if start is None else bisect.bisect_left(self._values, start)
+        high = len(self._values) if end is None else bisect.bisect_right(self._values, end)
+        return set(self._keys[low:high])